@@ -0,0 +1,71 @@
+"""
+Compares the fishnet and burn engines of analysis_circle.
+
+Both engines must produce identical rasters, the script fails when a pixel differs
+and prints the time taken by each engine at several cell sizes.
+
+    python benchmarks/compare_engines.py gis_osm_roads_free_1 16.55268272 40.82717010
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from osgeo import gdal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import postgis2raster
+
+
+def read_raster(path):
+    ds = gdal.Open(path)
+    return ds.ReadAsArray(), ds.GetGeoTransform()
+
+
+def run(table, query_x, query_y, radius, cell_size, engine, classes_to_bands, out_dir):
+    output_raster = os.path.join(out_dir, f"{engine}_{cell_size}_{int(classes_to_bands)}.tif")
+    start = time.perf_counter()
+    postgis2raster.analysis_circle(
+        table=table,
+        output_raster=output_raster,
+        query_x=query_x,
+        query_y=query_y,
+        radius=radius,
+        cell_size=cell_size,
+        classes_to_bands=classes_to_bands,
+        engine=engine
+    )
+    return time.perf_counter() - start, read_raster(output_raster)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('table')
+    parser.add_argument('query_x', type=float)
+    parser.add_argument('query_y', type=float)
+    parser.add_argument('--radius', type=float, default=2500)
+    parser.add_argument('--cell-sizes', type=float, nargs='+', default=[100, 50, 30, 10])
+    parser.add_argument('--classes-to-bands', action='store_true')
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'cell_size':>10} {'pixels':>10} {'fishnet s':>10} {'burn s':>10} {'speedup':>8}  identical")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for cell_size in args.cell_sizes:
+            results = {}
+            for engine in ('fishnet', 'burn'):
+                results[engine] = run(
+                    args.table, args.query_x, args.query_y, args.radius, cell_size,
+                    engine, args.classes_to_bands, out_dir
+                )
+            (t_fishnet, (a_fishnet, gt_fishnet)), (t_burn, (a_burn, gt_burn)) = results['fishnet'], results['burn']
+            identical = gt_fishnet == gt_burn and np.array_equal(a_fishnet, a_burn)
+            failed |= not identical
+            print(f"{cell_size:>10} {a_fishnet.size:>10} {t_fishnet:>10.3f} {t_burn:>10.3f} {t_fishnet/t_burn:>8.1f}  {identical}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
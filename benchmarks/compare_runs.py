@@ -0,0 +1,69 @@
+"""
+Compares two results files of run_suite.py case by case.
+
+Cases slower than the baseline by more than --threshold (p50 or p90 latency) are regressions,
+the exit status is 1 when there is any so the comparison can gate a release.
+
+    python benchmarks/compare_runs.py baseline.json results.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+
+def case_key(case):
+    return tuple(sorted(case.items()))
+
+
+def load(path):
+    with open(path) as f:
+        results = json.load(f)
+    return results['meta'], {case_key(c['case']): c for c in results['cases']}
+
+
+def compare(baseline, current, threshold=.1, stats=('p50', 'p90')):
+    """rows of (case, stat, baseline seconds, current seconds, relative change, regression) of the cases in both runs"""
+    rows = []
+    for key, case in current.items():
+        if key not in baseline:
+            continue
+        for stat in stats:
+            before = baseline[key]['latency_s'][stat]
+            after = case['latency_s'][stat]
+            change = (after - before)/before if before else 0
+            rows.append((case['case'], stat, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=.1, help='relative slow down counted as a regression')
+    parser.add_argument('--all', action='store_true', help='print every case, not only regressions and improvements')
+    args = parser.parse_args()
+
+    baseline_meta, baseline = load(args.baseline)
+    current_meta, current = load(args.current)
+    print(f"baseline {baseline_meta.get('git_revision')} {baseline_meta.get('started')}")
+    print(f"current  {current_meta.get('git_revision')} {current_meta.get('started')}")
+    missing = len(set(baseline) ^ set(current))
+    if missing:
+        print(f"{missing} cases are only in one of the runs and are not compared")
+
+    rows = compare(baseline, current, args.threshold)
+    regressions = 0
+    for case, stat, before, after, change, regression in rows:
+        regressions += regression
+        if not (args.all or regression or change < -args.threshold):
+            continue
+        name = " ".join(f"{k}={v}" for k, v in case.items())
+        flag = 'REGRESSION' if regression else ''
+        print(f"{name:<90} {stat} {before*1000:9.1f}ms -> {after*1000:9.1f}ms {change:+7.1%} {flag}")
+
+    print(f"{regressions} regressions in {len(rows)} comparisons (threshold {args.threshold:.0%})")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Per point cost of the query point projection.
+
+before: a CRS pair built for every call, what project_xy did with pyproj.Proj / pyproj.transform
+after: project_xy with the cached Transformer, and project_xy_array for whole arrays of query points
+
+    python benchmarks/project_xy.py --points 10000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pyproj
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from postgis2raster.utils import project_xy, project_xy_array
+
+
+def project_xy_uncached(x, y, source_srs, target_srs):
+    transformer = pyproj.Transformer.from_crs(f'EPSG:{source_srs}', f'EPSG:{target_srs}', always_xy=True)
+    return transformer.transform(x, y)
+
+
+def per_point(seconds, n):
+    return f"{seconds/n*1e6:>10.2f} us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--uncached-points', type=int, default=200, help='the uncached path is slow, fewer points')
+    parser.add_argument('--target-srid', type=int, default=32633)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    xs = rng.uniform(12, 18, args.points)
+    ys = rng.uniform(38, 46, args.points)
+
+    # Same three transforms get_grid makes per query point
+    def grid_transforms(transform, x, y):
+        mx, my = transform(x, y, 4326, 3857)
+        transform(mx - 2500, my - 2500, 3857, args.target_srid)
+        transform(mx + 2500, my + 2500, 3857, args.target_srid)
+
+    n = args.uncached_points
+    start = time.perf_counter()
+    for x, y in zip(xs[:n], ys[:n]):
+        grid_transforms(project_xy_uncached, float(x), float(y))
+    uncached = time.perf_counter() - start
+
+    project_xy(0, 0, 4326, 3857)
+    start = time.perf_counter()
+    for x, y in zip(xs, ys):
+        grid_transforms(project_xy, float(x), float(y))
+    cached = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid_transforms(project_xy_array, xs, ys)
+    vectorized = time.perf_counter() - start
+
+    print(f"pyproj {pyproj.__version__}, three transforms per query point")
+    print(f"{'uncached':>12} {per_point(uncached, n)}")
+    print(f"{'cached':>12} {per_point(cached, args.points)}")
+    print(f"{'vectorized':>12} {per_point(vectorized, args.points)}")
+
+
+if __name__ == '__main__':
+    main()
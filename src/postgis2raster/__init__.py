@@ -1,2 +1,14 @@
 from .main import analysis_circle, analysis_polygon
-from .utils import get_connection
\ No newline at end of file
+from .utils import get_connection
+from .pool import configure_pool, close_pool
+from .metadata import get_table_metadata, invalidate_table_metadata
+from .batch import analysis_batch, analysis_circle_batch, analysis_polygon_batch
+from .cache import ResultCache
+from .pyramid import build_pyramid, refresh_pyramid, drop_pyramid
+from .changes import enable_change_tracking, disable_change_tracking, record_changes, latest_change, changed_aois, prune_changes
+from .diagnostics import check_table, explain_plan
+from .metrics import add_metrics_hook, remove_metrics_hook, logging_hook, statsd_hook
+from .sources import PostGISSource, MemorySource, FileSource
+from .writers import OutputProfile
+from .aio import analysis_circle_async, analysis_polygon_async, configure_async_pool, close_async_pool
+from .layers import Layer, analysis_circle_layers, analysis_polygon_layers
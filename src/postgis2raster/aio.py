@@ -0,0 +1,313 @@
+import asyncio
+import contextvars
+import functools
+import time
+
+from .utils import get_class_query, get_grid
+from .pool import get_dsn
+from .metadata import metadata_cache, connection_key, _metadata_sql, _stamp_sql, _metadata_from_row
+from .main import analysis_output_profile, analysis_statement_kwargs, analysis_statement, finish_analysis
+from .metrics import instrumented, current_metrics
+from .sources import VectorSource, PostGISSource
+from . import config
+
+
+## Asyncio API start ##
+
+# Native asyncio counterparts of analysis_circle / analysis_polygon for async services, needs psycopg 3 and psycopg_pool
+#
+# Statements are built by the same functions as the blocking api (main.analysis_statement) and run on a
+# psycopg AsyncConnectionPool, the event loop keeps serving other tasks while the server rasterizes.
+# At most config.async_max_in_flight statements of the pool run at the same time, further calls wait for a slot
+# before they take a connection (back pressure). Cancelling a call cancels its statement on the server.
+
+_pool = None
+_slots = None
+
+
+def _async_pool_class():
+    try:
+        from psycopg_pool import AsyncConnectionPool
+    except ImportError:
+        raise ImportError("please install psycopg>=3.1 and psycopg_pool to use the asyncio api.")
+    return AsyncConnectionPool
+
+
+async def configure_async_pool(
+    min_size: int=None,
+    max_size: int=None,
+    max_in_flight: int=None,
+    dsn: str=None,
+    session_settings: dict=None
+    ):
+    """
+    (re)configure the asyncio connection pool of analysis_circle_async / analysis_polygon_async.
+
+    Values which are not given are taken from `config`, dsn and session_settings are shared with configure_pool.
+    An existing pool is closed.
+    -------------------------------
+    min_size: connections opened upfront and kept open.
+    max_size: upper limit of simultaneously open connections.
+    max_in_flight: statements running at the same time, further calls wait, max_size when None.
+    session_settings: session level GUCs set once per new connection e.g. {'postgis.gdal_enabled_drivers': 'ENABLE_ALL'}.
+    """
+    if min_size is not None:
+        config.async_pool_min_size = min_size
+    if max_size is not None:
+        config.async_pool_max_size = max_size
+    if max_in_flight is not None:
+        config.async_max_in_flight = max_in_flight
+    if dsn is not None:
+        config.dsn = dsn
+    if session_settings is not None:
+        config.session_settings = dict(session_settings)
+    await close_async_pool()
+
+
+async def _setup_connection(connection):
+    # Same session settings as the blocking pool, autocommit is set by the pool
+    settings = getattr(config, 'session_settings', None) or {}
+    for name, value in settings.items():
+        await connection.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+
+
+async def get_async_pool():
+    global _pool, _slots
+    pool = _pool
+    if pool is None:
+        AsyncConnectionPool = _async_pool_class()
+        # Created before the first await, concurrent first calls share it
+        pool = _pool = AsyncConnectionPool(
+            get_dsn(),
+            min_size=config.async_pool_min_size,
+            max_size=config.async_pool_max_size,
+            timeout=config.pool_timeout,
+            kwargs={'autocommit': True},
+            configure=_setup_connection,
+            open=False
+        )
+        _slots = asyncio.BoundedSemaphore(config.async_max_in_flight or config.async_pool_max_size)
+    # No-op once open
+    await pool.open()
+    return pool
+
+
+async def close_async_pool():
+    global _pool, _slots
+    pool, _pool, _slots = _pool, None, None
+    if pool is not None:
+        await pool.close()
+
+
+async def _cancel(connection):
+    # A cancelled task leaves its statement running on the server until it is cancelled as well
+    from psycopg.pq import TransactionStatus
+    if connection.info.transaction_status != TransactionStatus.ACTIVE:
+        return
+    cancel_safe = getattr(connection, 'cancel_safe', None)
+    if cancel_safe is not None:
+        # psycopg 3.2+, does not block the event loop
+        await cancel_safe()
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, connection.cancel)
+
+
+async def query_db_async(sql, params=None):
+    """rows of sql on a pooled asyncio connection, cancelling the caller cancels the statement on the server"""
+    pool = await get_async_pool()
+    slots = _slots
+    async with slots:
+        async with pool.connection() as con:
+            cur = con.cursor()
+            try:
+                await cur.execute(sql, params)
+                return await cur.fetchall()
+            except asyncio.CancelledError:
+                await _cancel(con)
+                raise
+            finally:
+                await cur.close()
+
+
+async def get_table_metadata_async(table: str, geom_column: str='wkb_geometry', schema: str='public'):
+    """metadata.get_table_metadata on the asyncio pool, both share the metadata cache"""
+    key = (connection_key(None), schema, table, geom_column)
+    entry = metadata_cache.get(key)
+    if entry is not None:
+        metadata, loaded = entry
+        if time.monotonic() - loaded < metadata_cache.ttl:
+            return metadata
+        # Expired, keep what was loaded if the table did not change
+        rows = await query_db_async(_stamp_sql, {'schema': schema, 'table': table})
+        if rows and tuple(rows[0]) == metadata.stamp:
+            metadata_cache.put(key, metadata)
+            return metadata
+
+    rows = await query_db_async(_metadata_sql, {'schema': schema, 'table': table, 'geom_column': geom_column})
+    metadata = _metadata_from_row(rows[0] if rows else None, schema, table)
+    metadata_cache.put(key, metadata)
+    return metadata
+
+
+def _in_executor(function, *args, **kwargs):
+    # Decoding and file writes off the event loop, metrics context carried along
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, function, *args, **kwargs))
+
+
+async def analysis_circle_async(
+    table: [str, PostGISSource],
+    output_raster: str,
+    query_x: float='latitude',
+    query_y: float='longitude',
+    radius: float='meter',
+    cell_size: float='meter',
+    classes: list=None,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    positive: [int, list]=1,
+    negative: [int, list]=0,
+    nodata: int=254,
+    out_srid: int=None,
+    classes_to_bands: bool=False,
+    engine: str='fishnet',
+    as_array: bool=False,
+    subdivide: [bool, int]=False,
+    simplify: float=None,
+    statistics: list=None,
+    output_profile: [str, dict, 'writers.OutputProfile']=None
+    ):
+    """
+    creates a circle analysis raster without blocking the event loop, see analysis_circle.
+
+    -------------------------------
+    Runs on the asyncio pool (configure_async_pool), 'fishnet' and 'burn' engines of PostGIS tables,
+    no tile_size, max_workers, cache or explain.
+    """
+    height = width = radius*2
+    return await analysis_polygon_async(
+        table=table,
+        output_raster=output_raster,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        width=width,
+        cell_size=cell_size,
+        classes=classes,
+        class_column=class_column,
+        geom_column=geom_column,
+        positive=positive,
+        negative=negative,
+        nodata=nodata,
+        circle=True,
+        out_srid=out_srid,
+        classes_to_bands=classes_to_bands,
+        engine=engine,
+        as_array=as_array,
+        subdivide=subdivide,
+        simplify=simplify,
+        statistics=statistics,
+        output_profile=output_profile
+    )
+
+
+@instrumented('analysis_polygon_async')
+async def analysis_polygon_async(
+    table: [str, PostGISSource],
+    output_raster: str,
+    query_x: float='latitude',
+    query_y: float='longitude',
+    height: float='meter',
+    width: float='meter',
+    cell_size: float='meter',
+    classes: list=None,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    positive: [int, list]=1,
+    negative: [int, list]=0,
+    nodata: int=254,
+    out_srid: int=None,
+    circle: bool=False,
+    classes_to_bands: bool=False,
+    engine: str='fishnet',
+    as_array: bool=False,
+    subdivide: [bool, int]=False,
+    simplify: float=None,
+    statistics: list=None,
+    output_profile: [str, dict, 'writers.OutputProfile']=None
+    ):
+    """
+    creates a polygon analysis raster without blocking the event loop, see analysis_polygon.
+
+    -------------------------------
+    Runs on the asyncio pool (configure_async_pool), 'fishnet' and 'burn' engines of PostGIS tables,
+    no tile_size, max_workers, cache or explain.
+    """
+    if as_array:
+        output_raster = None
+    elif not '.tif' in output_raster.lower():
+        output_raster+='.tif'
+
+    if engine not in ('fishnet', 'burn'):
+        raise ValueError(f"engine should be 'fishnet' or 'burn' for the asyncio api, got {engine!r}")
+    if isinstance(table, PostGISSource):
+        table, class_column, geom_column = table.table, table.class_column, table.geom_column
+    elif isinstance(table, VectorSource):
+        raise ValueError("the asyncio api rasterizes PostGIS tables, use analysis_polygon for other sources")
+    if statistics and classes_to_bands:
+        raise ValueError("statistics can not be combined with classes_to_bands")
+
+    profile = analysis_output_profile(output_profile, as_array, statistics, positive, negative, nodata)
+
+    metrics = current_metrics()
+    metrics.label(table=table, engine=engine, shape='circle' if circle else 'polygon')
+
+    with metrics.stage('srid'):
+        table_srid = (await get_table_metadata_async(table, geom_column=geom_column)).srid
+    if out_srid is None:
+        out_srid = table_srid
+
+    with metrics.stage('grid'):
+        grid = get_grid(query_x, query_y, height, width, cell_size, table_srid)
+    metrics.count('pixels', grid.n_rows*grid.n_cols)
+
+    statement_kwargs = analysis_statement_kwargs(
+        table=table,
+        grid=grid,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        cell_size=cell_size,
+        class_query=get_class_query(classes, class_column),
+        class_column=class_column,
+        geom_column=geom_column,
+        positive=positive,
+        negative=negative,
+        nodata=nodata,
+        out_srid=out_srid,
+        circle=circle,
+        classes_to_bands=classes_to_bands,
+        engine=engine,
+        subdivide=subdivide,
+        simplify=simplify,
+        statistics=statistics
+    )
+    feature_to_raster_sql = analysis_statement(grid, statement_kwargs, as_array=as_array, profile=profile)
+
+    # Waiting for a slot and a connection is part of 'query'
+    with metrics.stage('query'):
+        raster, band_classes, band_counts = (await query_db_async(feature_to_raster_sql))[0]
+
+    return await _in_executor(
+        finish_analysis,
+        raster,
+        band_classes,
+        band_counts,
+        output_raster,
+        as_array=as_array,
+        classes_to_bands=classes_to_bands,
+        statistics=statistics,
+        profile=profile
+    )
+
+## Asyncio API end ##
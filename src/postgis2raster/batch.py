@@ -0,0 +1,248 @@
+import psycopg2
+
+from .utils import stream_db, get_class_query, get_srid, get_grid, get_grids, write_band_mapping, Grid
+from .pool import borrow_connection
+from .sql import feature_to_raster_sql
+from .metrics import instrumented, current_metrics, timed_batches
+from . import config
+
+# Batch analysis, a chunk of AOIs is rasterized by one statement
+#
+#   WITH aoi(idx, query_x, ...) AS (VALUES (...), (...))
+#   SELECT aoi.idx, r.* FROM aoi, LATERAL (<analysis statement of one AOI>) r(tiff, band_classes, band_counts)
+#
+# Grids are computed on the client and joined in as columns of aoi, rasters are written as the rows stream back.
+
+_aoi_columns = ['idx', 'query_x', 'query_y', 'height', 'x_left', 'y_lower', 'x_right', 'y_upper', 'cell_size', 'n_rows', 'n_cols']
+
+
+def _per_item(value, n, name):
+    if isinstance(value, (list, tuple)) or hasattr(value, '__array__'):
+        value = list(value)
+        if len(value) != n:
+            raise ValueError(f"{name} should have {n} values, got {len(value)}")
+        return value
+    return n*[value]
+
+
+def _tif_path(output_raster):
+    if not '.tif' in output_raster.lower():
+        output_raster+='.tif'
+    return output_raster
+
+
+def batch_sql(grids: dict, query_x, query_y, heights, **kwargs):
+    """statement rasterizing the AOIs of grids {idx: Grid}, returns rows of (idx, GeoTIFF bytes, band classes, band counts)"""
+    values = ",\n".join(
+        f"({idx}, {query_x[idx]}, {query_y[idx]}, {heights[idx]}, {g.x_left}, {g.y_lower}, {g.x_right}, {g.y_upper}, {g.cell_size}, {g.n_rows}, {g.n_cols})"
+        for idx, g in grids.items()
+    )
+    srid = next(iter(grids.values())).srid
+    aoi_grid = Grid(srid, 'aoi.x_left', 'aoi.y_lower', 'aoi.x_right', 'aoi.y_upper', 'aoi.cell_size', 'aoi.n_rows', 'aoi.n_cols')
+    aoi_sql = feature_to_raster_sql(
+        grid=aoi_grid,
+        query_x='aoi.query_x',
+        query_y='aoi.query_y',
+        height='aoi.height',
+        **kwargs
+    )
+    return f"""
+        WITH aoi({', '.join(_aoi_columns)}) AS (
+            VALUES {values}
+        )
+
+        SELECT
+            aoi.idx,
+            r.tiff,
+            r.band_classes,
+            r.band_counts
+        FROM
+            aoi,
+            LATERAL (
+                {aoi_sql}
+            ) r(tiff, band_classes, band_counts)
+    """
+
+
+@instrumented('analysis_batch')
+def analysis_batch(
+    table: str,
+    output_rasters: list,
+    query_x: list,
+    query_y: list,
+    height: [float, list],
+    width: [float, list],
+    cell_size: [float, list],
+    classes: list=None,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    positive: int=1,
+    negative: int=0,
+    nodata: int=254,
+    out_srid: int=None,
+    circle: bool=False,
+    classes_to_bands: bool=False,
+    engine: str='fishnet',
+    chunk_size: int=None,
+    connection: 'psycopg2 connection' = None
+    ) -> list:
+    """
+    creates one analysis raster per query point, a chunk of query points per server round trip.
+
+    The SRID lookup and the SQL are done once per chunk, not per query point.
+    A failing query point does not abort the others of its chunk, the pending query points of a failed statement
+    are bisected until the failing ones run alone. A raster that can not be written fails its query point only.
+    -------------------------------
+    output_rasters: one output path per query point.
+    query_x, query_y: arrays of query point coordinates (longitude, latitude).
+    height, width, cell_size: single value or one value per query point.
+    classes_to_bands: one band per class, a band mapping csv is written next to every raster.
+    engine: 'fishnet' or 'burn', see analysis_polygon.
+    chunk_size: query points per statement, default config.batch_chunk_size.
+
+    returns a list with True or the raised exception for every query point.
+    """
+    n = len(output_rasters)
+    query_x = _per_item(query_x, n, 'query_x')
+    query_y = _per_item(query_y, n, 'query_y')
+    heights = _per_item(height, n, 'height')
+    widths = _per_item(width, n, 'width')
+    cell_sizes = _per_item(cell_size, n, 'cell_size')
+    output_rasters = [_tif_path(x) for x in output_rasters]
+    chunk_size = chunk_size or config.batch_chunk_size
+
+    metrics = current_metrics()
+    metrics.label(table=table, engine=engine, shape='circle' if circle else 'polygon')
+    metrics.count('items', n)
+
+    results = n*[None]
+    with borrow_connection(connection) as connection:
+        with metrics.stage('srid'):
+            table_srid = get_srid(table, geom_column=geom_column, connection=connection)
+        statement_kwargs = dict(
+            table=table,
+            class_query=get_class_query(classes, class_column),
+            class_column=class_column,
+            geom_column=geom_column,
+            positive=positive,
+            negative=negative,
+            nodata=nodata,
+            out_srid=table_srid if out_srid is None else out_srid,
+            circle=circle,
+            classes_to_bands=classes_to_bands,
+            engine=engine
+        )
+
+        # Grids of all query points in a few vectorized transforms, point by point when one of them fails
+        try:
+            with metrics.stage('grid'):
+                all_grids = get_grids(query_x, query_y, heights, widths, cell_sizes, table_srid)
+        except Exception:
+            all_grids = None
+
+        def run_chunk(idxs):
+            grids = {}
+            for idx in idxs:
+                if all_grids is not None:
+                    grids[idx] = all_grids[idx]
+                    continue
+                try:
+                    grids[idx] = get_grid(query_x[idx], query_y[idx], heights[idx], widths[idx], cell_sizes[idx], table_srid)
+                except Exception as e:
+                    results[idx] = e
+            if not grids:
+                return
+
+            sql = batch_sql(grids, query_x, query_y, heights, **statement_kwargs)
+            savepoint = not connection.autocommit
+            try:
+                if savepoint:
+                    connection.cursor().execute("SAVEPOINT postgis2raster_batch")
+                # 'query' is the time spent waiting for rasters, server execution and transfer
+                for rows in timed_batches(stream_db(sql, connection, batch_size=config.batch_fetch_size), stage='query'):
+                    for idx, raster, band_classes, band_counts in rows:
+                        if raster is None:
+                            results[idx] = ValueError(f"empty raster for query point {idx}")
+                            continue
+                        metrics.count('payload_bytes', len(raster))
+                        try:
+                            with metrics.stage('write'):
+                                if classes_to_bands:
+                                    write_band_mapping(output_rasters[idx], list(zip(band_classes or [], band_counts or [])))
+                                with open(output_rasters[idx], 'wb') as f:
+                                    f.write(raster)
+                        except OSError as e:
+                            results[idx] = e
+                            continue
+                        results[idx] = True
+                if savepoint:
+                    connection.cursor().execute("RELEASE SAVEPOINT postgis2raster_batch")
+            except psycopg2.Error as e:
+                if savepoint and not connection.closed:
+                    connection.cursor().execute("ROLLBACK TO SAVEPOINT postgis2raster_batch")
+                pending = [idx for idx in grids if results[idx] is None]
+                if len(grids) == 1:
+                    for idx in pending:
+                        results[idx] = e
+                    return
+                # Isolate the failing query points in halves, a few statements for one bad point in a large chunk
+                half = (len(pending) + 1)//2
+                for part in (pending[:half], pending[half:]):
+                    if part:
+                        run_chunk(part)
+
+        for start in range(0, n, chunk_size):
+            run_chunk(range(start, min(start + chunk_size, n)))
+
+    return results
+
+
+def analysis_polygon_batch(
+    table: str,
+    output_rasters: list,
+    query_x: list,
+    query_y: list,
+    height: [float, list],
+    width: [float, list],
+    cell_size: [float, list],
+    **kwargs
+    ) -> list:
+    """creates one polygon analysis raster per query point, see analysis_batch"""
+    return analysis_batch(
+        table=table,
+        output_rasters=output_rasters,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        width=width,
+        cell_size=cell_size,
+        circle=False,
+        **kwargs
+    )
+
+
+def analysis_circle_batch(
+    table: str,
+    output_rasters: list,
+    query_x: list,
+    query_y: list,
+    radius: [float, list],
+    cell_size: [float, list],
+    **kwargs
+    ) -> list:
+    """creates one circle analysis raster per query point, see analysis_batch"""
+    if isinstance(radius, (list, tuple)) or hasattr(radius, '__array__'):
+        height = width = [r*2 for r in radius]
+    else:
+        height = width = radius*2
+    return analysis_batch(
+        table=table,
+        output_rasters=output_rasters,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        width=width,
+        cell_size=cell_size,
+        circle=True,
+        **kwargs
+    )
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+from . import config
+from .metadata import _fetch_stamp, connection_key
+from .pool import borrow_connection
+from .metrics import current_metrics
+from .sources import VectorSource
+
+
+## Result Cache start ##
+
+# Content addressed cache of analysis results
+#
+# key = sha256 of the canonical request parameters, the database and the table version stamp,
+# a changed table (or a new user supplied version) gives new keys and old entries age out of the LRU.
+# File results are kept in a directory as {key}.tif (+ {key}.csv band mapping), array results in process.
+
+# Parameters which change how a raster is made but not its pixels
+_ignored_parameters = ('output_raster', 'connection', 'batch_size', 'tile_size', 'max_workers', 'as_array', 'table_version', 'subdivide')
+
+
+def _canonical(value):
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) or hasattr(value, 'item'):
+        # 30 and 30.0 (or numpy scalars) are the same request
+        return repr(float(value))
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return str(value)
+
+
+def request_key(parameters: dict, version, dsn: str=None) -> str:
+    """sha256 of the canonical analysis parameters, version of the table and database"""
+    parameters = {k: v for k, v in parameters.items() if k not in _ignored_parameters}
+    if parameters.get('classes') is not None:
+        # Classes only filter the features, their order does not matter
+        parameters['classes'] = sorted(str(c) for c in parameters['classes'])
+    canonical = json.dumps(
+        {
+            'parameters': {k: _canonical(v) for k, v in parameters.items()},
+            'version': _canonical(version),
+            'dsn': dsn,
+        },
+        sort_keys=True
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    size bounded LRU cache of analysis rasters.
+
+    directory: GeoTIFF results are cached in this directory, survives restarts and can be shared by processes:
+        misses look for the file on disk, eviction goes by the files in the directory (least recently used by mtime).
+        Without a directory only array results (as_array=True) are cached.
+    max_bytes: size of the files in directory after which least recently used entries are evicted.
+    max_array_bytes: size of the in process array results after which least recently used entries are evicted.
+    Array results are cached as read only copies, hits return the cached copy.
+    """
+
+    def __init__(self, directory: str=None, max_bytes: int=None, max_array_bytes: int=None):
+        self.directory = directory
+        self.max_bytes = config.result_cache_max_bytes if max_bytes is None else max_bytes
+        self.max_array_bytes = config.result_cache_max_array_bytes if max_array_bytes is None else max_array_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = OrderedDict()     # key: bytes on disk
+        self._arrays = OrderedDict()    # key: RasterArray
+        self._array_bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    def _path(self, key: str, suffix: str='.tif'):
+        return os.path.join(self.directory, key + suffix)
+
+    def _entry_size(self, key: str):
+        # Bytes of a cached raster and its band mapping, None when another process evicted it
+        try:
+            size = os.path.getsize(self._path(key))
+        except FileNotFoundError:
+            return None
+        try:
+            size += os.path.getsize(self._path(key, '.csv'))
+        except FileNotFoundError:
+            pass
+        return size
+
+    def _load_index(self):
+        # Least recently used first, hits touch the file, files removed by other processes meanwhile are skipped
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.tif'):
+                continue
+            key = name[:-4]
+            try:
+                mtime = os.path.getmtime(self._path(key))
+            except FileNotFoundError:
+                continue
+            size = self._entry_size(key)
+            if size is not None:
+                entries.append((mtime, key, size))
+        self._files = OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    @property
+    def size(self):
+        return sum(self._files.values())
+
+    def stats(self) -> dict:
+        """counters to size the cache"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': len(self._files),
+                'bytes': self.size,
+                'arrays': len(self._arrays),
+                'array_bytes': self._array_bytes,
+            }
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get_file(self, key: str, output_raster: str, classes_to_bands: bool=False) -> bool:
+        """copies a cached raster (and band mapping) to output_raster, False when not cached"""
+        if self.directory is None:
+            self._count(False)
+            return False
+        # Looked up on disk, entries cached by other processes are not in the index
+        try:
+            if classes_to_bands:
+                shutil.copyfile(self._path(key, '.csv'), f"{output_raster}.classes_to_bands_mapping.csv")
+            shutil.copyfile(self._path(key), output_raster)
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Evicted by another process
+            with self._lock:
+                self._files.pop(key, None)
+            self._count(False)
+            return False
+        size = self._entry_size(key)
+        with self._lock:
+            if size is not None:
+                self._files[key] = size
+                self._files.move_to_end(key)
+        self._count(True)
+        return True
+
+    def put_file(self, key: str, output_raster: str, classes_to_bands: bool=False):
+        if self.directory is None:
+            return
+        # Copied under a temporary name and renamed, readers never see a partial file
+        tmp = self._path(f"{key}.{uuid.uuid4().hex}", '.tmp')
+        size = 0
+        if classes_to_bands:
+            shutil.copyfile(f"{output_raster}.classes_to_bands_mapping.csv", tmp)
+            os.replace(tmp, self._path(key, '.csv'))
+            size += os.path.getsize(self._path(key, '.csv'))
+        shutil.copyfile(output_raster, tmp)
+        os.replace(tmp, self._path(key))
+        size += os.path.getsize(self._path(key))
+        with self._lock:
+            # Entries of every process sharing the directory count against max_bytes
+            self._load_index()
+            self._files[key] = size
+            self._files.move_to_end(key)
+            total = self.size
+            while total > self.max_bytes and len(self._files) > 1:
+                old_key, old_size = self._files.popitem(last=False)
+                for suffix in ('.tif', '.csv'):
+                    try:
+                        os.remove(self._path(old_key, suffix))
+                    except FileNotFoundError:
+                        pass
+                total -= old_size
+                self.evictions += 1
+
+    def get_array(self, key: str):
+        with self._lock:
+            raster = self._arrays.get(key)
+            if raster is not None:
+                self._arrays.move_to_end(key)
+        self._count(raster is not None)
+        return raster
+
+    def put_array(self, key: str, raster):
+        # Hits share the copy, the caller keeps a writable array
+        array = raster.array.copy()
+        array.setflags(write=False)
+        raster = raster._replace(array=array)
+        with self._lock:
+            if key in self._arrays:
+                self._array_bytes -= self._arrays.pop(key).array.nbytes
+            self._arrays[key] = raster
+            self._array_bytes += raster.array.nbytes
+            while self._array_bytes > self.max_array_bytes and len(self._arrays) > 1:
+                _, old = self._arrays.popitem(last=False)
+                self._array_bytes -= old.array.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """drops every entry, counters are kept"""
+        with self._lock:
+            if self.directory is not None:
+                for key in self._files:
+                    for suffix in ('.tif', '.csv'):
+                        try:
+                            os.remove(self._path(key, suffix))
+                        except FileNotFoundError:
+                            pass
+            self._files.clear()
+            self._arrays.clear()
+            self._array_bytes = 0
+
+
+def cached_analysis(cache: ResultCache, analysis, parameters: dict, table_version=None):
+    """
+    result of analysis(**parameters) served from cache when the same request was made on the same table version.
+
+    table_version: version of the table given by the caller, by default the modification stamp of the table
+        (inserted, updated, deleted rows and relfilenode from the statistics collector) read on every call,
+        not from the metadata cache whose entries may be up to its ttl old, version() of a sources.VectorSource.
+    """
+    connection = parameters.get('connection')
+    if table_version is None and isinstance(parameters['table'], VectorSource):
+        table_version = parameters['table'].version()
+    elif table_version is None:
+        with borrow_connection(connection) as con:
+            table_version = _fetch_stamp(con, 'public', parameters['table'])
+        if table_version is None:
+            raise ValueError(f"table public.{parameters['table']} does not exist")
+    key = request_key(parameters, table_version, dsn=connection_key(connection))
+
+    metrics = current_metrics()
+    if parameters.get('as_array'):
+        with metrics.stage('cache'):
+            raster = cache.get_array(key)
+        metrics.count('cache_hits', int(raster is not None))
+        if raster is None:
+            raster = analysis(**parameters)
+            with metrics.stage('cache'):
+                cache.put_array(key, raster)
+        return raster
+
+    output_raster = parameters['output_raster']
+    # Statistics rasters come with a band mapping file too
+    classes_to_bands = bool(parameters.get('classes_to_bands') or parameters.get('statistics'))
+    with metrics.stage('cache'):
+        hit = cache.get_file(key, output_raster, classes_to_bands)
+    metrics.count('cache_hits', int(hit))
+    if hit:
+        return True
+    result = analysis(**parameters)
+    with metrics.stage('cache'):
+        cache.put_file(key, output_raster, classes_to_bands)
+    return result
+
+## Result Cache end ##
@@ -0,0 +1,343 @@
+from .pool import borrow_connection
+from .utils import query_db, quote_identifier
+from . import config
+
+
+## Change Tracking start ##
+
+# Bounding boxes of inserted, updated and deleted features per table, to regenerate only the outputs they touch
+#
+# public.postgis2raster_changes(id, schema_name, table_name, op, changed_at, txid, bbox)
+#   id              increasing change id, in the order the ids were drawn, not the order the changes committed
+#   txid            transaction that recorded the change, outputs remember the xmin of the snapshot they were made in
+#                   (their watermark, see latest_change), every change of a transaction below it was committed (or rolled back) by then
+#   op              'I'nsert, 'U'pdate, 'D'elete, 'T'runcate or table replaced
+#   bbox            envelope of the old or new feature in the table srid, NULL when everything may have changed
+#
+# Changes are recorded by one of two methods, registered in public.postgis2raster_tracking:
+#   trigger     statement level triggers on the table, for tables updated in place
+#   snapshot    record_changes diffs the table against a snapshot of its feature hashes and bboxes
+#               ({table}_changes_snapshot), for tables replaced by imports e.g. ogr2ogr -overwrite
+#
+# changed_aois finds the AOIs with changes after their watermark, refresh_pyramid(changed_only=True) the pyramid tiles.
+
+_changes = "public.postgis2raster_changes"
+_tracking = "public.postgis2raster_tracking"
+_trigger_function = "public.postgis2raster_record_changes"
+_trigger_ops = {'insert': 'NEW TABLE AS new_rows', 'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows', 'delete': 'OLD TABLE AS old_rows'}
+
+_create_changes_sql = f"""
+    CREATE TABLE IF NOT EXISTS {_changes} (
+        id bigserial PRIMARY KEY,
+        schema_name text NOT NULL,
+        table_name text NOT NULL,
+        op char(1) NOT NULL,
+        changed_at timestamptz NOT NULL DEFAULT now(),
+        txid bigint NOT NULL DEFAULT txid_current(),
+        bbox geometry
+    );
+    CREATE INDEX IF NOT EXISTS postgis2raster_changes_table_idx ON {_changes} (schema_name, table_name, txid);
+    CREATE INDEX IF NOT EXISTS postgis2raster_changes_bbox_idx ON {_changes} USING gist (bbox);
+    CREATE TABLE IF NOT EXISTS {_tracking} (
+        schema_name text,
+        table_name text,
+        geom_column text NOT NULL,
+        class_column text,
+        method text NOT NULL,
+        PRIMARY KEY (schema_name, table_name)
+    );
+"""
+
+# Statement level, one insert per statement with the envelopes of all its rows, the geometry column is TG_ARGV[0]
+_create_trigger_function_sql = f"""
+    CREATE OR REPLACE FUNCTION {_trigger_function}() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'TRUNCATE' THEN
+            INSERT INTO {_changes} (schema_name, table_name, op, bbox) VALUES (TG_TABLE_SCHEMA, TG_TABLE_NAME, 'T', NULL);
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            EXECUTE format(
+                'INSERT INTO {_changes} (schema_name, table_name, op, bbox) SELECT %L, %L, %L, ST_Envelope(%I) FROM old_rows WHERE %I IS NOT NULL',
+                TG_TABLE_SCHEMA, TG_TABLE_NAME, left(TG_OP, 1), TG_ARGV[0], TG_ARGV[0]
+            );
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            EXECUTE format(
+                'INSERT INTO {_changes} (schema_name, table_name, op, bbox) SELECT %L, %L, %L, ST_Envelope(%I) FROM new_rows WHERE %I IS NOT NULL',
+                TG_TABLE_SCHEMA, TG_TABLE_NAME, left(TG_OP, 1), TG_ARGV[0], TG_ARGV[0]
+            );
+        END IF;
+        RETURN NULL;
+    END
+    $$
+"""
+
+
+def snapshot_table_name(table: str, schema: str='public'):
+    # Quoted like the tracked table, the suffix is part of the quoted name
+    return f"{quote_identifier(schema)}.{quote_identifier(table + '_changes_snapshot')}"
+
+
+def _feature_sql(table, geom_column, class_column, schema):
+    # Hash of a feature's geometry and class, ids are not stable across imports
+    class_value = f"COALESCE(t.{quote_identifier(class_column)}::text, '')" if class_column else "''"
+    return f"""
+        SELECT
+            md5(ST_AsEWKB(t.{quote_identifier(geom_column)})::text || {class_value}) AS hash,
+            ST_Envelope(t.{quote_identifier(geom_column)}) AS bbox
+        FROM
+            {quote_identifier(schema)}.{quote_identifier(table)} t
+        WHERE
+            t.{quote_identifier(geom_column)} IS NOT NULL
+    """
+
+
+def _create_triggers(cur, table, geom_column, schema):
+    qualified = f"{quote_identifier(schema)}.{quote_identifier(table)}"
+    for op, referencing in _trigger_ops.items():
+        cur.execute(f"""
+            DROP TRIGGER IF EXISTS postgis2raster_changes_{op} ON {qualified};
+            CREATE TRIGGER postgis2raster_changes_{op} AFTER {op.upper()} ON {qualified}
+            REFERENCING {referencing}
+            FOR EACH STATEMENT EXECUTE PROCEDURE {_trigger_function}('{geom_column.replace("'", "''")}')
+        """)
+    cur.execute(f"""
+        DROP TRIGGER IF EXISTS postgis2raster_changes_truncate ON {qualified};
+        CREATE TRIGGER postgis2raster_changes_truncate AFTER TRUNCATE ON {qualified}
+        FOR EACH STATEMENT EXECUTE PROCEDURE {_trigger_function}('{geom_column.replace("'", "''")}')
+    """)
+
+
+def _tracking_row(table, schema, connection):
+    if query_db(f"SELECT to_regclass('{_tracking}')", connection=connection)[0][0] is None:
+        return None
+    rows = query_db(
+        f"SELECT geom_column, class_column, method FROM {_tracking} WHERE schema_name = %s AND table_name = %s",
+        connection=connection,
+        params=(schema, table)
+    )
+    return rows[0] if rows else None
+
+
+def enable_change_tracking(
+    table: str,
+    geom_column: str='wkb_geometry',
+    class_column: str='fclass',
+    method: str='trigger',
+    schema: str='public',
+    connection: 'psycopg2 connection'=None
+    ):
+    """
+    records the bounding boxes of changed features of a table from now on.
+
+    -------------------------------
+    method: 'trigger' statement level triggers record every insert, update, delete (and truncate) as it happens,
+        'snapshot' takes a snapshot of the features, record_changes diffs the table against it after each import.
+        Tables dropped and created again by an import (ogr2ogr -overwrite) lose their triggers, use 'snapshot'.
+    class_column: part of the feature hash of 'snapshot', a changed class is a change. None to ignore classes.
+    """
+    if method not in ('trigger', 'snapshot'):
+        raise ValueError(f"method should be 'trigger' or 'snapshot', got {method!r}")
+    with borrow_connection(connection) as connection:
+        cur = connection.cursor()
+        cur.execute(_create_changes_sql)
+        if method == 'trigger':
+            cur.execute(_create_trigger_function_sql)
+            _create_triggers(cur, table, geom_column, schema)
+        else:
+            snapshot = snapshot_table_name(table, schema)
+            cur.execute(f"""
+                DROP TABLE IF EXISTS {snapshot};
+                CREATE TABLE {snapshot} AS {_feature_sql(table, geom_column, class_column, schema)};
+                CREATE INDEX ON {snapshot} (hash);
+            """)
+        cur.execute(
+            f"""
+                INSERT INTO {_tracking} (schema_name, table_name, geom_column, class_column, method)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (schema_name, table_name) DO UPDATE SET
+                    geom_column = EXCLUDED.geom_column,
+                    class_column = EXCLUDED.class_column,
+                    method = EXCLUDED.method
+            """,
+            (schema, table, geom_column, class_column, method)
+        )
+        cur.close()
+
+
+def disable_change_tracking(table: str, schema: str='public', connection: 'psycopg2 connection'=None):
+    """drops the triggers or snapshot of a table, its recorded changes are kept until prune_changes"""
+    with borrow_connection(connection) as connection:
+        tracking = _tracking_row(table, schema, connection)
+        if tracking is None:
+            return
+        cur = connection.cursor()
+        if tracking[2] == 'trigger':
+            if query_db("SELECT to_regclass(%s)", connection=connection, params=(f"{quote_identifier(schema)}.{quote_identifier(table)}",))[0][0] is not None:
+                for op in (*_trigger_ops, 'truncate'):
+                    cur.execute(f"DROP TRIGGER IF EXISTS postgis2raster_changes_{op} ON {quote_identifier(schema)}.{quote_identifier(table)}")
+        else:
+            cur.execute(f"DROP TABLE IF EXISTS {snapshot_table_name(table, schema)}")
+        cur.execute(f"DELETE FROM {_tracking} WHERE schema_name = %s AND table_name = %s", (schema, table))
+        cur.close()
+
+
+def record_changes(table: str, schema: str='public', connection: 'psycopg2 connection'=None) -> int:
+    """
+    brings the change log of a table up to date, run it after each import.
+
+    'snapshot' tables are diffed against their snapshot in one statement: features whose hash is new are recorded
+    with their new bbox, features whose hash is gone with their old bbox, then the snapshot is replaced.
+    'trigger' tables already logged their changes, when the table was replaced (the triggers are gone) the whole
+    table is recorded as changed and the triggers are created again.
+
+    returns the number of changes recorded.
+    """
+    with borrow_connection(connection) as connection:
+        tracking = _tracking_row(table, schema, connection)
+        if tracking is None:
+            raise ValueError(f"no change tracking for {schema}.{table}, see enable_change_tracking")
+        geom_column, class_column, method = tracking
+        cur = connection.cursor()
+
+        if method == 'trigger':
+            cur.execute(
+                """
+                    SELECT count(*) FROM pg_trigger
+                    WHERE tgrelid = to_regclass(%s) AND tgname = 'postgis2raster_changes_insert'
+                """,
+                (f"{quote_identifier(schema)}.{quote_identifier(table)}",)
+            )
+            if cur.fetchone()[0]:
+                cur.close()
+                return 0
+            cur.execute(f"INSERT INTO {_changes} (schema_name, table_name, op, bbox) VALUES (%s, %s, 'T', NULL)", (schema, table))
+            _create_triggers(cur, table, geom_column, schema)
+            cur.close()
+            return 1
+
+        snapshot = snapshot_table_name(table, schema)
+        # Source scanned once into a temporary table, diff and new snapshot in one transaction
+        autocommit = connection.autocommit
+        connection.autocommit = False
+        try:
+            cur.execute(f"""
+                DROP TABLE IF EXISTS postgis2raster_current;
+                CREATE TEMPORARY TABLE postgis2raster_current ON COMMIT DROP AS {_feature_sql(table, geom_column, class_column, schema)};
+                ANALYZE postgis2raster_current;
+            """)
+            cur.execute(f"""
+                INSERT INTO {_changes} (schema_name, table_name, op, bbox)
+                SELECT %(schema)s, %(table)s, 'I', c.bbox
+                FROM (
+                    SELECT DISTINCT ON (hash) hash, bbox FROM postgis2raster_current
+                    WHERE hash IN (SELECT hash FROM postgis2raster_current EXCEPT ALL SELECT hash FROM {snapshot})
+                ) c
+                UNION ALL
+                SELECT %(schema)s, %(table)s, 'D', s.bbox
+                FROM (
+                    SELECT DISTINCT ON (hash) hash, bbox FROM {snapshot}
+                    WHERE hash IN (SELECT hash FROM {snapshot} EXCEPT ALL SELECT hash FROM postgis2raster_current)
+                ) s
+            """, {'schema': schema, 'table': table})
+            recorded = cur.rowcount
+            cur.execute(f"""
+                TRUNCATE {snapshot};
+                INSERT INTO {snapshot} (hash, bbox) SELECT hash, bbox FROM postgis2raster_current;
+            """)
+            if autocommit:
+                connection.commit()
+        except BaseException:
+            if autocommit and not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            if not connection.closed:
+                connection.autocommit = autocommit
+        cur.execute(f"ANALYZE {snapshot}")
+        cur.close()
+    return recorded
+
+
+def latest_change(table: str, schema: str='public', connection: 'psycopg2 connection'=None) -> int:
+    """
+    watermark of outputs generated from now on, 0 without changes.
+
+    The xmin of the current snapshot: changes of transactions below it are committed and seen by the output,
+    changes of the transactions from it on (running now, or committed but maybe not seen) count as after the watermark.
+    max(id) would not do, a transaction still running can commit a lower id after a higher one was seen.
+    txid_current_snapshot is pg_current_snapshot of PostgreSQL 13+, kept for older servers.
+    """
+    with borrow_connection(connection) as connection:
+        if query_db(f"SELECT to_regclass('{_changes}')", connection=connection)[0][0] is None:
+            return 0
+        return query_db(
+            f"""
+                SELECT CASE WHEN EXISTS (SELECT 1 FROM {_changes} WHERE schema_name = %s AND table_name = %s)
+                    THEN txid_snapshot_xmin(txid_current_snapshot()) ELSE 0 END
+            """,
+            connection=connection,
+            params=(schema, table)
+        )[0][0]
+
+
+def changed_aois(
+    table: str,
+    aois: dict,
+    srid: int,
+    since: [int, dict]=0,
+    schema: str='public',
+    chunk_size: int=None,
+    connection: 'psycopg2 connection'=None
+    ) -> set:
+    """
+    keys of the AOIs intersecting a change of the table recorded after their watermark.
+
+    -------------------------------
+    aois: {key: (xmin, ymin, xmax, ymax)} in srid, the table srid, e.g. the extents of utils.get_grids.
+    since: watermark (latest_change when the output was generated) of every AOI, or {key: watermark}.
+    chunk_size: AOIs per statement, default config.changes_chunk_size.
+    """
+    keys = list(aois)
+    chunk_size = chunk_size or config.changes_chunk_size
+    changed = set()
+    with borrow_connection(connection) as connection:
+        if query_db(f"SELECT to_regclass('{_changes}')", connection=connection)[0][0] is None:
+            return changed
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            values = ",\n".join(
+                f"({i}, {int(since.get(key) or 0) if isinstance(since, dict) else int(since or 0)}, {', '.join(str(float(v)) for v in aois[key])})"
+                for i, key in enumerate(chunk, start)
+            )
+            rows = query_db(
+                f"""
+                    SELECT a.idx
+                    FROM (VALUES {values}) a(idx, since, xmin, ymin, xmax, ymax)
+                    WHERE EXISTS (
+                        SELECT 1 FROM {_changes} c
+                        WHERE
+                            c.schema_name = %s
+                            AND c.table_name = %s
+                            AND c.txid >= a.since
+                            AND (c.bbox IS NULL OR c.bbox && ST_MakeEnvelope(a.xmin, a.ymin, a.xmax, a.ymax, {int(srid)}))
+                    )
+                """,
+                connection=connection,
+                params=(schema, table)
+            )
+            changed.update(keys[idx] for idx, in rows)
+    return changed
+
+
+def prune_changes(table: str, up_to: int, schema: str='public', connection: 'psycopg2 connection'=None) -> int:
+    """deletes the changes of a table before watermark up_to (the lowest watermark still in use), returns the number deleted"""
+    with borrow_connection(connection) as connection:
+        cur = connection.cursor()
+        cur.execute(f"DELETE FROM {_changes} WHERE schema_name = %s AND table_name = %s AND txid < %s", (schema, table, up_to))
+        deleted = cur.rowcount
+        cur.close()
+    return deleted
+
+## Change Tracking end ##
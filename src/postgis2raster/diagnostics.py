@@ -0,0 +1,223 @@
+import json
+from collections import namedtuple
+
+from .pool import borrow_connection
+from .utils import query_db, quote_identifier
+from .metadata import get_table_metadata, invalidate_table_metadata
+from . import config
+
+
+## Diagnostics Functions start ##
+
+# Checks of a source table (indexes, planner statistics, vertex counts) and EXPLAIN capture of generated statements
+
+TableReport = namedtuple(
+    'TableReport',
+    ['table', 'geometry_type', 'row_estimate', 'geom_index', 'class_index', 'last_analyze', 'modified_since_analyze', 'vertices', 'issues', 'fixed']
+)
+TableReport.__doc__ = """
+    geom_index: name of the GiST index on the geometry column, None when missing.
+    class_index: name of an index led by the class column, None when missing.
+    last_analyze: time of the last (auto) ANALYZE, None when never analyzed.
+    modified_since_analyze: rows modified since the last ANALYZE.
+    vertices: vertex count distribution of a sample {'sampled', 'mean', 'p50', 'p90', 'p99', 'max'}.
+    issues: problems found, in words.
+    fixed: statements run to fix them.
+"""
+
+ExplainReport = namedtuple(
+    'ExplainReport',
+    ['sql', 'plan', 'planning_time', 'execution_time', 'seq_scans', 'cte_times', 'slow_nodes']
+)
+ExplainReport.__doc__ = """
+    sql: the explained statement.
+    plan: EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) plan.
+    planning_time, execution_time: milliseconds.
+    seq_scans: [(relation, rows)] sequential scans of tables.
+    cte_times: {cte name: milliseconds} of the materialized CTE stages.
+    slow_nodes: [(node, milliseconds)] plan nodes by exclusive time, slowest first.
+"""
+
+_indexes_sql = """
+    SELECT
+        i.relname,
+        am.amname,
+        a.attname
+    FROM
+        pg_index x
+        JOIN pg_class c ON c.oid = x.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class i ON i.oid = x.indexrelid
+        JOIN pg_am am ON am.oid = i.relam
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = x.indkey[0]
+    WHERE
+        n.nspname = %(schema)s
+        AND c.relname = %(table)s
+        AND x.indisvalid
+"""
+
+_stats_sql = """
+    SELECT
+        GREATEST(s.last_analyze, s.last_autoanalyze),
+        s.n_mod_since_analyze,
+        s.n_live_tup
+    FROM
+        pg_stat_user_tables s
+    WHERE
+        s.schemaname = %(schema)s
+        AND s.relname = %(table)s
+"""
+
+
+def _vertices_sql(table, geom_column, schema, sample_percent):
+    return f"""
+        SELECT
+            COUNT(*),
+            AVG(n),
+            percentile_disc(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY n),
+            MAX(n)
+        FROM (
+            SELECT ST_NPoints({quote_identifier(geom_column)}) AS n
+            FROM {quote_identifier(schema)}.{quote_identifier(table)} TABLESAMPLE SYSTEM ({float(sample_percent)})
+        ) a
+    """
+
+
+def check_table(
+    table: str,
+    geom_column: str='wkb_geometry',
+    class_column: str='fclass',
+    schema: str='public',
+    fix: bool=False,
+    sample_percent: float=1,
+    connection: 'psycopg2 connection'=None
+    ) -> TableReport:
+    """
+    checks a source table before first use.
+
+    Looks for a GiST index on geom_column, an index on class_column (filtered with IN (...)),
+    planner statistics older than config.stats_stale_fraction of the rows and features with many vertices.
+    -------------------------------
+    fix: create the missing indexes and ANALYZE the table when its statistics are stale.
+        Indexes are built CONCURRENTLY on autocommit (pooled) connections.
+    sample_percent: percent of the table pages sampled for the vertex counts.
+    """
+    issues = []
+    fixed = []
+    params = {'schema': schema, 'table': table}
+    with borrow_connection(connection) as connection:
+        metadata = get_table_metadata(table, geom_column=geom_column, schema=schema, connection=connection)
+
+        geom_index = class_index = None
+        for name, method, column in query_db(_indexes_sql, connection=connection, params=params):
+            if column == geom_column and method == 'gist':
+                geom_index = geom_index or name
+            if column == class_column and method in ('btree', 'hash'):
+                class_index = class_index or name
+
+        stats = query_db(_stats_sql, connection=connection, params=params)
+        last_analyze, modified, live = stats[0] if stats else (None, None, None)
+
+        n, mean, percentiles, largest = query_db(
+            _vertices_sql(table, geom_column, schema, sample_percent), connection=connection
+        )[0]
+        p50, p90, p99 = percentiles or (None, None, None)
+        vertices = {'sampled': n, 'mean': float(mean) if mean is not None else None, 'p50': p50, 'p90': p90, 'p99': p99, 'max': largest}
+
+        # Names quoted as they are, like in the catalog queries above
+        qualified = f"{quote_identifier(schema)}.{quote_identifier(table)}"
+        concurrently = "CONCURRENTLY " if connection.autocommit else ""
+        statements = []
+        if geom_index is None:
+            issues.append(f"no GiST index on {geom_column}, every ST_Intersects selection scans the whole table")
+            statements.append(f"CREATE INDEX {concurrently}ON {qualified} USING gist ({quote_identifier(geom_column)})")
+        if class_column is not None and class_index is None:
+            issues.append(f"no index on {class_column}, class filters can not use an index")
+            statements.append(f"CREATE INDEX {concurrently}ON {qualified} ({quote_identifier(class_column)})")
+        stale = last_analyze is None or (modified or 0) > config.stats_stale_fraction*max(live or 0, 1)
+        if stale:
+            issues.append(f"planner statistics are stale, last analyzed {last_analyze}, {modified} rows modified since")
+        if largest is not None and largest > config.vertex_warning_count:
+            issues.append(f"features with up to {largest} vertices (p99 {p99}), large features make intersections slow, see subdivide=True")
+
+        if fix:
+            cur = connection.cursor()
+            for statement in statements:
+                cur.execute(statement)
+                fixed.append(statement)
+            if statements or stale:
+                cur.execute(f"ANALYZE {qualified}")
+                fixed.append(f"ANALYZE {qualified}")
+                invalidate_table_metadata(table, schema=schema)
+            cur.close()
+
+    return TableReport(
+        table=f"{schema}.{table}",
+        geometry_type=metadata.geometry_type,
+        row_estimate=metadata.row_estimate,
+        geom_index=geom_index,
+        class_index=class_index,
+        last_analyze=last_analyze,
+        modified_since_analyze=modified,
+        vertices=vertices,
+        issues=issues,
+        fixed=fixed
+    )
+
+
+def _walk(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _walk(child)
+
+
+def _node_time(node):
+    # Actual Total Time is per loop
+    return node.get('Actual Total Time', 0)*node.get('Actual Loops', 1)
+
+
+def _node_name(node):
+    name = node['Node Type']
+    for key in ('Relation Name', 'CTE Name', 'Function Name', 'Index Name'):
+        if key in node:
+            name += f" on {node[key]}"
+            break
+    if 'Subplan Name' in node:
+        name = f"{node['Subplan Name']}: {name}"
+    return name
+
+
+def explain_plan(sql: str, params=None, connection: 'psycopg2 connection'=None) -> ExplainReport:
+    """
+    runs sql with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) and summarizes the plan.
+
+    The statement is executed, the analysis statements only read.
+    """
+    plan = query_db(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", connection=connection, params=params)[0][0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+
+    seq_scans = []
+    cte_times = {}
+    exclusive = []
+    for node in _walk(plan['Plan']):
+        if node['Node Type'] == 'Seq Scan':
+            seq_scans.append((node.get('Relation Name'), node.get('Actual Rows', 0)*node.get('Actual Loops', 1)))
+        if node.get('Subplan Name', '').startswith('CTE '):
+            cte_times[node['Subplan Name'][4:]] = _node_time(node)
+        children = sum(_node_time(child) for child in node.get('Plans', []))
+        exclusive.append((_node_name(node), max(_node_time(node) - children, 0)))
+
+    exclusive.sort(key=lambda x: x[1], reverse=True)
+    return ExplainReport(
+        sql=sql,
+        plan=plan,
+        planning_time=plan.get('Planning Time'),
+        execution_time=plan.get('Execution Time'),
+        seq_scans=seq_scans,
+        cte_times=cte_times,
+        slow_nodes=exclusive[:config.explain_slow_nodes]
+    )
+
+## Diagnostics Functions end ##
@@ -0,0 +1,180 @@
+from collections import namedtuple
+
+from .utils import query_db, get_class_query, get_srid, get_grid
+from .pool import borrow_connection
+from .sql import layers_to_raster_sql
+from .main import analysis_output_profile, statement_output_kwargs, finish_analysis
+from .metrics import instrumented, current_metrics
+from .sources import PostGISSource
+from . import config
+
+# Composite rasters, several tables rasterized onto one grid and selection by one statement
+#
+#   WITH q AS (selection), q_mask AS (selection rasterized once),
+#   layer_0 AS (WITH q_ras, features, <engine> SELECT raster, labels, counts), layer_1 AS (...), ...
+#   SELECT all bands of layer_0, layer_1, ... as one raster, band labels, band counts
+#
+# The bands of a layer are its classes with classes_to_bands, else one band. The band mapping csv
+# lists every band as label (single band layers) or label:class.
+
+Layer = namedtuple(
+    'Layer',
+    ['table', 'class_column', 'geom_column', 'classes', 'positive', 'negative', 'classes_to_bands', 'subdivide', 'simplify', 'name'],
+    defaults=('fclass', 'wkb_geometry', None, 1, 0, False, None, None, None)
+)
+Layer.__doc__ = """
+    table: name of a PostGIS table or a sources.PostGISSource.
+    classes: class values to rasterize, all features when None.
+    positive, negative: values of the layer's bands, positive can be a list of one value per class with classes_to_bands.
+    classes_to_bands: one band per class found in the selection instead of one band.
+    subdivide, simplify: feature preparation of the layer, see analysis_polygon.
+    name: label of the layer's bands in the band mapping, the table name by default.
+"""
+
+
+def _layer_kwargs(layer) -> dict:
+    layer = layer if isinstance(layer, Layer) else Layer(**layer)
+    table, class_column, geom_column = layer.table, layer.class_column, layer.geom_column
+    if isinstance(table, PostGISSource):
+        table, class_column, geom_column = table.table, table.class_column, table.geom_column
+    return dict(
+        table=table,
+        geom_column=geom_column,
+        class_column=class_column,
+        class_query=get_class_query(layer.classes, class_column),
+        positive=layer.positive,
+        negative=layer.negative,
+        classes_to_bands=layer.classes_to_bands,
+        subdivide=config.subdivide_max_vertices if layer.subdivide is True else layer.subdivide or None,
+        simplify=layer.simplify,
+        label=layer.name or table
+    )
+
+
+def analysis_circle_layers(
+    layers: list,
+    output_raster: str,
+    query_x: float='latitude',
+    query_y: float='longitude',
+    radius: float='meter',
+    cell_size: float='meter',
+    nodata: int=254,
+    out_srid: int=None,
+    engine: str='fishnet',
+    as_array: bool=False,
+    output_profile: [str, dict, 'writers.OutputProfile']=None,
+    connection: 'psycopg2 connection' = None
+    ):
+    """
+    creates one circle analysis raster with the bands of several tables, see analysis_polygon_layers.
+    """
+    height = width = radius*2
+    return analysis_polygon_layers(
+        layers=layers,
+        output_raster=output_raster,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        width=width,
+        cell_size=cell_size,
+        nodata=nodata,
+        out_srid=out_srid,
+        circle=True,
+        engine=engine,
+        as_array=as_array,
+        output_profile=output_profile,
+        connection=connection
+    )
+
+
+@instrumented('analysis_polygon_layers')
+def analysis_polygon_layers(
+    layers: list,
+    output_raster: str,
+    query_x: float='latitude',
+    query_y: float='longitude',
+    height: float='meter',
+    width: float='meter',
+    cell_size: float='meter',
+    nodata: int=254,
+    out_srid: int=None,
+    circle: bool=False,
+    engine: str='fishnet',
+    as_array: bool=False,
+    output_profile: [str, dict, 'writers.OutputProfile']=None,
+    connection: 'psycopg2 connection' = None
+    ):
+    """
+    creates one polygon analysis raster with the bands of several tables, e.g. a feature stack of roads, buildings and landuse.
+
+         roads     buildings   landuse:forest  landuse:farmland
+         _ _ _ _ _    _ _ _ _ _    _ _ _ _ _    _ _ _ _ _
+        |1 1 0 0 0|  |0 0 1 0 0|  |0 0 0 1 1|  |1 0 0 0 0|
+        |0 1 1 1 0|  |0 0 0 0 1|  |0 0 0 1 1|  |1 1 0 0 0|
+        |0_0_1_1_1|  |1_0_0_0_0|  |0_0_0_0_1|  |1_1_0_0_0|
+
+    The selection, template and mask are computed once and every table is rasterized onto them in a single statement,
+    a band mapping csv of every band (layer name or layer name:class) is written next to output_raster.
+    -------------------------------
+    layers: list of layers.Layer or dicts of its fields, all tables in the same srid.
+    engine: 'fishnet' or 'burn', see analysis_polygon.
+    as_array: return a raster_wkb.RasterArray with the band mapping instead of writing output_raster.
+    output_profile: layout and compression of output_raster, see analysis_polygon.
+    """
+    if as_array:
+        output_raster = None
+    elif not '.tif' in output_raster.lower():
+        output_raster+='.tif'
+    if engine not in ('fishnet', 'burn'):
+        raise ValueError(f"engine should be 'fishnet' or 'burn' for layers, got {engine!r}")
+    if not layers:
+        raise ValueError("layers should have at least one layer")
+
+    layers = [_layer_kwargs(layer) for layer in layers]
+    values = [v for layer in layers for v in (
+        *(layer['positive'] if isinstance(layer['positive'], (list, tuple)) else [layer['positive']]), layer['negative']
+    )]
+    profile = analysis_output_profile(output_profile, as_array, None, values, [], nodata)
+
+    metrics = current_metrics()
+    metrics.label(table=','.join(layer['table'] for layer in layers), engine=engine, shape='circle' if circle else 'polygon')
+    metrics.count('layers', len(layers))
+
+    with borrow_connection(connection) as connection:
+        with metrics.stage('srid'):
+            srids = {layer['table']: get_srid(layer['table'], geom_column=layer['geom_column'], connection=connection) for layer in layers}
+        if len(set(srids.values())) > 1:
+            raise ValueError(f"layers should share one srid, got {srids}")
+        table_srid = next(iter(srids.values()))
+        if out_srid is None:
+            out_srid = table_srid
+
+        with metrics.stage('grid'):
+            grid = get_grid(query_x, query_y, height, width, cell_size, table_srid)
+        metrics.count('pixels', grid.n_rows*grid.n_cols)
+
+        sql = layers_to_raster_sql(
+            layers,
+            grid,
+            query_x,
+            query_y,
+            height,
+            nodata=nodata,
+            out_srid=out_srid,
+            circle=circle,
+            engine=engine,
+            **statement_output_kwargs(as_array, profile)
+        )
+        with metrics.stage('query'):
+            raster, band_labels, band_counts = query_db(sql, connection=connection)[0]
+
+    # Every composite has a band mapping, written like classes_to_bands
+    return finish_analysis(
+        raster,
+        band_labels,
+        band_counts,
+        output_raster,
+        as_array=as_array,
+        classes_to_bands=True,
+        profile=profile
+    )
@@ -1,9 +1,18 @@
-from .utils import project_xy, query_db, center_hw_to_polygon, get_class_query, get_srid
-import math
+import inspect
+import os
+from contextlib import ExitStack
+
+from .utils import Grid, query_db, get_class_query, get_srid, get_grid, write_band_mapping
+from .pool import borrow_connection
+from .sql import ENGINES, class_count_sql, feature_count_sql, feature_to_raster_sql as build_feature_to_raster_sql
+from .metrics import instrumented, current_metrics, timed_batches
+from .sources import VectorSource, PostGISSource
+from .writers import get_output_profile, check_profile_values
+from . import config
 
 # Highest Level Functions
 def analysis_circle(
-    table:str, 
+    table: [str, VectorSource], 
     output_raster: str, 
     query_x: float='latitude', 
     query_y: float='longitude', 
@@ -17,8 +26,20 @@ def analysis_circle(
     nodata: int=254,
     out_srid: int=None,
     classes_to_bands: bool=False,
+    engine: str='fishnet',
+    batch_size: int=None,
+    tile_size: int=None,
+    max_workers: int=None,
+    as_array: bool=False,
+    cache: 'ResultCache'=None,
+    table_version=None,
+    explain: bool=False,
+    subdivide: [bool, int]=False,
+    simplify: float=None,
+    statistics: list=None,
+    output_profile: [str, dict, 'writers.OutputProfile']=None,
     connection: 'psycopg2 connection' = None
-    ) -> bool:
+    ):
     """
     creates a circle analysis raster
 
@@ -41,10 +62,42 @@ def analysis_circle(
         |0_0_0_1_1|  |0_0_1_1_1| 
         
     -------------------------------
+    table: name of a PostGIS table or a sources.VectorSource e.g. sources.FileSource('roads.gpkg'),
+        features of sources other than sources.PostGISSource are selected and rasterized in process without a database.
     classes: list of values from the class folder to look for.
     positive: int value for single band and multiple values for each class to be used in target raster's positive values.
     negative: int value for single band and multiple values for each class to be used in target raster's negative values.
     classes_to_bands: each class is in different band, a supporting file for class to band mapping will also be generated {output_raster}.txt.
+    engine: 'fishnet' intersects every pixel polygon with the features, 'burn' burns the features straight onto the grid (faster,
+        pixels the features only touch on their edges or corners can differ, see sql.burn_sql),
+        'numpy' streams the selected features as WKB and rasterizes them on the client (needs numpy and gdal),
+        'pyramid' reads the pre-rasterized tiles of pyramid.build_pyramid, 'burn' when no pyramid level lines up with the grid.
+    batch_size: features fetched per round trip by the 'numpy' engine, default config.stream_batch_size.
+    tile_size: rasterize tiles of tile_size x tile_size pixels one by one into a tiled GeoTIFF, memory stays proportional to the tile size.
+    max_workers: rasterize parts of the grid concurrently on up to max_workers pooled connections and stitch them on the client,
+        capped by config.max_workers_per_request.
+    as_array: return the raster as a raster_wkb.RasterArray (numpy array, geotransform, crs, nodata, band mapping)
+        instead of writing output_raster, output_raster can be None.
+    cache: cache.ResultCache, the same request on the same table version is copied from the cache without the database.
+    table_version: version of the table for the cache key, by default the table's modification stamp.
+    explain: run the statement with EXPLAIN (ANALYZE, BUFFERS) and return a diagnostics.ExplainReport
+        (sequential scans, CTE stage times, slowest plan nodes) instead of the raster.
+    subdivide: clip the features to the grid and split them into parts of at most subdivide vertices
+        (config.subdivide_max_vertices when True) before the pixel tests of the 'fishnet' and 'burn' engines,
+        for huge polygons (coastlines, landuse, admin areas). The raster is unchanged.
+    simplify: also simplify the clipped features with a tolerance of simplify*cell_size e.g. 0.1,
+        only pixels an edge passes closer than the tolerance can change.
+    statistics: one band per statistic of the features touching each pixel, computed in a single statement
+        instead of one run per statistic, e.g. ['presence', 'count', 'length', 'max:maxspeed'].
+        'presence' positive / negative, 'count' number of features, 'length' meters of lines in the pixel,
+        'area_fraction' covered part of the pixel (0 to 1), 'min:column' / 'max:column' of a numeric column.
+        Bands share the narrowest type holding all of them (8BUI, 16BUI or 32BF, nodata see config),
+        the statistic of every band is written to the band mapping file like classes_to_bands.
+        'fishnet' and 'burn' engines of PostGIS tables only, not with classes_to_bands, tile_size or max_workers.
+    output_profile: layout and compression of output_raster, a name of config.output_profiles e.g. 'cog' (Cloud Optimized GeoTIFF,
+        tiled with overviews, DEFLATE with predictor), a dict or a writers.OutputProfile. Encoded on the server
+        (ST_AsGDALRaster, the COG driver needs GDAL 3.1+) or here with encode='client' (needs gdal).
+        None for the LZW compressed striped GeoTIFF of the server.
     """
 
     height = width = radius*2
@@ -61,14 +114,28 @@ def analysis_circle(
         geom_column=geom_column,
         positive=positive,
         negative=negative,
+        nodata=nodata,
         circle=True,
         out_srid=out_srid,
         classes_to_bands=classes_to_bands,
+        engine=engine,
+        batch_size=batch_size,
+        tile_size=tile_size,
+        max_workers=max_workers,
+        as_array=as_array,
+        cache=cache,
+        table_version=table_version,
+        explain=explain,
+        subdivide=subdivide,
+        simplify=simplify,
+        statistics=statistics,
+        output_profile=output_profile,
         connection=connection
     )
 
+@instrumented('analysis_polygon')
 def analysis_polygon(
-    table:str, 
+    table: [str, VectorSource], 
     output_raster: str, 
     query_x: float='latitude', 
     query_y: float='longitude', 
@@ -84,8 +151,20 @@ def analysis_polygon(
     out_srid: int=None,
     circle: bool=False,
     classes_to_bands: bool=False,
+    engine: str='fishnet',
+    batch_size: int=None,
+    tile_size: int=None,
+    max_workers: int=None,
+    as_array: bool=False,
+    cache: 'ResultCache'=None,
+    table_version=None,
+    explain: bool=False,
+    subdivide: [bool, int]=False,
+    simplify: float=None,
+    statistics: list=None,
+    output_profile: [str, dict, 'writers.OutputProfile']=None,
     connection: 'psycopg2 connection' = None
-    ) -> bool:
+    ):
     """
     creates a polygon analysis raster
 
@@ -108,296 +187,383 @@ def analysis_polygon(
         |0_0_0_1_1|  |0_0_1_1_1|
 
     -------------------------------
+    table: name of a PostGIS table or a sources.VectorSource e.g. sources.FileSource('roads.gpkg'),
+        features of sources other than sources.PostGISSource are selected and rasterized in process without a database.
     classes: list of values from the class folder to look for.
     positive: int value for single band and multiple values for each class to be used in target raster's positive values.
     negative: int value for single band and multiple values for each class to be used in target raster's negative values.
     classes_to_bands: each class is in different band, a supporting file for class to band mapping will also be generated {output_raster}_classes_to_bands_mapping.txt.
-
+    engine: 'fishnet' intersects every pixel polygon with the features, 'burn' burns the features straight onto the grid (faster,
+        pixels the features only touch on their edges or corners can differ, see sql.burn_sql),
+        'numpy' streams the selected features as WKB and rasterizes them on the client (needs numpy and gdal),
+        'pyramid' reads the pre-rasterized tiles of pyramid.build_pyramid, 'burn' when no pyramid level lines up with the grid.
+    batch_size: features fetched per round trip by the 'numpy' engine, default config.stream_batch_size.
+    tile_size: rasterize tiles of tile_size x tile_size pixels one by one into a tiled GeoTIFF, memory stays proportional to the tile size.
+    max_workers: rasterize parts of the grid concurrently on up to max_workers pooled connections and stitch them on the client,
+        capped by config.max_workers_per_request.
+    as_array: return the raster as a raster_wkb.RasterArray (numpy array, geotransform, crs, nodata, band mapping)
+        instead of writing output_raster, output_raster can be None.
+    cache: cache.ResultCache, the same request on the same table version is copied from the cache without the database.
+    table_version: version of the table for the cache key, by default the table's modification stamp.
+    explain: run the statement with EXPLAIN (ANALYZE, BUFFERS) and return a diagnostics.ExplainReport
+        (sequential scans, CTE stage times, slowest plan nodes) instead of the raster.
+    subdivide: clip the features to the grid and split them into parts of at most subdivide vertices
+        (config.subdivide_max_vertices when True) before the pixel tests of the 'fishnet' and 'burn' engines,
+        for huge polygons (coastlines, landuse, admin areas). The raster is unchanged.
+    simplify: also simplify the clipped features with a tolerance of simplify*cell_size e.g. 0.1,
+        only pixels an edge passes closer than the tolerance can change.
+    statistics: one band per statistic of the features touching each pixel, computed in a single statement
+        instead of one run per statistic, e.g. ['presence', 'count', 'length', 'max:maxspeed'].
+        'presence' positive / negative, 'count' number of features, 'length' meters of lines in the pixel,
+        'area_fraction' covered part of the pixel (0 to 1), 'min:column' / 'max:column' of a numeric column.
+        Bands share the narrowest type holding all of them (8BUI, 16BUI or 32BF, nodata see config),
+        the statistic of every band is written to the band mapping file like classes_to_bands.
+        'fishnet' and 'burn' engines of PostGIS tables only, not with classes_to_bands, tile_size or max_workers.
+    output_profile: layout and compression of output_raster, a name of config.output_profiles e.g. 'cog' (Cloud Optimized GeoTIFF,
+        tiled with overviews, DEFLATE with predictor), a dict or a writers.OutputProfile. Encoded on the server
+        (ST_AsGDALRaster, the COG driver needs GDAL 3.1+) or here with encode='client' (needs gdal).
+        None for the LZW compressed striped GeoTIFF of the server.
     """
     #
     #   
         
-    if not '.tif' in output_raster.lower():
+    if as_array:
+        output_raster = None
+    elif not '.tif' in output_raster.lower():
         output_raster+='.tif'
 
-    class_query = get_class_query(classes, class_column)
-    table_srid = get_srid(table, geom_column=geom_column) 
-
-    if out_srid is None:
-        out_srid = table_srid
-    
-    # Convert Lat Long to Meter coordinates in 3857 for calculations as height width are in meters
-    x, y = project_xy(query_x, query_y, 4326, 3857)
-    x_left, y_lower, x_right, y_upper = center_hw_to_polygon(x, y, height, width)
-
-    # Dimension of Raster
-    n_rows = math.ceil((x_right - x_left) / cell_size)
-    n_cols = math.ceil((y_upper - y_lower) / cell_size)
-
-    # Find Coordinates in degrees
-    # x_left_d, y_lower_d = project_xy(x_left, y_lower, 3857, 4326)
-    # x_right_d, y_upper_d = project_xy(x_right, y_upper, 3857, 4326)
-
-    # Find Grid size in degrees
-    # cell_size_d = (((x_right_d - x_left_d) / (x_right - x_left)) + ((y_upper_d - y_lower_d) / (y_upper - y_lower))) *.5*cell_size
-
-
-    # Convert query coordinates to table srid
-    x_left_t, y_lower_t = project_xy(x_left, y_lower, 3857, table_srid)
-    x_right_t, y_upper_t = project_xy(x_right, y_upper, 3857, table_srid)
-
-    # Find Grid size in table srid units
-    cell_size_t = (((x_right_t - x_left_t) / (x_right - x_left)) + ((y_upper_t - y_lower_t) / (y_upper - y_lower))) *.5*cell_size
-
-    # Based on input selection type create selection query
-    if circle:
-        selection_geom_query = f"""
-            WITH a AS (
-                SELECT 
-                    ST_SetSRID(ST_Point({query_x}, {query_y}), 4326) AS geom
-            ),
-
-            b AS (
-                SELECT 
-                    ST_Buffer(ST_Transform(a.geom, 3857), {height/2}) AS geom
-                FROM a
-            )
-
-            SELECT
-                ST_Transform(geom, {table_srid}) as geom
-            FROM b
-
-        """
-    else: # POlygon
-        selection_geom_query = f"""
-            SELECT ST_GeomFromText('POLYGON(({x_left_t} {y_lower_t}, {x_left_t} {y_upper_t}, {x_right_t} {y_upper_t}, {x_right_t} {y_lower_t}, {x_left_t} {y_lower_t}))', {table_srid})
-        """
-
-    # Rasterization template query 
-    raster_template_sql = f""" 
-        SELECT ST_SetBandNoDataValue(ST_MakeEmptyRaster({n_cols}, {n_rows}, {x_left_t}, {y_upper_t}, {cell_size_t}, {cell_size_t}, {0}, {0}, {table_srid}), {nodata})
-    """
-
-    # Selection Query and empty raster for fishnet
-    selection_query = f"""
-        q AS (
-            {selection_geom_query} AS geom
+    if engine not in ENGINES:
+        raise ValueError(f"engine should be one of {ENGINES}, got {engine!r}")
+
+    if cache is not None and not explain:
+        # Arguments of this call only, no other local may be defined before locals() is read
+        parameters = dict(locals())
+        parameters = {
+            name: parameters[name] for name in inspect.signature(analysis_polygon).parameters
+            if name not in ('cache', 'table_version')
+        }
+        from .cache import cached_analysis
+        return cached_analysis(cache, analysis_polygon, parameters, table_version=table_version)
+
+    # PostGIS tables by name, any other source is rasterized on the client
+    source = None
+    if isinstance(table, PostGISSource):
+        connection = connection or table.connection
+        table, class_column, geom_column = table.table, table.class_column, table.geom_column
+    elif isinstance(table, VectorSource):
+        source, engine = table, 'numpy'
+        if explain:
+            raise ValueError("explain needs a PostGIS table")
+    if (tile_size or max_workers) and engine == 'numpy':
+        raise ValueError("tile_size and max_workers are supported by the 'fishnet' and 'burn' engines")
+    if statistics:
+        if engine in ('numpy', 'pyramid'):
+            raise ValueError("statistics are computed by PostGIS, use the 'fishnet' or 'burn' engine of a PostGIS table")
+        if classes_to_bands or tile_size or max_workers:
+            raise ValueError("statistics can not be combined with classes_to_bands, tile_size or max_workers")
+
+    profile = analysis_output_profile(output_profile, as_array, statistics, positive, negative, nodata)
+
+    # Stage timings and counts for the metrics hooks, no-ops without hooks
+    metrics = current_metrics()
+    metrics.label(table=table, engine=engine, shape='circle' if circle else 'polygon')
+
+    # One connection for every query of this call, pooled unless given by the caller
+    with ExitStack() as stack:
+        if source is None:
+            with metrics.stage('connection'):
+                connection = stack.enter_context(borrow_connection(connection))
+
+        class_query = get_class_query(classes, class_column)
+        with metrics.stage('srid'):
+            table_srid = source.srid if source is not None else get_srid(table, geom_column=geom_column, connection=connection) 
+
+        if out_srid is None:
+            out_srid = table_srid
+
+        with metrics.stage('grid'):
+            grid = get_grid(query_x, query_y, height, width, cell_size, table_srid)
+        metrics.count('pixels', grid.n_rows*grid.n_cols)
+
+        pyramid_kwargs = {}
+        if engine == 'pyramid':
+            # Indexed raster read of the pre-rasterized tiles, the features are burnt when no level lines up with the grid
+            from .pyramid import get_pyramid, pyramid_level
+            with metrics.stage('pyramid'):
+                pyramid = get_pyramid(table, class_column=class_column, geom_column=geom_column, connection=connection)
+            level = None if pyramid is None else pyramid_level(pyramid, grid)
+            if level is None:
+                engine = 'burn'
+            else:
+                pyramid_kwargs = dict(pyramid_table=pyramid.pyramid_table, pyramid_level=level)
+            metrics.label(engine=engine)
+
+        if metrics.enabled and not classes_to_bands and not statistics and not explain and config.metrics_count_features and engine != 'numpy':
+            # Number of selected features, classes_to_bands gets it with the band mapping, the numpy engine from the streamed rows
+            with metrics.stage('feature_count'):
+                metrics.count('features', query_db(feature_count_sql(
+                    table=table,
+                    grid=grid,
+                    query_x=query_x,
+                    query_y=query_y,
+                    height=height,
+                    class_query=class_query,
+                    class_column=class_column,
+                    geom_column=geom_column,
+                    circle=circle
+                ), connection=connection)[0][0])
+
+        if engine == 'numpy':
+            # Database (or the in process index of a source) only selects features, rasterization on the client
+            from .rasterize import rasterize_stream
+            from .writers import write_geotiff
+
+            if source is None:
+                source = PostGISSource(table, class_column=class_column, geom_column=geom_column, connection=connection)
+            if explain:
+                from .diagnostics import explain_plan
+                return explain_plan(
+                    source.stream_sql(grid, query_x, query_y, height, classes=classes, circle=circle),
+                    connection=connection
+                )
+            # 'fetch' is the part of 'rasterize' spent waiting for rows
+            with metrics.stage('rasterize'):
+                array, band_mapping = rasterize_stream(
+                    grid,
+                    timed_batches(source.feature_batches(
+                        grid,
+                        query_x,
+                        query_y,
+                        height,
+                        classes=classes,
+                        circle=circle,
+                        batch_size=batch_size or config.stream_batch_size
+                    ), count_features=not classes_to_bands),
+                    positive=positive,
+                    negative=negative,
+                    nodata=nodata,
+                    classes_to_bands=classes_to_bands
+                )
+            metrics.count('bands', array.shape[0])
+            if classes_to_bands:
+                metrics.count('features', sum(n for _, n in band_mapping))
+            if as_array:
+                from .writers import array_to_raster_array
+                with metrics.stage('warp'):
+                    result = array_to_raster_array(array, grid, nodata=nodata, out_srid=out_srid, band_mapping=band_mapping)
+                metrics.count('output_bytes', result.array.nbytes)
+                return result
+            with metrics.stage('write'):
+                if classes_to_bands:
+                    write_band_mapping(output_raster, band_mapping)
+                if profile is not None:
+                    from .writers import array_to_raster_array, write_raster
+                    result = write_raster(output_raster, array_to_raster_array(array, grid, nodata=nodata, out_srid=out_srid), profile)
+                else:
+                    result = write_geotiff(output_raster, array, grid, nodata=nodata, out_srid=out_srid)
+            metrics.count('output_bytes', os.path.getsize(output_raster))
+            return result
+
+        statement_kwargs = analysis_statement_kwargs(
+            table=table,
+            grid=grid,
+            query_x=query_x,
+            query_y=query_y,
+            height=height,
+            cell_size=cell_size,
+            class_query=class_query,
+            class_column=class_column,
+            geom_column=geom_column,
+            positive=positive,
+            negative=negative,
+            nodata=nodata,
+            out_srid=out_srid,
+            circle=circle,
+            classes_to_bands=classes_to_bands,
+            engine=engine,
+            subdivide=subdivide,
+            simplify=simplify,
+            statistics=statistics,
+            **pyramid_kwargs
         )
-    """
 
-    # Rasterize Selection query
-    selection_query_rasterize = f"""
-        q_ras AS (
-            SELECT
-                ST_Union(
-                    ST_AsRaster(
-                        q.geom,
-                        ({raster_template_sql}),
-                        '8BUI'::text, 
-                        {negative}, 
-                        {nodata}
-                    ),
-                    'Max'
-                ) AS ras
-            FROM q
-        )
-    """
+        if (tile_size or (max_workers or 1) > 1) and not explain:
+            # Tile by tile into a tiled GeoTIFF, every tile gets the bands of the whole selection
+            from .tiling import analysis_tiled
+
+            band_classes = band_mapping = None
+            if classes_to_bands:
+                with metrics.stage('class_count'):
+                    band_mapping = query_db(class_count_sql(
+                        table=table,
+                        grid=grid,
+                        query_x=query_x,
+                        query_y=query_y,
+                        height=height,
+                        class_query=class_query,
+                        class_column=class_column,
+                        geom_column=geom_column,
+                        circle=circle
+                    ), connection=connection)
+                metrics.count('features', sum(n for _, n in band_mapping))
+                if not as_array:
+                    write_band_mapping(output_raster, band_mapping)
+                band_classes = [row[0] for row in band_mapping]
+            metrics.count('bands', 1 if band_classes is None else max(len(band_classes), 1))
+            with metrics.stage('tiles'):
+                result = analysis_tiled(
+                    output_raster,
+                    grid,
+                    statement_kwargs,
+                    tile_size=tile_size,
+                    nodata=nodata,
+                    out_srid=out_srid,
+                    band_classes=band_classes,
+                    max_workers=max_workers,
+                    as_array=as_array,
+                    profile=profile,
+                    connection=connection
+                )
+            if as_array:
+                metrics.count('output_bytes', result.array.nbytes)
+                return result._replace(band_mapping=band_mapping)
+            metrics.count('output_bytes', os.path.getsize(output_raster))
+            return result
+
+        feature_to_raster_sql = analysis_statement(grid, statement_kwargs, as_array=as_array, profile=profile)
+
+        if explain:
+            from .diagnostics import explain_plan
+            return explain_plan(feature_to_raster_sql, connection=connection)
+
+        # Server execution and transfer of the raster
+        with metrics.stage('query'):
+            if config.prepared_statements and engine in ('fishnet', 'burn') and not statistics:
+                from .prepared import query_prepared
+                sql, params, types = prepared_statement(
+                    grid, statement_kwargs, query_x, query_y, height, classes, class_column, as_array=as_array, profile=profile
+                )
+                raster, band_classes, band_counts = query_prepared(sql, params, types, connection=connection)[0]
+            else:
+                raster, band_classes, band_counts = query_db(feature_to_raster_sql, connection=connection)[0]
+
+    return finish_analysis(
+        raster,
+        band_classes,
+        band_counts,
+        output_raster,
+        as_array=as_array,
+        classes_to_bands=classes_to_bands,
+        statistics=statistics,
+        profile=profile
+    )
 
-    # Use the Selection query to select features from source table
-    features_selection_query = f"""
-        features AS (            
-            SELECT                 
-                t.{geom_column} AS geom,
-                t.{class_column} as class
-            FROM                 
-                public.{table} t,                
-                q            
-            WHERE                 
-                ST_Intersects(q.geom, t.{geom_column})                
-                AND                
-                {class_query}        
-        )
-    """
 
-    # Fishnet from raster band 1
-    fishnet_query = f"""
-        q_poly AS (
-            SELECT  
-                (pp).geom AS geom
-            FROM 
-                (
-                    SELECT ST_PixelAsPolygons(
-                        q_ras.ras, 
-                        1
-                    ) pp
-                    FROM q_ras
-                ) a, 
-                features f
-            WHERE 
-                ST_Intersects(f.geom, (pp).geom)   
-        )
-    """
+# Steps shared by analysis_polygon and the asyncio api (aio), everything but the database round trips
 
-    # Fishnet to point query
-    fishnet_to_point_query = f"""
-        q_point AS (
-            SELECT
-                ST_Collect(ST_Centroid(q_poly.geom)) as geom
-            FROM 
-                q_poly
-        )
-    """
+def analysis_output_profile(output_profile, as_array, statistics, positive, negative, nodata):
+    """writers.OutputProfile of output_profile checked against the raster values, None for arrays"""
+    # Written rasters only, arrays are returned as they are
+    profile = None if as_array else get_output_profile(output_profile)
+    if profile is not None and profile.nbits:
+        if statistics:
+            raise ValueError("nbits packs the 8 bit masks, not statistics")
+        values = [*(positive if isinstance(positive, (list, tuple)) else [positive]),
+                  *(negative if isinstance(negative, (list, tuple)) else [negative]), nodata]
+        check_profile_values(profile, values)
+    return profile
 
-    # Updated values of rasterized selection query with positive values from fishnet points
-    update_selection_raster_query = f"""raster_w_values AS (
-        SELECT 
-            ST_SetValue(
-                q_ras.ras,
-                1,
-                q_point.geom,
-                {positive}
-            ) AS ras
-        FROM
-            q_ras,
-            q_point
+
+def analysis_statement_kwargs(table, grid, query_x, query_y, height, cell_size, subdivide=False, statistics=None, **kwargs):
+    """keyword arguments of sql.feature_to_raster_sql for an analysis on grid, kwargs are passed as they are"""
+    return dict(
+        table=table,
+        query_x=query_x,
+        query_y=query_y,
+        height=height,
+        subdivide=config.subdivide_max_vertices if subdivide is True else subdivide or None,
+        statistics=statistics,
+        # Meters per table unit for the 'length' statistic
+        length_scale=cell_size/grid.cell_size,
+        **kwargs
     )
-    """
 
-    if classes_to_bands:
-        #
-        classes_in_selection_query = f"""
-            WITH {selection_query}
-            SELECT 
-                t.{class_column} as class,
-                COUNT(t.{class_column}) as num_features
-            FROM 
-                public.{table} t,                
-                q            
-            WHERE                 
-                ST_Intersects(q.geom, t.{geom_column})                
-                AND                
-                {class_query}
-            GROUP BY
-                {class_column}
-        """
-        classes_in_selection = query_db(classes_in_selection_query)
-        csv_file = f"{output_raster}.classes_to_bands_mapping.csv"
-        with open(csv_file, 'w') as f:
-            f.write('S.no, class, number of features, raster_band_idx\n')
-            for i, row in enumerate(classes_in_selection):
-                line = f"{i+1}, {row[0]}, {row[1]}, {i}\n"
-                f.write(line)
-
-        num_bands = len(classes_in_selection)        
-        datatype_array = ", ".join(num_bands*["'8BUI'::text"])
-        negative_val_array = num_bands*[negative]
-        nodata_val_array = num_bands*[nodata]
 
-        
-        fishnet_to_point_query_store = []
-        update_selection_raster_query_setvalue = "q_ras.ras"
-        update_selection_raster_query_from = "q_ras"
-        for i, row in enumerate(classes_in_selection):
-            idx = i+1
-            _fishnet_to_point_query = f"""
-                q_point_{idx} AS (
-                    SELECT
-                        ST_Collect(ST_Centroid(q_poly.geom)) AS geom,
-                        {idx} AS idx
-                    FROM 
-                        q_poly,
-                        features f
-                    WHERE
-                        ST_Intersects(q_poly.geom, f.geom)
-                        AND
-                        f.class = '{row[0]}'
-                )
-            """
-            fishnet_to_point_query_store.append(_fishnet_to_point_query)
-
-            _positive = positive
-            if type(positive) == list:
-                _positive = positive[i]
-            
-            update_selection_raster_query_setvalue = f"""
-                ST_SetValue(
-                    {update_selection_raster_query_setvalue},
-                    {idx},
-                    q_point_{idx}.geom,
-                    {_positive}
-                )
-            """
-            update_selection_raster_query_from += f", q_point_{idx}"
-
-        fishnet_to_point_query = ",\n".join(fishnet_to_point_query_store)
-
-        update_selection_raster_query = f"""
-            raster_w_values AS (
-                SELECT 
-                    {update_selection_raster_query_setvalue} AS ras
-                FROM
-                    {update_selection_raster_query_from}
-            )
-        """
-        selection_query_rasterize = f"""
-            q_ras AS (
-                SELECT
-                    ST_Union(
-                        ST_AsRaster(
-                            q.geom,
-                            ({raster_template_sql}),
-                            ARRAY[{datatype_array}], 
-                            ARRAY{negative_val_array}, 
-                            ARRAY{nodata_val_array}
-                        ),
-                        'Max'
-                    ) AS ras
-                FROM q
-            )
-        """
-
-    out_raster_sql = f"""
-        {selection_query},
-        
-        {features_selection_query},
+def statement_output_kwargs(as_array: bool=False, profile=None) -> dict:
+    """output_format, output_driver and creation_options of the statement for as_array and an output profile"""
+    # GeoTIFF encoded by the server unless the profile encodes here
+    client_encode = profile is not None and profile.encode == 'client'
+    output_kwargs = dict(output_format='wkb' if as_array or client_encode else 'tiff')
+    if profile is not None and not client_encode:
+        from .writers import server_driver_options
+        output_kwargs['output_driver'], output_kwargs['creation_options'] = server_driver_options(profile)
+    return output_kwargs
 
-        {selection_query_rasterize},
 
-        {fishnet_query},
+def analysis_statement(grid, statement_kwargs: dict, as_array: bool=False, profile=None) -> str:
+    """rasterization statement of statement_kwargs returning (raster, band classes, band counts)"""
+    return build_feature_to_raster_sql(
+        grid=grid,
+        **statement_output_kwargs(as_array, profile),
+        **statement_kwargs
+    )
 
-        {fishnet_to_point_query},
 
-        {update_selection_raster_query}
+def prepared_statement(grid, statement_kwargs: dict, query_x, query_y, height, classes=None, class_column='fclass', as_array=False, profile=None):
     """
+    (sql, params, types) of analysis_statement with the query point, grid and classes as $n parameters.
 
-    feature_to_raster_sql = f"""
-        WITH {out_raster_sql},
-
-        out_raster AS (
-            SELECT
-                ST_Transform(
-                    r.ras,
-                    {out_srid}
-                ) AS ras
-            FROM
-                raster_w_values r
-        )
-
-        SELECT 
-            ST_AsTIFF(
-                out_raster.ras,
-                'LZW'
-            )
-        FROM out_raster
+    The text only depends on the statement shape (table, columns, engine, mode, bands, output), requests of the same
+    shape share one prepared statement, see prepared.query_prepared.
     """
+    parameter_grid = Grid(grid.srid, '$4', '$5', '$6', '$7', '$8', '$9', '$10')
+    statement_kwargs = dict(
+        statement_kwargs,
+        query_x='$1',
+        query_y='$2',
+        height='$3',
+        class_query=get_class_query(classes, class_column, placeholder='$11')
+    )
+    params = [query_x, query_y, height, grid.x_left, grid.y_lower, grid.x_right, grid.y_upper, grid.cell_size, grid.n_rows, grid.n_cols]
+    if classes is not None:
+        # Array of the class column's type, inferred by the server
+        params.append(list(classes))
+    types = ['float8']*8 + ['integer']*2
+    return analysis_statement(parameter_grid, statement_kwargs, as_array=as_array, profile=profile), params, types
+
+
+def finish_analysis(raster, band_classes, band_counts, output_raster, as_array=False, classes_to_bands=False, statistics=None, profile=None):
+    """RasterArray, or True once output_raster is written, of the row returned by analysis_statement"""
+    metrics = current_metrics()
+    metrics.count('payload_bytes', len(raster) if raster is not None else 0)
+    metrics.count('bands', len(band_classes) if band_classes else 1)
+    if classes_to_bands:
+        metrics.count('features', sum(band_counts or []))
+    elif statistics:
+        metrics.count('features', band_counts[0])
 
-    #print(feature_to_raster_sql.replace('\n', ''))
+    # Band mapping comes with the raster, no separate class query
+    band_mapping = list(zip(band_classes or [], band_counts or [])) if classes_to_bands or statistics else None
 
-    raster = query_db(feature_to_raster_sql, connection=connection)[0][0]
+    if as_array:
+        # Raw band bytes straight into numpy, no GeoTIFF round trip
+        from .raster_wkb import raster_array
+        with metrics.stage('decode'):
+            result = raster_array(raster, band_mapping)
+        metrics.count('output_bytes', result.array.nbytes)
+        return result
 
     # Write Raster
-        
-    with open(output_raster, 'wb') as f:
-        f.write(bytes(raster))
+    with metrics.stage('write'):
+        if band_mapping is not None:
+            write_band_mapping(output_raster, band_mapping)
+        if profile is not None and profile.encode == 'client':
+            from .raster_wkb import raster_array
+            from .writers import write_raster
+            write_raster(output_raster, raster_array(raster), profile)
+        else:
+            with open(output_raster, 'wb') as f:
+                f.write(raster)
+    metrics.count('output_bytes', os.path.getsize(output_raster))
 
     return True
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from . import config
+from .pool import borrow_connection, get_dsn
+
+
+## Table Metadata Cache start ##
+
+TableMetadata = namedtuple(
+    'TableMetadata',
+    ['srid', 'geometry_type', 'extent', 'row_estimate', 'stamp', 'classes']
+)
+TableMetadata.__doc__ = """
+    srid: srid of the geometry column.
+    geometry_type: geometry type registered in geometry_columns e.g. MULTILINESTRING.
+    extent: estimated (xmin, ymin, xmax, ymax) from the planner statistics, None without statistics.
+    row_estimate: estimated number of rows from pg_class.
+    stamp: modification stamp of the table (oid, relfilenode, inserted + updated + deleted rows).
+    classes: {class_column: [distinct values]} for the class columns loaded so far.
+"""
+
+_metadata_sql = """
+    SELECT
+        FIND_SRID(%(schema)s, %(table)s, %(geom_column)s),
+        (
+            SELECT type FROM geometry_columns
+            WHERE f_table_schema = %(schema)s AND f_table_name = %(table)s AND f_geometry_column = %(geom_column)s
+        ),
+        ST_XMin(e.ext), ST_YMin(e.ext), ST_XMax(e.ext), ST_YMax(e.ext),
+        c.reltuples::bigint,
+        c.oid::bigint,
+        c.relfilenode::bigint,
+        COALESCE(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0)
+    FROM
+        pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid,
+        LATERAL (SELECT ST_EstimatedExtent(%(schema)s, %(table)s, %(geom_column)s) AS ext) e
+    WHERE
+        n.nspname = %(schema)s
+        AND c.relname = %(table)s
+"""
+
+_stamp_sql = """
+    SELECT
+        c.oid::bigint,
+        c.relfilenode::bigint,
+        COALESCE(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0)
+    FROM
+        pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE
+        n.nspname = %(schema)s
+        AND c.relname = %(table)s
+"""
+
+
+class MetadataCache:
+    """
+    TTL / LRU cache of table metadata keyed by (dsn, schema, table, geom_column).
+
+    Entries are served without touching the database for `ttl` seconds,
+    after that the table's modification stamp is compared and the entry is reloaded when it changed.
+    """
+
+    def __init__(self, ttl: float=300, maxsize: int=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, metadata):
+        with self._lock:
+            self._entries[key] = (metadata, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, table: str=None, schema: str=None, dsn: str=None):
+        """drops matching entries, everything when called without arguments"""
+        with self._lock:
+            for key in list(self._entries):
+                _dsn, _schema, _table, _ = key
+                if table is not None and _table != table:
+                    continue
+                if schema is not None and _schema != schema:
+                    continue
+                if dsn is not None and _dsn != dsn:
+                    continue
+                del self._entries[key]
+
+    def clear(self):
+        self.invalidate()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+metadata_cache = MetadataCache(ttl=config.metadata_cache_ttl, maxsize=config.metadata_cache_size)
+
+
+def connection_key(connection=None):
+    if connection is None:
+        return get_dsn()
+    # psycopg2 connection, password is masked in the dsn
+    return getattr(connection, 'dsn', None) or str(id(connection))
+
+
+def _fetch_metadata(connection, schema, table, geom_column):
+    cur = connection.cursor()
+    cur.execute(_metadata_sql, {'schema': schema, 'table': table, 'geom_column': geom_column})
+    row = cur.fetchone()
+    cur.close()
+    return _metadata_from_row(row, schema, table)
+
+
+def _metadata_from_row(row, schema, table):
+    if row is None:
+        raise ValueError(f"table {schema}.{table} does not exist")
+    srid, geometry_type, xmin, ymin, xmax, ymax, row_estimate, oid, relfilenode, n_mod = row
+    extent = None if xmin is None else (xmin, ymin, xmax, ymax)
+    return TableMetadata(
+        srid=srid,
+        geometry_type=geometry_type,
+        extent=extent,
+        row_estimate=max(int(row_estimate), 0),
+        stamp=(oid, relfilenode, n_mod),
+        classes={}
+    )
+
+
+def _fetch_stamp(connection, schema, table):
+    cur = connection.cursor()
+    cur.execute(_stamp_sql, {'schema': schema, 'table': table})
+    row = cur.fetchone()
+    cur.close()
+    return None if row is None else tuple(row)
+
+
+def _fetch_classes(connection, schema, table, class_column):
+    from psycopg2 import sql
+    cur = connection.cursor()
+    cur.execute(sql.SQL("""
+        SELECT DISTINCT {} FROM {}.{} ORDER BY 1
+    """).format(sql.Identifier(class_column), sql.Identifier(schema), sql.Identifier(table)))
+    classes = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return classes
+
+
+def get_table_metadata(
+    table: str,
+    geom_column: str='wkb_geometry',
+    schema: str='public',
+    class_column: str=None,
+    connection: 'psycopg2 connection'=None,
+    cache: MetadataCache=None
+    ) -> TableMetadata:
+    """
+    returns TableMetadata of a table, served from the cache when possible.
+
+    class_column: also load the distinct values of this column (a full scan of the table, cached as well).
+    """
+    cache = metadata_cache if cache is None else cache
+    key = (connection_key(connection), schema, table, geom_column)
+
+    entry = cache.get(key)
+    if entry is not None:
+        metadata, loaded = entry
+        fresh = time.monotonic() - loaded < cache.ttl
+        if fresh and (class_column is None or class_column in metadata.classes):
+            return metadata
+
+    with borrow_connection(connection) as con:
+        if entry is not None and not fresh:
+            # Expired, keep what was loaded if the table did not change
+            if _fetch_stamp(con, schema, table) != metadata.stamp:
+                entry = None
+            else:
+                cache.put(key, metadata)
+        if entry is None:
+            metadata = _fetch_metadata(con, schema, table, geom_column)
+        if class_column is not None and class_column not in metadata.classes:
+            classes = dict(metadata.classes)
+            classes[class_column] = _fetch_classes(con, schema, table, class_column)
+            metadata = metadata._replace(classes=classes)
+    cache.put(key, metadata)
+    return metadata
+
+
+def invalidate_table_metadata(table: str=None, schema: str=None):
+    """drops cached metadata of a table, of all tables when called without arguments"""
+    metadata_cache.invalidate(table=table, schema=schema)
+
+## Table Metadata Cache end ##
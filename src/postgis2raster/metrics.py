@@ -0,0 +1,254 @@
+import contextvars
+import functools
+import inspect
+import logging
+import time
+from collections import OrderedDict
+
+from . import config
+
+
+## Metrics Functions start ##
+
+# Per call timings and counts of the analysis functions, handed to hooks when the call ends
+#
+#   add_metrics_hook(print)
+#   analysis_circle(...)  ->  hook(AnalysisMetrics(name='analysis_polygon', stages={'connection': .., 'srid': .., ...}, counts={...}))
+#
+# Without hooks nothing is recorded, the stage markers are a shared no-op object.
+
+logger = logging.getLogger(__name__)
+
+_hooks = []
+_current = contextvars.ContextVar('postgis2raster_metrics', default=None)
+
+
+class AnalysisMetrics:
+    """
+    timings and counts of one call.
+
+    stages: {stage: seconds} in the order the stages ran, a stage run more than once is summed.
+        'fetch' is the part of 'rasterize' spent waiting for rows.
+    counts: e.g. payload_bytes, output_bytes, pixels, bands, features.
+    labels: e.g. table and engine.
+    total: seconds of the whole call.
+    error: repr of the exception the call raised, None when it succeeded.
+    """
+
+    enabled = True
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+        self.stages = OrderedDict()
+        self.counts = {}
+        self.total = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    def stage(self, name: str):
+        return _Stage(self, name)
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def count(self, name: str, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def label(self, **labels):
+        self.labels.update(labels)
+
+    def finish(self, error: BaseException=None):
+        self.total = time.perf_counter() - self._start
+        self.error = None if error is None else repr(error)
+        for hook in list(_hooks):
+            try:
+                hook(self)
+            except Exception:
+                logger.exception("metrics hook %r failed", hook)
+
+    def as_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'labels': dict(self.labels),
+            'stages': dict(self.stages),
+            'counts': dict(self.counts),
+            'total': self.total,
+            'error': self.error,
+        }
+
+    def __repr__(self):
+        return f"AnalysisMetrics({self.as_dict()})"
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.name, time.perf_counter() - self.start)
+
+
+class _NullMetrics:
+    # Stands in for AnalysisMetrics when no hook is registered
+
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def stage(self, name):
+        return self
+
+    def add(self, stage, seconds):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def label(self, **labels):
+        pass
+
+
+_null_metrics = _NullMetrics()
+
+
+def current_metrics():
+    """metrics of the running analysis call, a no-op recorder when metrics are off"""
+    return _current.get() or _null_metrics
+
+
+def instrumented(name: str):
+    """records metrics of every call of the decorated function while hooks are registered, nested calls share the record"""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            # Context variables are per task, concurrent coroutines get their own record
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not _hooks or _current.get() is not None:
+                    return await function(*args, **kwargs)
+                metrics = AnalysisMetrics(name)
+                token = _current.set(metrics)
+                try:
+                    result = await function(*args, **kwargs)
+                except BaseException as e:
+                    metrics.finish(error=e)
+                    raise
+                finally:
+                    _current.reset(token)
+                metrics.finish()
+                return result
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _hooks or _current.get() is not None:
+                return function(*args, **kwargs)
+            metrics = AnalysisMetrics(name)
+            token = _current.set(metrics)
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                # KeyboardInterrupt and SystemExit end the call too, recorded like in async_wrapper
+                metrics.finish(error=e)
+                raise
+            finally:
+                _current.reset(token)
+            metrics.finish()
+            return result
+        return wrapper
+    return decorator
+
+
+def timed_batches(batches, stage: str='fetch', count_features: bool=False):
+    """
+    passes batches of rows through, the time spent waiting for them is added to stage.
+
+    count_features: count the feature rows (kind 1, see rasterize.rasterize_stream) as 'features'.
+    """
+    metrics = current_metrics()
+    if not metrics.enabled:
+        yield from batches
+        return
+    batches = iter(batches)
+    while True:
+        start = time.perf_counter()
+        try:
+            rows = next(batches)
+        except StopIteration:
+            metrics.add(stage, time.perf_counter() - start)
+            return
+        metrics.add(stage, time.perf_counter() - start)
+        metrics.count('rows', len(rows))
+        if count_features:
+            metrics.count('features', sum(1 for row in rows if row[0] == 1 and row[2] is not None))
+        yield rows
+
+
+def add_metrics_hook(hook):
+    """
+    calls hook(AnalysisMetrics) at the end of every analysis call.
+
+    hook: any callable, e.g. logging_hook(), statsd_hook(client) or a function feeding Prometheus histograms.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_metrics_hook(hook=None):
+    """removes a hook, every hook when called without arguments"""
+    if hook is None:
+        _hooks.clear()
+    elif hook in _hooks:
+        _hooks.remove(hook)
+
+
+def logging_hook(log: logging.Logger=None, level: int=logging.INFO):
+    """hook writing one line per call to log, default the postgis2raster.metrics logger"""
+    log = log or logger
+
+    def hook(metrics: AnalysisMetrics):
+        stages = " ".join(f"{stage}={seconds*1000:.1f}ms" for stage, seconds in metrics.stages.items())
+        counts = " ".join(f"{name}={value}" for name, value in metrics.counts.items())
+        labels = " ".join(f"{name}={value}" for name, value in metrics.labels.items())
+        log.log(
+            level,
+            "%s total=%.1fms %s %s %s%s",
+            metrics.name, metrics.total*1000, stages, counts, labels,
+            f" error={metrics.error}" if metrics.error else ""
+        )
+    return hook
+
+
+def statsd_hook(client, prefix: str=None):
+    """
+    hook for StatsD style clients with timing(name, ms), gauge(name, value) and incr(name).
+
+    prefix: metric name prefix, default config.metrics_prefix.
+    """
+    prefix = prefix or config.metrics_prefix
+
+    def hook(metrics: AnalysisMetrics):
+        base = f"{prefix}.{metrics.name}"
+        client.incr(f"{base}.calls")
+        if metrics.error:
+            client.incr(f"{base}.errors")
+        client.timing(f"{base}.total", metrics.total*1000)
+        for stage, seconds in metrics.stages.items():
+            client.timing(f"{base}.stage.{stage}", seconds*1000)
+        for name, value in metrics.counts.items():
+            client.gauge(f"{base}.{name}", value)
+    return hook
+
+## Metrics Functions end ##
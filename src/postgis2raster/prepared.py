@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.errors
+
+from .pool import borrow_connection
+from . import config
+
+
+## Prepared Statements start ##
+
+# Server side prepared statements of the rasterization statements
+#
+# A statement shape (table, columns, engine, mode, bands, output) is sent once per pooled connection with PREPARE,
+# afterwards only EXECUTE name (values) is sent and the server skips parsing and analysis, and planning too
+# once it settles on a generic plan (plan_cache_mode, config.session_settings). Statements are named by a hash
+# of their text and kept per connection in a LRU of config.prepared_statements_per_connection, evicted ones
+# are deallocated on the server.
+
+_prepared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def statement_name(sql: str) -> str:
+    # Same text, same name on every connection
+    return 'p2r_' + hashlib.sha1(sql.encode()).hexdigest()[:24]
+
+
+def _statements(connection) -> OrderedDict:
+    # Names prepared on this connection, a new backend (reconnect) starts empty
+    with _lock:
+        pid, statements = _prepared.get(connection, (None, None))
+        if statements is None or pid != connection.get_backend_pid():
+            statements = OrderedDict()
+            _prepared[connection] = (connection.get_backend_pid(), statements)
+        return statements
+
+
+def _prepare(cur, statements, name, sql, types):
+    types_sql = f" ({', '.join(types)})" if types else ""
+    cur.execute(f"PREPARE {name}{types_sql} AS {sql}")
+    statements[name] = None
+    while len(statements) > config.prepared_statements_per_connection:
+        evicted, _ = statements.popitem(last=False)
+        cur.execute(f"DEALLOCATE {evicted}")
+
+
+def query_prepared(sql: str, params: list, types: list=None, connection: 'psycopg2 connection'=None):
+    """
+    rows of sql with $1, $2, ... parameters, prepared once per connection and executed with params.
+
+    types: postgres types of the leading parameters e.g. ['float8', 'integer'], the server infers the rest.
+    """
+    name = statement_name(sql)
+    execute_sql = f"EXECUTE {name} ({', '.join(['%s']*len(params))})" if params else f"EXECUTE {name}"
+    with borrow_connection(connection) as con:
+        statements = _statements(con)
+        cur = con.cursor()
+        try:
+            if name in statements:
+                statements.move_to_end(name)
+            else:
+                _prepare(cur, statements, name, sql, types)
+            try:
+                cur.execute(execute_sql, params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # Deallocated behind our back (DISCARD ALL, a pooler), prepared again on autocommit connections
+                statements.pop(name, None)
+                if not con.autocommit:
+                    raise
+                _prepare(cur, statements, name, sql, types)
+                cur.execute(execute_sql, params)
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+
+def deallocate_prepared(connection: 'psycopg2 connection'):
+    """drops the prepared statements of connection on the server"""
+    with _lock:
+        _prepared.pop(connection, None)
+    cur = connection.cursor()
+    cur.execute("DEALLOCATE ALL")
+    cur.close()
+
+## Prepared Statements end ##
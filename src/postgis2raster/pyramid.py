@@ -0,0 +1,477 @@
+import math
+from collections import namedtuple
+
+from .pool import borrow_connection
+from .utils import Grid, query_db, quote_identifier
+from . import config
+
+
+## Pyramid Functions start ##
+
+# Pre-rasterized base grid of a table, one tiled raster per class, served by the 'pyramid' engine
+#
+# {table}_pyramid(level, {class_column}, tile_x, tile_y, features_hash, rast)
+#   level           overview factor, tiles of level n have n times the base cell size (1 is the base grid)
+#   tile_x, tile_y  tile index, tile (x, y) covers x*w .. (x+1)*w, y*w .. (y+1)*w with w = tile_size*cell_size*level
+#   features_hash   md5 of the features of the class intersecting the tile, a refresh rebuilds tiles whose hash changed
+#   rast            8BUI band, 1 where a feature of the class touches the pixel, nodata (0) elsewhere
+#
+# Features without a class get tiles of the NULL class, they are burnt by requests without classes like in the burn engine.
+# Tiles without features are not stored. Pyramids are registered in public.postgis2raster_pyramids.
+
+Pyramid = namedtuple(
+    'Pyramid',
+    ['schema', 'table', 'geom_column', 'class_column', 'pyramid_table', 'srid', 'cell_size', 'tile_size', 'levels']
+)
+Pyramid.__doc__ = """
+    pyramid_table: qualified name of the tile table.
+    srid: srid of the tiles, the srid of the source table.
+    cell_size: base cell size in units of srid.
+    tile_size: tiles are tile_size x tile_size pixels.
+    levels: overview factors, 1 is the base grid.
+"""
+
+_registry = "public.postgis2raster_pyramids"
+
+_create_registry_sql = f"""
+    CREATE TABLE IF NOT EXISTS {_registry} (
+        schema_name text,
+        table_name text,
+        geom_column text,
+        class_column text,
+        pyramid_table text NOT NULL,
+        srid integer NOT NULL,
+        cell_size double precision NOT NULL,
+        tile_size integer NOT NULL,
+        levels integer[] NOT NULL,
+        refreshed_at timestamptz,
+        changes_seen bigint,
+        PRIMARY KEY (schema_name, table_name, geom_column, class_column)
+    );
+"""
+
+
+def _add_changes_seen(cur):
+    # Registries created before change tracking lack changes_seen, the ACCESS EXCLUSIVE ALTER only runs when it is missing
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = 'postgis2raster_pyramids' AND column_name = 'changes_seen'
+    """)
+    if cur.fetchone() is None:
+        cur.execute(f"ALTER TABLE {_registry} ADD COLUMN IF NOT EXISTS changes_seen bigint")
+
+
+def pyramid_table_name(table: str, schema: str='public'):
+    return f"{schema}.{table}_pyramid"
+
+
+def tile_template_sql(pyramid: Pyramid, level, tile_x, tile_y):
+    # Empty tile, all pixels nodata (0)
+    tile_width = pyramid.tile_size*pyramid.cell_size*level
+    return f"""ST_AddBand(
+        ST_MakeEmptyRaster({pyramid.tile_size}, {pyramid.tile_size}, {tile_x}*{tile_width}, ({tile_y} + 1)*{tile_width}, {pyramid.cell_size*level}, {-pyramid.cell_size*level}, 0, 0, {pyramid.srid}),
+        '8BUI'::text, 0, 0
+    )"""
+
+
+def refresh_tile_row_sql(pyramid: Pyramid, level: int, tile_y: int, tile_x_min: int, tile_x_max: int):
+    """
+    statement bringing one row of tiles of a level up to date.
+
+    Tiles whose features hash changed are deleted and rasterized again, tiles of classes gone from the row are deleted.
+    Against an empty pyramid table it builds the row.
+    """
+    tile_width = pyramid.tile_size*pyramid.cell_size*level
+    cell_size = pyramid.cell_size*level
+    template = tile_template_sql(pyramid, level, 'c.tile_x', 'c.tile_y')
+    class_column, geom_column = quote_identifier(pyramid.class_column), quote_identifier(pyramid.geom_column)
+    table = f"{quote_identifier(pyramid.schema)}.{quote_identifier(pyramid.table)}"
+    return f"""
+        WITH tiles AS (
+            SELECT
+                tile_x,
+                {tile_y} AS tile_y,
+                ST_MakeEnvelope(tile_x*{tile_width}, {tile_y}*{tile_width}, (tile_x + 1)*{tile_width}, ({tile_y} + 1)*{tile_width}, {pyramid.srid}) AS env
+            FROM
+                generate_series({tile_x_min}, {tile_x_max}) tile_x
+        ),
+
+        f AS (
+            SELECT
+                tiles.tile_x,
+                tiles.env,
+                t.{class_column}::text AS class,
+                t.{geom_column} AS geom,
+                md5(ST_AsBinary(t.{geom_column})) AS hash
+            FROM
+                tiles
+                JOIN {table} t ON ST_Intersects(t.{geom_column}, tiles.env)
+        ),
+
+        tile_hashes AS (
+            SELECT
+                f.class,
+                f.tile_x,
+                {tile_y} AS tile_y,
+                md5(string_agg(f.hash, '' ORDER BY f.hash)) AS features_hash
+            FROM
+                f
+            GROUP BY
+                f.class,
+                f.tile_x
+        ),
+
+        stale AS (
+            DELETE FROM {pyramid.pyramid_table} p
+            WHERE
+                p.level = {level}
+                AND p.tile_y = {tile_y}
+                AND p.tile_x BETWEEN {tile_x_min} AND {tile_x_max}
+                AND NOT EXISTS (
+                    SELECT 1 FROM tile_hashes c
+                    WHERE c.class IS NOT DISTINCT FROM p.{class_column} AND c.tile_x = p.tile_x AND c.features_hash = p.features_hash
+                )
+        )
+
+        INSERT INTO {pyramid.pyramid_table} (level, {class_column}, tile_x, tile_y, features_hash, rast)
+        SELECT
+            {level},
+            c.class,
+            c.tile_x,
+            c.tile_y,
+            c.features_hash,
+            (
+                SELECT
+                    ST_MapAlgebra(
+                        {template},
+                        1,
+                        ST_Union(
+                            ST_AsRaster(
+                                ST_ClipByBox2D(f.geom, ST_Expand(f.env, {cell_size})),
+                                {template},
+                                '8BUI'::text,
+                                1,
+                                0,
+                                true
+                            ),
+                            'Max'
+                        ),
+                        1,
+                        '[rast2]', '8BUI', 'FIRST', '[rast2]', NULL, NULL
+                    )
+                FROM
+                    f
+                WHERE
+                    f.class IS NOT DISTINCT FROM c.class
+                    AND f.tile_x = c.tile_x
+            )
+        FROM
+            tile_hashes c
+        WHERE
+            NOT EXISTS (
+                SELECT 1 FROM {pyramid.pyramid_table} p
+                WHERE
+                    p.level = {level}
+                    AND p.tile_y = c.tile_y
+                    AND p.tile_x = c.tile_x
+                    AND p.{class_column} IS NOT DISTINCT FROM c.class
+                    AND p.features_hash = c.features_hash
+            )
+    """
+
+
+def get_pyramid(
+    table: str,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    schema: str='public',
+    connection: 'psycopg2 connection'=None
+    ) -> Pyramid:
+    """registered pyramid of a table, None when there is none"""
+    with borrow_connection(connection) as connection:
+        if query_db(f"SELECT to_regclass('{_registry}')", connection=connection)[0][0] is None:
+            return None
+        rows = query_db(
+            f"""
+                SELECT pyramid_table, srid, cell_size, tile_size, levels
+                FROM {_registry}
+                WHERE schema_name = %s AND table_name = %s AND geom_column = %s AND class_column = %s
+            """,
+            connection=connection,
+            params=(schema, table, geom_column, class_column)
+        )
+    if not rows:
+        return None
+    pyramid_table, srid, cell_size, tile_size, levels = rows[0]
+    return Pyramid(schema, table, geom_column, class_column, pyramid_table, srid, cell_size, tile_size, sorted(levels))
+
+
+def _on_multiple(value: float, step: float) -> bool:
+    # value is a whole multiple of step, up to rounding of the grid computation
+    return abs(value - round(value/step)*step) <= 1e-9*max(abs(value), step)
+
+
+def pyramid_level(pyramid: Pyramid, grid: Grid, resample: str=None):
+    """
+    coarsest level whose pixels tile the pixels of grid exactly, None when no level does.
+
+    Level pixels are aligned on multiples of their cell size from 0, request grids on their query point.
+    A level fits when the grid origin is a pixel corner of the level and the grid cell size is the level cell size,
+    or a whole multiple of it when resample is 'Max' (default config.pyramid_resample_algorithm).
+    Any other level would resample touched pixels into neighbouring request pixels (or drop them).
+    """
+    resample = resample or config.pyramid_resample_algorithm
+    if grid.srid != pyramid.srid:
+        return None
+    levels = []
+    for level in pyramid.levels:
+        level_cell_size = pyramid.cell_size*level
+        if not (_on_multiple(grid.x_left, level_cell_size) and _on_multiple(grid.y_upper, level_cell_size)):
+            continue
+        factor = grid.cell_size/level_cell_size
+        if abs(factor - 1) <= 1e-9 or (resample == 'Max' and factor > 1 and _on_multiple(grid.cell_size, level_cell_size)):
+            levels.append(level)
+    return max(levels) if levels else None
+
+
+def build_pyramid(
+    table: str,
+    cell_size: float,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    levels: list=(1,),
+    tile_size: int=None,
+    schema: str='public',
+    connection: 'psycopg2 connection'=None
+    ) -> Pyramid:
+    """
+    rasterizes a whole table once, per class, into a tiled raster table with a GiST index on the tile envelopes.
+
+    An existing pyramid of the table is replaced once the new one is built, requests read the old one until then.
+    Requests with engine='pyramid' are served from it.
+    -------------------------------
+    cell_size: base cell size in units of the table srid.
+    levels: overview factors, e.g. (1, 2, 4, 8) adds overviews with 2, 4 and 8 times the base cell size.
+    tile_size: tiles of tile_size x tile_size pixels, default config.pyramid_tile_size.
+    """
+    from .changes import latest_change
+    from .metadata import get_table_metadata
+
+    levels = sorted(set([1, *levels]))
+    tile_size = tile_size or config.pyramid_tile_size
+    with borrow_connection(connection) as connection:
+        srid = get_table_metadata(table, geom_column=geom_column, schema=schema, connection=connection).srid
+        pyramid = Pyramid(schema, table, geom_column, class_column, pyramid_table_name(table, schema), srid, cell_size, tile_size, levels)
+
+        cur = connection.cursor()
+        cur.execute(_create_registry_sql)
+        _add_changes_seen(cur)
+        cur.close()
+        # Changes from this watermark on are left for the next refresh
+        changes_seen = latest_change(table, schema=schema, connection=connection)
+
+        # Tiles built into a table of their own, requests keep reading the old pyramid meanwhile
+        build = pyramid._replace(pyramid_table=f"{pyramid.pyramid_table}_build")
+        cur = connection.cursor()
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {build.pyramid_table};
+            CREATE TABLE {build.pyramid_table} (
+                rid serial PRIMARY KEY,
+                level integer NOT NULL,
+                {quote_identifier(class_column)} text,
+                tile_x integer NOT NULL,
+                tile_y integer NOT NULL,
+                features_hash text NOT NULL,
+                rast raster NOT NULL
+            );
+            CREATE INDEX ON {build.pyramid_table} USING gist (ST_ConvexHull(rast));
+            CREATE INDEX ON {build.pyramid_table} (level, tile_y, tile_x);
+        """)
+        cur.close()
+        _refresh_tiles(build, connection)
+
+        # Swapped in with its registry row in one transaction
+        cur = connection.cursor()
+        autocommit = connection.autocommit
+        connection.autocommit = False
+        try:
+            cur.execute(f"""
+                DROP TABLE IF EXISTS {pyramid.pyramid_table};
+                ALTER TABLE {build.pyramid_table} RENAME TO {pyramid.pyramid_table.split('.', 1)[1]};
+            """)
+            cur.execute(
+                f"""
+                    INSERT INTO {_registry} (schema_name, table_name, geom_column, class_column, pyramid_table, srid, cell_size, tile_size, levels, refreshed_at, changes_seen)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, now(), %s)
+                    ON CONFLICT (schema_name, table_name, geom_column, class_column) DO UPDATE SET
+                        pyramid_table = EXCLUDED.pyramid_table,
+                        srid = EXCLUDED.srid,
+                        cell_size = EXCLUDED.cell_size,
+                        tile_size = EXCLUDED.tile_size,
+                        levels = EXCLUDED.levels,
+                        refreshed_at = EXCLUDED.refreshed_at,
+                        changes_seen = EXCLUDED.changes_seen
+                """,
+                (schema, table, geom_column, class_column, pyramid.pyramid_table, srid, cell_size, tile_size, levels, changes_seen)
+            )
+            if autocommit:
+                connection.commit()
+        except BaseException:
+            if autocommit and not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            if not connection.closed:
+                connection.autocommit = autocommit
+        cur.execute(f"ANALYZE {pyramid.pyramid_table}")
+        cur.close()
+    return pyramid
+
+
+def refresh_pyramid(
+    table: str,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    schema: str='public',
+    changed_only: bool=False,
+    connection: 'psycopg2 connection'=None
+    ) -> dict:
+    """
+    rebuilds the tiles of a pyramid whose features changed since the last build or refresh.
+
+    Features are hashed per tile and class and compared to the stored hashes,
+    only tiles with a different hash are rasterized again. One statement per row of tiles.
+
+    changed_only: only hash the tiles intersecting the changes recorded since the last refresh (changes.enable_change_tracking),
+        every tile when the table has no change log or was replaced.
+
+    returns {level: number of tiles rebuilt}.
+    """
+    from .changes import latest_change
+
+    with borrow_connection(connection) as connection:
+        pyramid = get_pyramid(table, class_column=class_column, geom_column=geom_column, schema=schema, connection=connection)
+        if pyramid is None:
+            raise ValueError(f"no pyramid for {schema}.{table}, see build_pyramid")
+        cur = connection.cursor()
+        _add_changes_seen(cur)
+        cur.close()
+        # Changes from this watermark on are left for the next refresh
+        changes_seen = latest_change(table, schema=schema, connection=connection)
+        if changed_only:
+            since = query_db(
+                f"SELECT changes_seen FROM {_registry} WHERE schema_name = %s AND table_name = %s AND geom_column = %s AND class_column = %s",
+                connection=connection,
+                params=(schema, table, geom_column, class_column)
+            )[0][0]
+            if since is not None:
+                rebuilt = _refresh_changed_tiles(pyramid, since, changes_seen, connection)
+                if rebuilt is not None:
+                    return rebuilt
+
+        rebuilt = _refresh_tiles(pyramid, connection)
+        _refreshed(pyramid, changes_seen, connection)
+    return rebuilt
+
+
+def _refresh_tiles(pyramid: Pyramid, connection) -> dict:
+    # Every row of tiles within the extent of the table per level, tiles outside it are deleted
+    xmin, ymin, xmax, ymax = query_db(
+        f"""
+            SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+            FROM (SELECT ST_Extent({quote_identifier(pyramid.geom_column)}) AS e FROM {quote_identifier(pyramid.schema)}.{quote_identifier(pyramid.table)}) a
+        """,
+        connection=connection
+    )[0]
+
+    rebuilt = {}
+    cur = connection.cursor()
+    for level in pyramid.levels:
+        rebuilt[level] = 0
+        if xmin is None:
+            # Empty table, every tile is stale
+            cur.execute(f"DELETE FROM {pyramid.pyramid_table} WHERE level = {level}")
+            continue
+        tile_width = pyramid.tile_size*pyramid.cell_size*level
+        tile_x_min, tile_x_max = math.floor(xmin/tile_width), math.floor(xmax/tile_width)
+        tile_y_min, tile_y_max = math.floor(ymin/tile_width), math.floor(ymax/tile_width)
+        # Rows outside the current extent
+        cur.execute(
+            f"DELETE FROM {pyramid.pyramid_table} WHERE level = {level} AND (tile_y NOT BETWEEN {tile_y_min} AND {tile_y_max} OR tile_x NOT BETWEEN {tile_x_min} AND {tile_x_max})"
+        )
+        for tile_y in range(tile_y_min, tile_y_max + 1):
+            cur.execute(refresh_tile_row_sql(pyramid, level, tile_y, tile_x_min, tile_x_max))
+            rebuilt[level] += cur.rowcount
+    cur.close()
+    return rebuilt
+
+
+def _refreshed(pyramid: Pyramid, changes_seen: int, connection):
+    cur = connection.cursor()
+    cur.execute(
+        f"UPDATE {_registry} SET refreshed_at = now(), changes_seen = %s WHERE schema_name = %s AND table_name = %s AND geom_column = %s AND class_column = %s",
+        (changes_seen, pyramid.schema, pyramid.table, pyramid.geom_column, pyramid.class_column)
+    )
+    cur.execute(f"ANALYZE {pyramid.pyramid_table}")
+    cur.close()
+
+
+def _refresh_changed_tiles(pyramid: Pyramid, since: int, changes_seen: int, connection) -> dict:
+    # Tile rows (with the tile_x range) of the changes since..changes_seen per level, None when everything may have changed
+    from .changes import _changes
+
+    window = f"c.schema_name = %s AND c.table_name = %s AND c.txid >= {int(since)} AND c.txid < {int(changes_seen)}"
+    params = (pyramid.schema, pyramid.table)
+    if query_db(f"SELECT EXISTS (SELECT 1 FROM {_changes} c WHERE {window} AND c.bbox IS NULL)", connection=connection, params=params)[0][0]:
+        return None
+
+    rebuilt = {}
+    cur = connection.cursor()
+    for level in pyramid.levels:
+        tile_width = pyramid.tile_size*pyramid.cell_size*level
+        rows = query_db(
+            f"""
+                SELECT tile_y, min(tile_x), max(tile_x)
+                FROM
+                    {_changes} c,
+                    generate_series(floor(ST_YMin(c.bbox)/{tile_width})::integer, floor(ST_YMax(c.bbox)/{tile_width})::integer) tile_y,
+                    generate_series(floor(ST_XMin(c.bbox)/{tile_width})::integer, floor(ST_XMax(c.bbox)/{tile_width})::integer) tile_x
+                WHERE
+                    {window}
+                GROUP BY
+                    tile_y
+                ORDER BY
+                    tile_y
+            """,
+            connection=connection,
+            params=params
+        )
+        rebuilt[level] = 0
+        for tile_y, tile_x_min, tile_x_max in rows:
+            cur.execute(refresh_tile_row_sql(pyramid, level, tile_y, tile_x_min, tile_x_max))
+            rebuilt[level] += cur.rowcount
+    cur.close()
+    _refreshed(pyramid, changes_seen, connection)
+    return rebuilt
+
+
+def drop_pyramid(
+    table: str,
+    class_column: str='fclass',
+    geom_column: str='wkb_geometry',
+    schema: str='public',
+    connection: 'psycopg2 connection'=None
+    ):
+    with borrow_connection(connection) as connection:
+        pyramid = get_pyramid(table, class_column=class_column, geom_column=geom_column, schema=schema, connection=connection)
+        if pyramid is None:
+            return
+        cur = connection.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {pyramid.pyramid_table}")
+        cur.execute(
+            f"DELETE FROM {_registry} WHERE schema_name = %s AND table_name = %s AND geom_column = %s AND class_column = %s",
+            (schema, table, geom_column, class_column)
+        )
+        cur.close()
+
+## Pyramid Functions end ##
@@ -0,0 +1,108 @@
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# In memory rasters, decoded from the PostGIS raster WKB (ST_AsBinary(raster)) without GeoTIFF encode / decode
+#
+# WKB raster layout, little or big endian as given by the first byte
+#   endian uint8, version uint16, n_bands uint16,
+#   scale_x, scale_y, ip_x, ip_y, skew_x, skew_y float64, srid int32, width uint16, height uint16
+#   per band: flags uint8 (0x80 offline, 0x40 has nodata, 0x20 all nodata, 0x0f pixel type), nodata value, pixels
+
+RasterArray = namedtuple('RasterArray', ['array', 'geotransform', 'crs', 'nodata', 'band_mapping'])
+RasterArray.__doc__ = """
+    array: (bands, rows, cols) numpy array, read only when it is a view on the fetched bytes.
+    geotransform: GDAL geotransform (x_left, cell_size_x, skew_x, y_upper, skew_y, -cell_size_y).
+    crs: 'EPSG:{srid}'.
+    nodata: nodata value of the bands.
+    band_mapping: list of (class, number of features) per band with classes_to_bands, (statistic, number of features) with statistics, else None.
+"""
+
+_pixel_types = {
+    0: np.uint8,    # 1BB
+    1: np.uint8,    # 2BUI
+    2: np.uint8,    # 4BUI
+    3: np.int8,     # 8BSI
+    4: np.uint8,    # 8BUI
+    5: np.int16,    # 16BSI
+    6: np.uint16,   # 16BUI
+    7: np.int32,    # 32BSI
+    8: np.uint32,   # 32BUI
+    10: np.float32, # 32BF
+    11: np.float64, # 64BF
+}
+
+_header_format = 'HHddddddiHH'
+
+
+def read_raster_wkb(data):
+    """(bands, rows, cols) array, geotransform, srid and band nodata values of a WKB raster, bands are zero copy views"""
+    buf = memoryview(data)
+    byteorder = '<' if buf[0] == 1 else '>'
+    header = struct.Struct(byteorder + _header_format)
+    version, n_bands, scale_x, scale_y, ip_x, ip_y, skew_x, skew_y, srid, width, height = header.unpack_from(buf, 1)
+    pos = 1 + header.size
+
+    bands = []
+    nodata = []
+    for _ in range(n_bands):
+        flags = buf[pos]
+        pos += 1
+        if flags & 0x80:
+            raise ValueError("out-db raster bands can not be decoded")
+        dtype = np.dtype(_pixel_types[flags & 0x0f]).newbyteorder(byteorder)
+        value = np.frombuffer(buf, dtype=dtype, count=1, offset=pos)[0]
+        nodata.append(value.item() if flags & 0x40 else None)
+        pos += dtype.itemsize
+        bands.append(np.frombuffer(buf, dtype=dtype, count=width*height, offset=pos).reshape(height, width))
+        pos += dtype.itemsize*width*height
+
+    if len(bands) == 1:
+        array = bands[0][None]
+    elif bands:
+        array = np.stack(bands)
+    else:
+        array = np.empty((0, height, width), dtype=np.uint8)
+    geotransform = (ip_x, scale_x, skew_x, ip_y, skew_y, scale_y)
+    return array, geotransform, srid, nodata
+
+
+def raster_array(data, band_mapping=None) -> RasterArray:
+    array, geotransform, srid, nodata = read_raster_wkb(data)
+    return RasterArray(
+        array=array,
+        geotransform=geotransform,
+        crs=f"EPSG:{srid}",
+        nodata=nodata[0] if nodata else None,
+        band_mapping=band_mapping
+    )
+
+
+def to_xarray(raster: RasterArray):
+    """xarray DataArray (band, y, x) of a RasterArray with pixel center coordinates, needs xarray"""
+    try:
+        import xarray as xr
+    except ImportError:
+        raise ImportError("please install xarray to use to_xarray.")
+
+    n_bands, n_rows, n_cols = raster.array.shape
+    x_left, cell_x, _, y_upper, _, cell_y = raster.geotransform
+    if raster.band_mapping is None:
+        bands = np.arange(1, n_bands + 1)
+    else:
+        bands = [row[0] for row in raster.band_mapping]
+    return xr.DataArray(
+        raster.array,
+        dims=('band', 'y', 'x'),
+        coords={
+            'band': bands,
+            'y': y_upper + (np.arange(n_rows) + .5)*cell_y,
+            'x': x_left + (np.arange(n_cols) + .5)*cell_x,
+        },
+        attrs={
+            'crs': raster.crs,
+            'transform': raster.geotransform,
+            'nodata': raster.nodata,
+        }
+    )
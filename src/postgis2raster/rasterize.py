@@ -0,0 +1,288 @@
+from fractions import Fraction
+
+import numpy as np
+
+from .utils import Grid
+from .wkb import GeometryParts, read_wkb
+
+# Vectorized rasterizer of the client side engines
+#
+# Burns on the same grid the SQL path uses, pixel (row, col) covers
+#   x: grid.x_left + col*cell_size .. grid.x_left + (col+1)*cell_size
+#   y: grid.y_upper - (row+1)*cell_size .. grid.y_upper - row*cell_size
+#
+# all touched: a pixel is burnt when its closed square intersects the geometry,
+# the same pixels ST_Intersects(feature, ST_PixelAsPolygons(...)) selects in the fishnet engine.
+# center: a pixel is burnt when its center is inside the polygon, like ST_AsRaster(geom, ref).
+
+# Long segments are cut in pieces spanning at most this many pixels, keeps candidate cells per segment linear
+_SEGMENT_PIECE = 8
+
+# Coordinates on a pixel edge or corner come out of to_pixel a few ulps off the integer,
+# candidate pixels are widened by this many ulps of the largest coordinate of the grid
+_EDGE_ULPS = 8
+
+# Shewchuk's error bound of the floating point orientation determinant, its sign is exact above it
+_ORIENT_BOUND = (3 + 16*np.finfo(float).eps/2)*np.finfo(float).eps/2
+
+
+def grid_shape(grid: Grid):
+    return grid.n_rows, grid.n_cols
+
+
+def to_pixel(grid: Grid, coords):
+    """(n, 2) map coordinates to fractional (col, row) pixel coordinates"""
+    u = (coords[:, 0] - grid.x_left) / grid.cell_size
+    v = (grid.y_upper - coords[:, 1]) / grid.cell_size
+    return u, v
+
+
+def edge_tolerance(grid: Grid) -> float:
+    """pixels within which a coordinate may be on a pixel edge, the rounding error of to_pixel"""
+    magnitude = max(abs(grid.x_left), abs(grid.y_upper), abs(grid.x_left) + grid.n_cols*grid.cell_size, abs(grid.y_upper) + grid.n_rows*grid.cell_size)
+    return _EDGE_ULPS*np.finfo(float).eps*magnitude/grid.cell_size
+
+
+def cell_bounds(grid: Grid, rows, cols):
+    """map coordinates x_min, y_min, x_max, y_max of pixels, computed like the pixel polygons of the fishnet engine"""
+    return (
+        grid.x_left + cols*grid.cell_size, grid.y_upper - (rows + 1)*grid.cell_size,
+        grid.x_left + (cols + 1)*grid.cell_size, grid.y_upper - rows*grid.cell_size,
+    )
+
+
+def _orientation(x0, y0, x1, y1, cx, cy):
+    """sign of the side of (cx, cy) to the line (x0, y0) -> (x1, y1), exact like the GEOS predicates"""
+    left = (x0 - cx)*(y1 - cy)
+    right = (y0 - cy)*(x1 - cx)
+    det = left - right
+    sign = np.sign(det)
+    # Near the line the float determinant may have the wrong sign, those few are recomputed in rationals
+    unsure = np.flatnonzero(np.abs(det) <= _ORIENT_BOUND*(np.abs(left) + np.abs(right)))
+    for i in unsure:
+        a = [Fraction(float(c[i])) for c in (x0, y0, x1, y1, cx, cy)]
+        exact = (a[0] - a[4])*(a[3] - a[5]) - (a[1] - a[5])*(a[2] - a[4])
+        sign[i] = (exact > 0) - (exact < 0)
+    return sign
+
+
+def _touches(grid: Grid, rows, cols, start, end):
+    """whether the segments start -> end intersect the closed squares of pixels (rows, cols), exact on map coordinates"""
+    x0, y0, x1, y1 = start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+    x_min, y_min, x_max, y_max = cell_bounds(grid, rows, cols)
+    sides = np.stack([
+        _orientation(x0, y0, x1, y1, cx, cy)
+        for cx, cy in ((x_min, y_min), (x_max, y_min), (x_min, y_max), (x_max, y_max))
+    ])
+    return (
+        (x_min <= np.maximum(x0, x1)) & (x_max >= np.minimum(x0, x1))
+        & (y_min <= np.maximum(y0, y1)) & (y_max >= np.minimum(y0, y1))
+        & ~((sides > 0).all(axis=0) | (sides < 0).all(axis=0))
+    )
+
+
+def burn_points(mask, grid: Grid, points):
+    if not points:
+        return
+    coords = np.concatenate(points)
+    u, v = to_pixel(grid, coords)
+    n_rows, n_cols = mask.shape
+    # Point on a pixel edge touches both pixels, the candidates around the point are checked on the map coordinates
+    for d_col in (-1, 0, 1):
+        for d_row in (-1, 0, 1):
+            cols, rows = np.floor(u) + d_col, np.floor(v) + d_row
+            keep = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+            cols, rows, x, y = cols[keep], rows[keep], coords[keep, 0], coords[keep, 1]
+            x_min, y_min, x_max, y_max = cell_bounds(grid, rows, cols)
+            inside = (x_min <= x) & (x <= x_max) & (y_min <= y) & (y <= y_max)
+            mask[rows[inside].astype(np.intp), cols[inside].astype(np.intp)] = True
+
+
+def _segments(lines):
+    lines = [line for line in lines if len(line) > 1]
+    if not lines:
+        return np.empty((0, 2)), np.empty((0, 2))
+    return np.concatenate([line[:-1] for line in lines]), np.concatenate([line[1:] for line in lines])
+
+
+def burn_lines(mask, grid: Grid, lines):
+    """all touched burn of linestrings and polygon rings"""
+    start, end = _segments(lines)
+    if not len(start):
+        return
+    u0, v0 = to_pixel(grid, start)
+    u1, v1 = to_pixel(grid, end)
+    n_rows, n_cols = mask.shape
+    tol = edge_tolerance(grid)
+
+    # Cut long segments into pieces, they only bound the candidate cells, the test runs on the whole segment
+    n_pieces = np.maximum(np.ceil(np.maximum(np.abs(u1 - u0), np.abs(v1 - v0)) / _SEGMENT_PIECE), 1).astype(np.intp)
+    seg = np.repeat(np.arange(len(u0)), n_pieces)
+    piece = np.arange(len(seg)) - np.repeat(np.cumsum(n_pieces) - n_pieces, n_pieces)
+    t0, t1 = piece / n_pieces[seg], (piece + 1) / n_pieces[seg]
+    du, dv = u1 - u0, v1 - v0
+    pu0, pv0 = u0[seg] + t0*du[seg], v0[seg] + t0*dv[seg]
+    pu1, pv1 = u0[seg] + t1*du[seg], v0[seg] + t1*dv[seg]
+    pu1[t1 == 1], pv1[t1 == 1] = u1[seg][t1 == 1], v1[seg][t1 == 1]
+
+    # Candidate cells, a coordinate on a pixel edge touches the pixels on both sides
+    c_min = np.clip(np.ceil(np.minimum(pu0, pu1) - tol) - 1, 0, n_cols).astype(np.intp)
+    c_max = np.clip(np.floor(np.maximum(pu0, pu1) + tol), -1, n_cols - 1).astype(np.intp)
+    r_min = np.clip(np.ceil(np.minimum(pv0, pv1) - tol) - 1, 0, n_rows).astype(np.intp)
+    r_max = np.clip(np.floor(np.maximum(pv0, pv1) + tol), -1, n_rows - 1).astype(np.intp)
+    n_c = np.maximum(c_max - c_min + 1, 0)
+    n_r = np.maximum(r_max - r_min + 1, 0)
+    n_cells = n_c * n_r
+    if not n_cells.sum():
+        return
+
+    idx = np.repeat(np.arange(len(pu0)), n_cells)
+    k = np.arange(len(idx)) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    cols = c_min[idx] + k % n_c[idx]
+    rows = r_min[idx] + k // n_c[idx]
+
+    # Separating axis test of the whole segment against the closed cell square: the bounding boxes overlap
+    # and the corners are not all strictly on one side of the segment. In pixel coordinates first,
+    # the cells within the rounding error of to_pixel of touching are decided on the map coordinates.
+    s = seg[idx]
+    a, b = du[s], dv[s]
+    ox, oy = u0[s], v0[s]
+    f00 = a*(rows - oy) - b*(cols - ox)
+    f10 = a*(rows - oy) - b*(cols + 1 - ox)
+    f01 = a*(rows + 1 - oy) - b*(cols - ox)
+    f11 = a*(rows + 1 - oy) - b*(cols + 1 - ox)
+    f_min = np.minimum(np.minimum(f00, f10), np.minimum(f01, f11))
+    f_max = np.maximum(np.maximum(f00, f10), np.maximum(f01, f11))
+    f_tol = 4*tol*(np.abs(a) + np.abs(b) + 2)
+    u_min, u_max = np.minimum(u0, u1)[s], np.maximum(u0, u1)[s]
+    v_min, v_max = np.minimum(v0, v1)[s], np.maximum(v0, v1)[s]
+    hit = (
+        (f_min < -f_tol) & (f_max > f_tol)
+        & (cols < u_max - tol) & (cols + 1 > u_min + tol) & (rows < v_max - tol) & (rows + 1 > v_min + tol)
+    )
+    unsure = ~hit & (f_min <= f_tol) & (f_max >= -f_tol)
+    unsure[unsure] = _touches(grid, rows[unsure], cols[unsure], start[s[unsure]], end[s[unsure]])
+    hit |= unsure
+    mask[rows[hit], cols[hit]] = True
+
+
+def fill_polygons(mask, grid: Grid, rings, ring_polygon):
+    """even odd scanline fill of pixel centers, rings of one polygon share their polygon id"""
+    if not rings:
+        return
+    n_rows, n_cols = mask.shape
+
+    coords = [to_pixel(grid, ring) for ring in rings]
+    u0 = np.concatenate([c[0][:-1] for c in coords])
+    u1 = np.concatenate([c[0][1:] for c in coords])
+    v0 = np.concatenate([c[1][:-1] for c in coords])
+    v1 = np.concatenate([c[1][1:] for c in coords])
+    polygon = np.repeat(np.asarray(ring_polygon), [len(c[0]) - 1 for c in coords])
+
+    # Rows whose center line the edge crosses, half open so that shared vertices count once
+    v_min, v_max = np.minimum(v0, v1), np.maximum(v0, v1)
+    r_first = np.clip(np.ceil(v_min - .5), 0, n_rows).astype(np.intp)
+    r_last = np.clip(np.ceil(v_max - .5), 0, n_rows).astype(np.intp)
+    n_cross = r_last - r_first
+    if not n_cross.sum():
+        return
+
+    edge = np.repeat(np.arange(len(u0)), n_cross)
+    rows = r_first[edge] + np.arange(len(edge)) - np.repeat(np.cumsum(n_cross) - n_cross, n_cross)
+    u = u0[edge] + (rows + .5 - v0[edge]) * (u1[edge] - u0[edge]) / (v1[edge] - v0[edge])
+
+    # Pair crossings per polygon and row from left to right
+    order = np.lexsort((u, rows, polygon[edge]))
+    rows, u = rows[order][0::2], u[order]
+    u_start, u_end = u[0::2], u[1::2]
+
+    # Pixel centers inside [u_start, u_end)
+    c_start = np.clip(np.ceil(u_start - .5), 0, n_cols).astype(np.intp)
+    c_end = np.clip(np.ceil(u_end - .5), 0, n_cols).astype(np.intp)
+    keep = c_end > c_start
+    diff = np.zeros((n_rows, n_cols + 1), dtype=np.int32)
+    np.add.at(diff, (rows[keep], c_start[keep]), 1)
+    np.add.at(diff, (rows[keep], c_end[keep]), -1)
+    mask |= np.cumsum(diff[:, :-1], axis=1) > 0
+
+
+def burn_parts(mask, grid: Grid, parts: GeometryParts, all_touched: bool=True):
+    if all_touched:
+        burn_points(mask, grid, parts.points)
+        burn_lines(mask, grid, parts.lines)
+    fill_polygons(mask, grid, parts.rings, parts.ring_polygon)
+
+
+def rasterize_wkb(grid: Grid, geometries, all_touched: bool=True, mask=None):
+    """
+    boolean (rows, cols) mask of an iterable of WKB geometries.
+
+    all_touched: burn every pixel touched by a geometry, else only pixels with their center inside polygons.
+    """
+    if mask is None:
+        mask = np.zeros(grid_shape(grid), dtype=bool)
+    parts = GeometryParts()
+    for wkb in geometries:
+        read_wkb(wkb, parts)
+    burn_parts(mask, grid, parts, all_touched=all_touched)
+    return mask
+
+
+def rasterize_stream(
+    grid: Grid,
+    batches,
+    positive=1,
+    negative=0,
+    nodata=254,
+    classes_to_bands: bool=False
+    ):
+    """
+    (bands, rows, cols) uint8 array and band mapping from batches of (kind, class, wkb) rows.
+
+    kind 0 rows are the selection geometry, pixels with their center inside get negative values, nodata elsewhere.
+    kind 1 rows are features, touched pixels inside the selection get positive values.
+    Rows can come in any order, memory is bounded by the batch size and the output array.
+    classes_to_bands: one band per class ordered by class like the SQL engines,
+        band mapping is a list of (class, number of features) per band, None for a single band.
+    """
+    selection = np.zeros(grid_shape(grid), dtype=bool)
+    touched = {}
+    num_features = {}
+
+    for rows in batches:
+        selection_parts = GeometryParts()
+        class_parts = {}
+        for kind, class_value, wkb in rows:
+            if wkb is None:
+                continue
+            if kind == 0:
+                read_wkb(wkb, selection_parts)
+                continue
+            if not classes_to_bands:
+                class_value = None
+            elif class_value is None:
+                continue
+            num_features[class_value] = num_features.get(class_value, 0) + 1
+            if class_value not in class_parts:
+                class_parts[class_value] = GeometryParts()
+            read_wkb(wkb, class_parts[class_value])
+
+        burn_parts(selection, grid, selection_parts, all_touched=False)
+        for class_value, parts in class_parts.items():
+            if class_value not in touched:
+                touched[class_value] = np.zeros(grid_shape(grid), dtype=bool)
+            burn_parts(touched[class_value], grid, parts, all_touched=True)
+
+    if classes_to_bands:
+        band_classes = sorted(touched)
+        band_mapping = [(c, num_features[c]) for c in band_classes]
+    else:
+        band_classes = [None]
+        band_mapping = None
+
+    out = np.full((max(len(band_classes), 1), *grid_shape(grid)), nodata, dtype=np.uint8)
+    out[:, selection] = negative
+    for i, class_value in enumerate(band_classes):
+        if class_value in touched:
+            out[i][selection & touched[class_value]] = positive[i] if type(positive) == list else positive
+    return out, band_mapping
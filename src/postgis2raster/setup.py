@@ -13,13 +13,24 @@ setuptools.setup(
   author = 'SANDEEP KUMAR',
   author_email = 'sandeepgadhwal1@gmail.com',
   url = 'https://urbantalks.in',
-  packages = setuptools.find_packages(),
+  # setup.py lives in the package directory, find_packages() would find nothing here
+  package_dir = {'postgis2raster': '.'},
+  packages = ['postgis2raster'],
   download_url = 'https://github.com/sandeepgadhwal/postgis2raster/archive/v_01.tar.gz',
   keywords = ['postgis', 'raster', 'fishnet'],
   install_requires=[
           'psycopg2',
           'pyproj',
       ],
+  extras_require={
+          'client': ['numpy', 'gdal'],
+          'xarray': ['numpy', 'xarray'],
+          'files': ['numpy', 'shapely>=2.0', 'gdal', 'pyarrow'],
+          'async': ['psycopg>=3.1', 'psycopg_pool'],
+      },
+  entry_points={
+          'console_scripts': ['postgis2raster=postgis2raster.cli:main'],
+      },
   classifiers=[
     'Development Status :: 3 - Alpha',    
     'Intended Audience :: Science/Research', 
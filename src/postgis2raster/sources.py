@@ -0,0 +1,261 @@
+import abc
+import json
+import os
+import uuid
+
+from .utils import Grid, get_class_query, get_srid, stream_db, project_xy, project_xy_array
+from .metadata import get_table_metadata
+from .pool import borrow_connection
+from .sql import feature_stream_sql
+from . import config
+
+
+## Vector Sources start ##
+
+# Where the features of an analysis come from
+#
+# A source yields batches of (kind, class, wkb) rows for the client side rasterizer (rasterize.rasterize_stream):
+# kind 0 is the selection geometry, kind 1 the features intersecting it clipped to the grid extent plus one cell.
+#
+#   PostGISSource   a PostGIS table, the rows come from a server side cursor (the 'numpy' engine)
+#   MemorySource    geometries held in process behind a packed STRtree, no database
+#   FileSource      a MemorySource loaded once from a GeoPackage, Shapefile (OGR) or GeoParquet (pyarrow) file
+#
+# Sources other than PostGISSource can be given as `table` of analysis_circle / analysis_polygon.
+
+
+class VectorSource(abc.ABC):
+    """features for client side rasterization, srid is the srid of the geometries"""
+
+    srid = None
+
+    @abc.abstractmethod
+    def version(self):
+        """changes whenever the features change, part of the result cache key"""
+
+    @abc.abstractmethod
+    def feature_batches(self, grid: Grid, query_x, query_y, height, classes: list=None, circle: bool=False, batch_size: int=None):
+        """batches of (kind, class, wkb) rows of the selection and the features intersecting it, see rasterize.rasterize_stream"""
+
+
+class PostGISSource(VectorSource):
+    """features of a PostGIS table, selected by the database"""
+
+    def __init__(self, table: str, class_column: str='fclass', geom_column: str='wkb_geometry', connection=None):
+        self.table = table
+        self.class_column = class_column
+        self.geom_column = geom_column
+        self.connection = connection
+
+    @property
+    def srid(self):
+        return get_srid(self.table, geom_column=self.geom_column, connection=self.connection)
+
+    def version(self):
+        return get_table_metadata(self.table, geom_column=self.geom_column, connection=self.connection).stamp
+
+    def stream_sql(self, grid: Grid, query_x, query_y, height, classes: list=None, circle: bool=False):
+        return feature_stream_sql(
+            table=self.table,
+            grid=grid,
+            query_x=query_x,
+            query_y=query_y,
+            height=height,
+            class_query=get_class_query(classes, self.class_column),
+            class_column=self.class_column,
+            geom_column=self.geom_column,
+            circle=circle
+        )
+
+    def feature_batches(self, grid: Grid, query_x, query_y, height, classes: list=None, circle: bool=False, batch_size: int=None):
+        sql = self.stream_sql(grid, query_x, query_y, height, classes=classes, circle=circle)
+        with borrow_connection(self.connection) as con:
+            yield from stream_db(sql, con, batch_size=batch_size or config.stream_batch_size)
+
+    def __repr__(self):
+        return f"PostGISSource({self.table!r}, class_column={self.class_column!r}, geom_column={self.geom_column!r})"
+
+
+def _shapely():
+    try:
+        import shapely
+    except ImportError:
+        raise ImportError("please install shapely>=2.0 to rasterize features without a database.")
+    return shapely
+
+
+class MemorySource(VectorSource):
+    """
+    geometries held in process, selected with a packed STRtree.
+
+    geometries: shapely geometries or WKB.
+    classes: class value of every geometry, compared as text like the class column of a table. None for no classes.
+    srid: srid of the geometries.
+    """
+
+    def __init__(self, geometries, classes=None, srid: int=4326):
+        import numpy as np
+        shapely = _shapely()
+
+        geometries = np.asarray(geometries, dtype=object)
+        if len(geometries) and not isinstance(geometries[0], shapely.Geometry):
+            geometries = shapely.from_wkb(geometries)
+        if classes is None:
+            classes = [None]*len(geometries)
+        if len(classes) != len(geometries):
+            raise ValueError(f"got {len(classes)} classes for {len(geometries)} geometries")
+
+        self.srid = int(srid)
+        self.geometries = geometries
+        self.classes = np.array([None if c is None else str(c) for c in classes], dtype=object)
+        # Packed once, queries only read the tree
+        self.tree = shapely.STRtree(geometries)
+        # Geometries are not hashed, every instance is a new version
+        self._version = uuid.uuid4().hex
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def version(self):
+        return self._version
+
+    def selection_geometry(self, grid: Grid, query_x, query_y, height, circle: bool=False):
+        """selection geometry of selection_geom_sql in the source srid"""
+        shapely = _shapely()
+        if not circle:
+            return shapely.box(grid.x_left, grid.y_lower, grid.x_right, grid.y_upper)
+        # Buffer in web mercator with the ST_Buffer default of 8 segments per quarter circle
+        x, y = project_xy(query_x, query_y, 4326, 3857)
+        circle_3857 = shapely.Point(x, y).buffer(height/2, quad_segs=8)
+        return shapely.transform(
+            circle_3857,
+            lambda coords: _stack(*project_xy_array(coords[:, 0], coords[:, 1], 3857, self.srid))
+        )
+
+    def select(self, selection, classes: list=None):
+        """indices of the geometries intersecting selection, of classes when given"""
+        import numpy as np
+        index = self.tree.query(selection, predicate='intersects')
+        if classes is not None:
+            index = index[np.isin(self.classes[index], [str(c) for c in classes])]
+        return np.sort(index)
+
+    def feature_batches(self, grid: Grid, query_x, query_y, height, classes: list=None, circle: bool=False, batch_size: int=None):
+        shapely = _shapely()
+        batch_size = batch_size or config.stream_batch_size
+
+        selection = self.selection_geometry(grid, query_x, query_y, height, circle=circle)
+        yield [(0, None, shapely.to_wkb(selection))]
+
+        # Clipped to the grid extent plus one cell like ST_ClipByBox2D of feature_stream_sql
+        box = (
+            grid.x_left - grid.cell_size,
+            grid.y_upper - grid.n_rows*grid.cell_size - grid.cell_size,
+            grid.x_left + grid.n_cols*grid.cell_size + grid.cell_size,
+            grid.y_upper + grid.cell_size
+        )
+        index = self.select(selection, classes=classes)
+        for start in range(0, len(index), batch_size):
+            part = index[start:start + batch_size]
+            wkbs = shapely.to_wkb(shapely.clip_by_rect(self.geometries[part], *box))
+            yield [(1, c, w) for c, w in zip(self.classes[part], wkbs)]
+
+    def __repr__(self):
+        return f"MemorySource(n={len(self)}, srid={self.srid}, version={self._version!r})"
+
+
+def _stack(x, y):
+    import numpy as np
+    return np.column_stack([x, y])
+
+
+def _read_ogr(path: str, layer=None, class_column: str=None):
+    # GeoPackage, Shapefile and every other OGR vector format
+    try:
+        from osgeo import ogr
+    except ImportError:
+        raise ImportError("please install gdal to read vector files.")
+    ogr.UseExceptions()
+    ds = ogr.Open(path)
+    lyr = ds.GetLayer() if layer is None else ds.GetLayer(layer)
+    if lyr is None:
+        raise ValueError(f"{path} has no layer {layer!r}")
+
+    srs = lyr.GetSpatialRef()
+    srid = None
+    if srs is not None:
+        try:
+            srs.AutoIdentifyEPSG()
+        except RuntimeError:
+            # Not an EPSG crs, srid has to be given
+            pass
+        srid = srs.GetAuthorityCode(None)
+    if class_column is not None and lyr.GetLayerDefn().GetFieldIndex(class_column) < 0:
+        raise ValueError(f"{path} has no column {class_column!r}")
+
+    wkbs, classes = [], []
+    for feature in lyr:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        wkbs.append(bytes(geom.ExportToIsoWkb()))
+        classes.append(feature.GetField(class_column) if class_column is not None else None)
+    ds = None
+    return wkbs, classes, srid
+
+
+def _read_geoparquet(path: str, class_column: str=None):
+    # WKB encoded GeoParquet, crs from the 'geo' metadata (OGC:CRS84 when missing)
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("please install pyarrow to read GeoParquet files.")
+    schema = pq.read_schema(path)
+    geo = json.loads((schema.metadata or {}).get(b'geo', b'{}'))
+    geom_column = geo.get('primary_column', 'geometry')
+    meta = geo.get('columns', {}).get(geom_column, {})
+    if meta.get('encoding', 'WKB').upper() != 'WKB':
+        raise ValueError(f"{path}: only WKB encoded GeoParquet is supported, got {meta['encoding']!r}")
+
+    srid = 4326
+    if meta.get('crs') is not None:
+        import pyproj
+        srid = pyproj.CRS.from_json_dict(meta['crs']).to_epsg()
+
+    columns = [geom_column] + ([class_column] if class_column is not None else [])
+    table = pq.read_table(path, columns=columns)
+    wkbs = table.column(geom_column).to_pylist()
+    classes = table.column(class_column).to_pylist() if class_column is not None else [None]*len(wkbs)
+    keep = [i for i, w in enumerate(wkbs) if w is not None]
+    return [wkbs[i] for i in keep], [classes[i] for i in keep], srid
+
+
+class FileSource(MemorySource):
+    """
+    features of a GeoPackage, Shapefile or GeoParquet file, read once and selected in process.
+
+    layer: layer name or index of multi layer files (GeoPackage), the first layer by default.
+    class_column: column of the class values, None for files without classes.
+    srid: srid of the geometries, read from the file by default.
+    """
+
+    def __init__(self, path: str, layer=None, class_column: str='fclass', srid: int=None):
+        self.path = os.path.abspath(path)
+        self.layer = layer
+        self.class_column = class_column
+        stat = os.stat(self.path)
+        if self.path.lower().endswith(('.parquet', '.geoparquet')):
+            wkbs, classes, file_srid = _read_geoparquet(self.path, class_column=class_column)
+        else:
+            wkbs, classes, file_srid = _read_ogr(self.path, layer=layer, class_column=class_column)
+        srid = srid or file_srid
+        if srid is None:
+            raise ValueError(f"srid of {path} is unknown, please give srid")
+        super().__init__(wkbs, classes, srid=srid)
+        # Modified files give new cache keys
+        self._version = (self.path, layer, class_column, stat.st_mtime_ns, stat.st_size)
+
+    def __repr__(self):
+        return f"FileSource({self.path!r}, layer={self.layer!r}, class_column={self.class_column!r}, srid={self.srid})"
+
+## Vector Sources end ##
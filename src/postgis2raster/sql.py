@@ -0,0 +1,1005 @@
+from .utils import Grid, quote_identifier
+from . import config
+
+# SQL builders shared by the analysis functions
+#
+# Every builder returns a piece of the rasterization statement, the pieces are put together by feature_to_raster_sql
+# Values are formatted into the SQL as they are, so a value can also be a column reference e.g. Grid(x_left='aoi.x_left', ...)
+#
+#   q               selection geometry (circle or rectangle) in table srid
+#   features        features of the source table intersecting q
+#   q_ras           selection rasterized on the template grid with negative values
+#   raster_w_values q_ras with positive values where features are, built by an engine
+#   out_raster      raster_w_values transformed to the output srid
+
+ENGINES = ('fishnet', 'burn', 'numpy', 'pyramid')
+
+
+def selection_geom_sql(grid: Grid, query_x, query_y, height, circle=False):
+    # Based on input selection type create selection query
+    if circle:
+        return f"""
+            WITH a AS (
+                SELECT
+                    ST_SetSRID(ST_Point({query_x}, {query_y}), 4326) AS geom
+            ),
+
+            b AS (
+                SELECT
+                    ST_Buffer(ST_Transform(a.geom, 3857), {height}/2.0) AS geom
+                FROM a
+            )
+
+            SELECT
+                ST_Transform(geom, {grid.srid}) as geom
+            FROM b
+
+        """
+    # POlygon
+    return f"""
+            SELECT ST_MakeEnvelope({grid.x_left}, {grid.y_lower}, {grid.x_right}, {grid.y_upper}, {grid.srid})
+        """
+
+
+def clip_selection_geom_sql(selection_geom_query, window: Grid):
+    # Selection geometry restricted to the extent of a window of the grid
+    return f"""
+            SELECT ST_Intersection(
+                ST_MakeEnvelope({window.x_left}, {window.y_lower}, {window.x_right}, {window.y_upper}, {window.srid}),
+                ({selection_geom_query})
+            )
+        """
+
+
+def raster_template_sql(grid: Grid, nodata):
+    # Rasterization template query
+    return f"""
+        SELECT ST_SetBandNoDataValue(ST_MakeEmptyRaster({grid.n_cols}, {grid.n_rows}, {grid.x_left}, {grid.y_upper}, {grid.cell_size}, {grid.cell_size}, {0}, {0}, {grid.srid}), {nodata})
+    """
+
+
+def selection_sql(selection_geom_query):
+    # Selection Query and empty raster for fishnet
+    return f"""
+        q AS (
+            {selection_geom_query} AS geom
+        )
+    """
+
+
+def prepared_geom_sql(geom, grid: Grid, clip=False, simplify=None):
+    """
+    feature geometry clipped to the grid extent plus one cell and simplified, before any pixel test.
+
+    Clipping keeps the geometry inside the extent as it is, pixels are unchanged.
+    simplify: tolerance as a fraction of the cell size, edges move by less than simplify*cell_size,
+        only pixels an edge passes closer than that can change.
+    """
+    if clip:
+        # Values can be SQL expressions, the arithmetic is left to the database
+        geom = f"""ST_ClipByBox2D(
+                    {geom},
+                    ST_Expand(
+                        ST_MakeEnvelope({grid.x_left}, ({grid.y_upper}) - ({grid.n_rows})*({grid.cell_size}), ({grid.x_left}) + ({grid.n_cols})*({grid.cell_size}), {grid.y_upper}, {grid.srid}),
+                        {grid.cell_size}
+                    )
+                )"""
+    if simplify:
+        geom = f"ST_SimplifyPreserveTopology({geom}, {simplify}*({grid.cell_size}))"
+    return geom
+
+
+def features_sql(table, geom_column, class_column, class_query, grid: Grid=None, clip=False, subdivide=None, simplify=None, attributes: list=None):
+    """
+    features of the source table intersecting q, part is 1 for the first (or only) part of a feature.
+
+    grid, clip, simplify: features are prepared with prepared_geom_sql on grid.
+    subdivide: features are split by ST_Subdivide into parts of at most subdivide vertices,
+        every pixel test then only walks the vertices of a part whose box is near the pixel,
+        fid (ctid) tells the parts of a feature apart.
+    attributes: columns of the table selected as attr_0, attr_1, ...
+    """
+    table, geom_column, class_column = quote_identifier(table), quote_identifier(geom_column), quote_identifier(class_column)
+    geom = f"t.{geom_column}"
+    if grid is not None:
+        geom = prepared_geom_sql(geom, grid, clip=clip, simplify=simplify)
+    attribute_columns = "".join(f",\n                t.{quote_identifier(column)} AS attr_{i}" for i, column in enumerate(attributes or []))
+
+    if not subdivide:
+        return f"""
+        features AS (
+            SELECT
+                {geom} AS geom,
+                t.{class_column} as class,
+                1 AS part{attribute_columns}
+            FROM
+                public.{table} t,
+                q
+            WHERE
+                ST_Intersects(q.geom, t.{geom_column})
+                AND
+                {class_query}
+        )
+    """
+
+    # Selection on the original geometry, parts of features without parts (e.g. empty after clipping) are NULL
+    return f"""
+        features AS (
+            SELECT
+                p.geom,
+                t.class,
+                COALESCE(p.part, 1) AS part,
+                t.fid{"".join(f", t.attr_{i}" for i in range(len(attributes or [])))}
+            FROM
+                (
+                    SELECT
+                        {geom} AS geom,
+                        t.{class_column} as class,
+                        t.ctid AS fid{attribute_columns}
+                    FROM
+                        public.{table} t,
+                        q
+                    WHERE
+                        ST_Intersects(q.geom, t.{geom_column})
+                        AND
+                        {class_query}
+                ) t
+                LEFT JOIN LATERAL ST_Subdivide(t.geom, {subdivide}) WITH ORDINALITY AS p(geom, part) ON true
+        )
+    """
+
+
+def selection_rasterize_sql(template_sql, negative, nodata, name='q_ras'):
+    # Rasterize Selection query
+    return f"""
+        {name} AS (
+            SELECT
+                ST_Union(
+                    ST_AsRaster(
+                        q.geom,
+                        ({template_sql}),
+                        '8BUI'::text,
+                        {negative},
+                        {nodata}
+                    ),
+                    'Max'
+                ) AS ras
+            FROM q
+        )
+    """
+
+
+def band_positive_sql(positive, idx='b.idx'):
+    # positive value of a band, a list has one value per band
+    if type(positive) == list:
+        return f"(ARRAY{positive})[{idx}]"
+    return f"{positive}"
+
+
+def literal(value):
+    # SQL literal of a class value
+    if value is None:
+        return "NULL"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def bands_sql(band_classes: list=None):
+    """
+    band mapping, one band per class.
+
+    band_classes: fixed list of class values, by default the classes of the selected features ordered by class.
+    """
+    if band_classes is not None:
+        values = ",\n".join(
+            f"({literal(c)}, NULL::bigint, {i+1})" for i, c in enumerate(band_classes)
+        ) or "(NULL, NULL::bigint, NULL::integer)"
+        return f"""
+        bands AS (
+            SELECT * FROM (VALUES {values}) AS v(class, num_features, idx)
+            WHERE idx IS NOT NULL
+        )
+    """
+    return """
+        bands AS (
+            SELECT
+                f.class::text AS class,
+                COUNT(*) FILTER (WHERE f.part = 1) AS num_features,
+                (ROW_NUMBER() OVER (ORDER BY f.class))::integer AS idx
+            FROM
+                features f
+            WHERE
+                f.class IS NOT NULL
+            GROUP BY
+                f.class
+        )
+    """
+
+
+def class_count_sql(table, grid: Grid, query_x, query_y, height, class_query, class_column='fclass', geom_column='wkb_geometry', circle=False):
+    # Classes in the selection and their number of features ordered by class, the band mapping of classes_to_bands
+    return f"""
+        WITH {selection_sql(selection_geom_sql(grid, query_x, query_y, height, circle=circle))},
+
+        {features_sql(table, geom_column, class_column, class_query)}
+
+        SELECT
+            f.class::text,
+            COUNT(*)
+        FROM
+            features f
+        WHERE
+            f.class IS NOT NULL
+        GROUP BY
+            f.class
+        ORDER BY
+            f.class
+    """
+
+
+def feature_count_sql(table, grid: Grid, query_x, query_y, height, class_query, class_column='fclass', geom_column='wkb_geometry', circle=False):
+    # Number of features in the selection
+    return f"""
+        WITH {selection_sql(selection_geom_sql(grid, query_x, query_y, height, circle=circle))},
+
+        {features_sql(table, geom_column, class_column, class_query)}
+
+        SELECT COUNT(*) FROM features
+    """
+
+
+def multi_band_raster_sql(band_expression, band_from):
+    """
+    raster_w_values with one band per row of bands, built in one ST_AddBand from band 1 of q_ras.
+
+    band_expression: single band raster of band b, ST_Band(q_ras.ras, 1) where no feature is.
+    band_from: joins of bands b to the per band results.
+    """
+    return f"""
+        raster_w_values AS (
+            SELECT
+                COALESCE(
+                    ST_AddBand(
+                        ST_MakeEmptyRaster(q_ras.ras),
+                        (
+                            SELECT
+                                array_agg(
+                                    {band_expression}
+                                    ORDER BY b.idx
+                                )
+                            FROM
+                                {band_from}
+                        )
+                    ),
+                    q_ras.ras
+                ) AS ras
+            FROM
+                q_ras
+        )
+    """
+
+
+def fishnet_sql(positive, classes_to_bands=False, band_classes=None):
+    """
+    pixels of q_ras as polygons, pixels intersecting a feature get positive values through their centroids.
+
+    classes_to_bands: the pixel x feature intersections are computed once and grouped by class, one band per class.
+    band_classes: fixed band classes, see bands_sql.
+    """
+    # Fishnet from raster band 1
+    fishnet_query = f"""
+        q_poly AS (
+            SELECT
+                (pp).geom AS geom,
+                f.class
+            FROM
+                (
+                    SELECT ST_PixelAsPolygons(
+                        q_ras.ras,
+                        1
+                    ) pp
+                    FROM q_ras
+                ) a,
+                features f
+            WHERE
+                ST_Intersects(f.geom, (pp).geom)
+        )
+    """
+
+    if not classes_to_bands:
+        # Fishnet to point query
+        fishnet_to_point_query = f"""
+        q_point AS (
+            SELECT
+                ST_Collect(ST_Centroid(q_poly.geom)) as geom
+            FROM
+                q_poly
+        )
+        """
+
+        # Updated values of rasterized selection query with positive values from fishnet points
+        update_selection_raster_query = f"""raster_w_values AS (
+        SELECT
+            ST_SetValue(
+                q_ras.ras,
+                1,
+                q_point.geom,
+                {positive}
+            ) AS ras
+        FROM
+            q_ras,
+            q_point
+    )
+        """
+        return ",\n".join([fishnet_query, fishnet_to_point_query, update_selection_raster_query])
+
+    # Fishnet to point query, one point collection per band
+    fishnet_to_point_query = f"""
+        q_point AS (
+            SELECT
+                b.idx,
+                ST_Collect(ST_Centroid(q_poly.geom)) AS geom
+            FROM
+                q_poly
+                JOIN bands b ON b.class = q_poly.class::text
+            GROUP BY
+                b.idx
+        )
+    """
+
+    update_selection_raster_query = multi_band_raster_sql(
+        band_expression=f"""
+            CASE
+                WHEN p.geom IS NULL THEN ST_Band(q_ras.ras, 1)
+                ELSE ST_SetValue(ST_Band(q_ras.ras, 1), 1, p.geom, {band_positive_sql(positive)})
+            END
+        """,
+        band_from="bands b LEFT JOIN q_point p ON p.idx = b.idx"
+    )
+    return ",\n".join([bands_sql(band_classes), fishnet_query, fishnet_to_point_query, update_selection_raster_query])
+
+
+def burn_sql(positive, nodata, classes_to_bands=False, band_classes=None):
+    """
+    features burnt straight onto the q_ras grid with all touched semantics, merged into q_ras with map algebra.
+
+    A pixel is positive when GDAL burns it with ALL_TOUCHED. Away from pixel boundaries these are the pixels
+    the fishnet engine selects with ST_Intersects on the pixel polygons, features lying on boundaries differ:
+    a point on a pixel edge or corner burns the one pixel containing it (fishnet: the 2 or 4 pixels sharing it),
+    a line along a pixel edge burns the pixels on one side of it, and pixels a line or polygon only touches
+    at a corner (a vertex on a pixel corner, a segment through it) may not be burnt.
+    Features are clipped to the raster extent plus one cell so that large features do not create large intermediate rasters.
+
+    classes_to_bands: features are burnt grouped by class, one band per class.
+    band_classes: fixed band classes, see bands_sql.
+    """
+    clipped_geom = "ST_ClipByBox2D(f.geom, ST_Expand(ST_Envelope(q_ras.ras), ST_PixelWidth(q_ras.ras)))"
+
+    # Burn value on positive pixels, nodata elsewhere, outside the selection the selection raster decides
+    merge_expression = "ST_MapAlgebra(q_ras.ras, 1, r.ras, 1, '[rast2]', '8BUI', 'FIRST', NULL, '[rast1]', NULL)"
+
+    if not classes_to_bands:
+        return f"""
+        burn AS (
+            SELECT
+                ST_Union(
+                    ST_AsRaster(
+                        {clipped_geom},
+                        q_ras.ras,
+                        '8BUI'::text,
+                        {positive},
+                        {nodata},
+                        true
+                    ),
+                    'Max'
+                ) AS ras
+            FROM
+                features f,
+                q_ras
+        ),
+
+        raster_w_values AS (
+            SELECT
+                CASE
+                    WHEN r.ras IS NULL THEN q_ras.ras
+                    ELSE {merge_expression}
+                END AS ras
+            FROM
+                q_ras,
+                burn r
+        )
+        """
+
+    burn_query = f"""
+        burn AS (
+            SELECT
+                b.idx,
+                ST_Union(
+                    ST_AsRaster(
+                        {clipped_geom},
+                        q_ras.ras,
+                        '8BUI'::text,
+                        {band_positive_sql(positive)},
+                        {nodata},
+                        true
+                    ),
+                    'Max'
+                ) AS ras
+            FROM
+                bands b
+                JOIN features f ON f.class::text = b.class,
+                q_ras
+            GROUP BY
+                b.idx
+        )
+    """
+
+    update_selection_raster_query = multi_band_raster_sql(
+        band_expression=f"""
+            CASE
+                WHEN r.ras IS NULL THEN ST_Band(q_ras.ras, 1)
+                ELSE {merge_expression}
+            END
+        """,
+        band_from="bands b LEFT JOIN burn r ON r.idx = b.idx"
+    )
+    return ",\n".join([bands_sql(band_classes), burn_query, update_selection_raster_query])
+
+
+# Per cell statistics of statistics_sql, 'min' and 'max' take a numeric column as 'min:column'
+STATISTICS = ('presence', 'count', 'length', 'area_fraction', 'min', 'max')
+
+# Largest count of a 16BUI band, 65535 is its nodata
+_max_count = 65534
+
+
+def parse_statistics(statistics: list) -> list:
+    """[(statistic, column)] of ['presence', 'count', 'min:maxspeed', ...], column is None but for 'min' and 'max'"""
+    parsed = []
+    for statistic in statistics:
+        name, _, column = statistic.partition(':')
+        if name not in STATISTICS:
+            raise ValueError(f"statistics should be in {STATISTICS}, got {statistic!r}")
+        if (name in ('min', 'max')) != bool(column):
+            raise ValueError(f"'min' and 'max' need a column e.g. 'max:maxspeed', the others none, got {statistic!r}")
+        parsed.append((name, column or None))
+    return parsed
+
+
+def statistics_pixel_type(statistics: list) -> str:
+    """pixel type holding every statistic, the bands of a GeoTIFF (and of a numpy array) share one type"""
+    names = {name for name, _ in parse_statistics(statistics)}
+    if names <= {'presence'}:
+        return '8BUI'
+    if names <= {'presence', 'count'}:
+        return '16BUI'
+    return '32BF'
+
+
+def statistics_sql(statistics: list, positive, negative, nodata, cell_size, pixel_type='32BF', length_scale=1, subdivided=False):
+    """
+    one band per statistic of the features touching every pixel, computed in one pass over the pixel x feature intersections.
+
+    presence: positive where a feature touches the pixel, negative elsewhere in the selection.
+    count: number of features touching the pixel.
+    length: length of lines inside the pixel, in meters through length_scale (meters per table unit).
+    area_fraction: part of the pixel covered by polygons, 0 to 1.
+    min, max: smallest and largest value of a column of the features touching the pixel, nodata where there is none.
+    Outside the selection every band is nodata. Needs features_sql with attributes, the columns of 'min' and 'max' in order.
+    """
+    statistics = parse_statistics(statistics)
+    names = {name for name, _ in statistics}
+    columns = [column for _, column in statistics if column is not None]
+    columns = list(dict.fromkeys(columns))
+
+    aggregates = ["COUNT(DISTINCT f.fid) AS n" if subdivided else "COUNT(*) AS n"]
+    if 'length' in names:
+        aggregates.append("SUM(ST_Length(i.geom)) AS length")
+    if 'area_fraction' in names:
+        aggregates.append("ST_Area(ST_Union(ST_CollectionExtract(i.geom, 3))) AS area")
+    for i, column in enumerate(columns):
+        aggregates.append(f"MIN(f.attr_{i})::double precision AS min_{i}")
+        aggregates.append(f"MAX(f.attr_{i})::double precision AS max_{i}")
+    intersection = ""
+    if names & {'length', 'area_fraction'}:
+        # Intersection of pixel and feature computed once for every statistic
+        intersection = "CROSS JOIN LATERAL (SELECT ST_Intersection(f.geom, px.geom) AS geom) i"
+
+    pixel_stats_query = f"""
+        pixel_stats AS (
+            SELECT
+                px.x,
+                px.y,
+                {(',' + chr(10) + '                ').join(aggregates)}
+            FROM
+                (
+                    SELECT (pp).x, (pp).y, (pp).geom
+                    FROM (SELECT ST_PixelAsPolygons(q_ras.ras, 1) pp FROM q_ras) a
+                ) px
+                JOIN features f ON ST_Intersects(f.geom, px.geom)
+                {intersection}
+            GROUP BY
+                px.x,
+                px.y
+        )
+    """
+
+    def band_query(idx, name, column):
+        # Value of every pixel touched by a feature and the value of the rest of the selection
+        if name == 'presence':
+            value, base = f"{positive}", f"{negative}"
+        elif name == 'count':
+            value, base = f"LEAST(p.n, {_max_count})", "0"
+        elif name == 'length':
+            value, base = f"(p.length*{length_scale})::real", "0"
+        elif name == 'area_fraction':
+            value, base = f"LEAST(p.area / (({cell_size})*({cell_size})), 1)::real", "0"
+        else:
+            value, base = f"p.{name}_{columns.index(column)}::real", "NULL"
+        # ST_SetValues rasterizes every geomval, pixels of the same value are set as one multipoint
+        return f"""
+            SELECT
+                {idx} AS idx,
+                COALESCE(
+                    ST_SetValues(
+                        b.ras,
+                        1,
+                        (
+                            SELECT array_agg((v.geom, v.value)::geomval)
+                            FROM (
+                                SELECT
+                                    ST_Collect(ST_PixelAsCentroid(q_ras.ras, p.x, p.y)) AS geom,
+                                    {value} AS value
+                                FROM pixel_stats p
+                                WHERE {value} IS NOT NULL
+                                GROUP BY 2
+                            ) v
+                        )
+                    ),
+                    b.ras
+                ) AS ras
+            FROM
+                q_ras,
+                LATERAL (SELECT ST_MapAlgebra(q_ras.ras, 1, '{pixel_type}', '{base}', {nodata}) AS ras) b
+        """
+
+    stat_bands_query = f"""
+        stat_bands AS (
+            {"UNION ALL".join(band_query(i + 1, name, column) for i, (name, column) in enumerate(statistics))}
+        )
+    """
+
+    update_selection_raster_query = f"""
+        raster_w_values AS (
+            SELECT
+                ST_AddBand(
+                    ST_MakeEmptyRaster(q_ras.ras),
+                    (SELECT array_agg(s.ras ORDER BY s.idx) FROM stat_bands s)
+                ) AS ras
+            FROM
+                q_ras
+        )
+    """
+    return ",\n".join([pixel_stats_query, stat_bands_query, update_selection_raster_query])
+
+
+def pyramid_sql(
+    pyramid_table,
+    pyramid_level,
+    class_column,
+    class_query,
+    positive,
+    classes_to_bands=False,
+    band_classes=None,
+    resample='Max'
+    ):
+    """
+    touched pixels read from the pre-rasterized tiles of a pyramid (see pyramid.py) instead of the features.
+
+    Only tiles intersecting q_ras are read (GiST index on ST_ConvexHull(rast)), clipped to q_ras,
+    unioned and resampled onto the q_ras grid, then merged into q_ras like the burn engine.
+    Exact only for grids lining up with the level, pyramid.pyramid_level picks such a level.
+    resample: resampling algorithm of ST_Resample, 'Max' keeps every touched pixel (PostGIS 3.4+).
+    """
+    # NULL class tiles are burnt into the single band like features without a class, bands are of classes
+    tiles_query = f"""
+        tiles AS (
+            SELECT
+                p.{quote_identifier(class_column)} AS class,
+                ST_Clip(p.rast, ST_Expand(ST_Envelope(q_ras.ras), ST_PixelWidth(p.rast)), true) AS rast
+            FROM
+                {pyramid_table} p,
+                q_ras
+            WHERE
+                p.level = {pyramid_level}
+                AND ST_ConvexHull(p.rast) && ST_Envelope(q_ras.ras)
+                AND {class_query}
+                {f"AND p.{quote_identifier(class_column)} IS NOT NULL" if classes_to_bands else ""}
+        )
+    """
+
+    def merge_expression(band_positive):
+        # Positive where a tile pixel is touched, outside the selection the selection raster decides
+        return f"ST_MapAlgebra(q_ras.ras, 1, r.ras, 1, 'CASE WHEN [rast2] > 0 THEN ' || {band_positive} || ' ELSE [rast1] END', '8BUI', 'FIRST', NULL, '[rast1]', NULL)"
+
+    if not classes_to_bands:
+        return f"""
+        {tiles_query},
+
+        touched AS (
+            SELECT
+                ST_Resample((SELECT ST_Union(t.rast, 'Max') FROM tiles t), q_ras.ras, '{resample}') AS ras
+            FROM
+                q_ras
+        ),
+
+        raster_w_values AS (
+            SELECT
+                CASE
+                    WHEN r.ras IS NULL THEN q_ras.ras
+                    ELSE {merge_expression(positive)}
+                END AS ras
+            FROM
+                q_ras,
+                touched r
+        )
+        """
+
+    touched_query = f"""
+        touched AS (
+            SELECT
+                b.idx,
+                ST_Resample((SELECT ST_Union(t.rast, 'Max') FROM tiles t WHERE t.class = b.class), q_ras.ras, '{resample}') AS ras
+            FROM
+                bands b,
+                q_ras
+        )
+    """
+
+    update_selection_raster_query = multi_band_raster_sql(
+        band_expression=f"""
+            CASE
+                WHEN r.ras IS NULL THEN ST_Band(q_ras.ras, 1)
+                ELSE {merge_expression(band_positive_sql(positive))}
+            END
+        """,
+        band_from="bands b LEFT JOIN touched r ON r.idx = b.idx"
+    )
+    return ",\n".join([bands_sql(band_classes), tiles_query, touched_query, update_selection_raster_query])
+
+
+def feature_to_raster_sql(
+    table,
+    grid: Grid,
+    query_x,
+    query_y,
+    height,
+    class_query,
+    class_column='fclass',
+    geom_column='wkb_geometry',
+    positive=1,
+    negative=0,
+    nodata=254,
+    out_srid=None,
+    circle=False,
+    classes_to_bands=False,
+    engine='fishnet',
+    window: Grid=None,
+    band_classes: list=None,
+    output_format='tiff',
+    pyramid_table=None,
+    pyramid_level=None,
+    subdivide: int=None,
+    simplify: float=None,
+    statistics: list=None,
+    length_scale=1,
+    output_driver: str='GTiff',
+    creation_options: list=None
+    ):
+    """
+    complete rasterization statement returning a row of (raster, band classes, band feature counts).
+
+    classes_to_bands: one band per class found in the selection ordered by class, the band classes and
+        their number of features are returned along with the raster, NULL for a single band raster.
+    engine: 'fishnet' pixel polygons intersected with features, 'burn' features burnt straight onto the grid,
+        'pyramid' touched pixels read from the tiles of level pyramid_level of pyramid_table.
+    window: pixel aligned part of grid, only this part of the raster is built.
+    band_classes: fixed band classes instead of the classes found in the selection, e.g. the same bands for every window.
+    output_format: 'tiff' LZW compressed GeoTIFF bytes, 'wkb' raw band bytes (ST_AsBinary) to be decoded by raster_wkb.
+    subdivide, simplify: features are clipped to the grid (or window) and prepared before the engine runs, see features_sql.
+    statistics: one band per statistic of statistics_sql instead of the engine, the band classes returned are the statistics
+        and the band counts the number of features. nodata is the nodata of 8BUI bands, see config.statistics_*_nodata for the others.
+    length_scale: meters per table unit of the 'length' statistic.
+    output_driver, creation_options: GDAL driver and creation options of the 'tiff' output encoded by the server,
+        see writers.server_driver_options, LZW compressed GTiff when creation_options is None.
+    """
+    if statistics and classes_to_bands:
+        raise ValueError("statistics and classes_to_bands can not be combined")
+    if engine not in ('fishnet', 'burn', 'pyramid'):
+        raise ValueError(f"engine should be 'fishnet', 'burn' or 'pyramid' for server side rasterization, got {engine!r}")
+    if engine == 'pyramid' and pyramid_table is None:
+        raise ValueError("engine 'pyramid' needs pyramid_table and pyramid_level, see pyramid.get_pyramid")
+
+    if out_srid is None:
+        out_srid = grid.srid
+
+    selection_geom_query = selection_geom_sql(grid, query_x, query_y, height, circle=circle)
+    if window is not None:
+        selection_geom_query = clip_selection_geom_sql(selection_geom_query, window)
+        grid = window
+
+    attributes = None
+    if statistics:
+        pixel_type = statistics_pixel_type(statistics)
+        # q_ras stays 8BUI, only the statistic bands take the wider type
+        statistics_nodata = {'8BUI': nodata, '16BUI': config.statistics_count_nodata, '32BF': config.statistics_float_nodata}[pixel_type]
+        attributes = list(dict.fromkeys(column for _, column in parse_statistics(statistics) if column is not None))
+
+    template_sql = raster_template_sql(grid, nodata)
+
+    if statistics:
+        engine_query = statistics_sql(
+            statistics,
+            positive,
+            negative,
+            statistics_nodata,
+            grid.cell_size,
+            pixel_type=pixel_type,
+            length_scale=length_scale,
+            subdivided=bool(subdivide)
+        )
+    elif engine == 'burn':
+        engine_query = burn_sql(positive, nodata, classes_to_bands=classes_to_bands, band_classes=band_classes)
+    elif engine == 'pyramid':
+        engine_query = pyramid_sql(
+            pyramid_table,
+            pyramid_level,
+            class_column,
+            class_query,
+            positive,
+            classes_to_bands=classes_to_bands,
+            band_classes=band_classes,
+            resample=config.pyramid_resample_algorithm
+        )
+    else:
+        engine_query = fishnet_sql(positive, classes_to_bands=classes_to_bands, band_classes=band_classes)
+
+    out_raster_sql = f"""
+        {selection_sql(selection_geom_query)},
+
+        {features_sql(
+            table,
+            geom_column,
+            class_column,
+            class_query,
+            grid=grid,
+            clip=bool(subdivide or simplify),
+            subdivide=subdivide,
+            simplify=simplify,
+            attributes=attributes
+        )},
+
+        {selection_rasterize_sql(template_sql, negative, nodata)},
+
+        {engine_query}
+    """
+
+    if classes_to_bands:
+        band_mapping_sql = """
+            (SELECT array_agg(b.class::text ORDER BY b.idx) FROM bands b),
+            (SELECT array_agg(b.num_features ORDER BY b.idx) FROM bands b)
+        """
+    elif statistics:
+        band_mapping_sql = f"""
+            ARRAY[{", ".join(literal(statistic) for statistic in statistics)}]::text[],
+            array_fill((SELECT COUNT(*) FILTER (WHERE f.part = 1) FROM features f), ARRAY[{len(statistics)}])
+        """
+    else:
+        band_mapping_sql = """
+            NULL::text[],
+            NULL::bigint[]
+        """
+
+    return f"""
+        WITH {out_raster_sql},
+
+        {out_raster_transform_sql(grid, out_srid)}
+
+        SELECT
+            {output_sql(output_format, output_driver, creation_options)},
+            {band_mapping_sql}
+        FROM out_raster
+    """
+
+
+def out_raster_transform_sql(grid: Grid, out_srid):
+    # raster_w_values transformed to the output srid
+    out_raster_expression = "r.ras"
+    if out_srid != grid.srid:
+        out_raster_expression = f"""
+                ST_Transform(
+                    r.ras,
+                    {out_srid}
+                )"""
+    return f"""
+        out_raster AS (
+            SELECT
+                {out_raster_expression} AS ras
+            FROM
+                raster_w_values r
+        )
+    """
+
+
+def output_sql(output_format='tiff', output_driver='GTiff', creation_options: list=None):
+    # Encoding of out_raster, see feature_to_raster_sql
+    if output_format == 'wkb':
+        return "ST_AsBinary(out_raster.ras)"
+    if creation_options is not None:
+        return f"""ST_AsGDALRaster(
+                out_raster.ras,
+                {literal(output_driver)},
+                ARRAY[{", ".join(literal(o) for o in creation_options)}]::text[]
+            )"""
+    return """ST_AsTIFF(
+                out_raster.ras,
+                'LZW'
+            )"""
+
+
+def layers_to_raster_sql(
+    layers: list,
+    grid: Grid,
+    query_x,
+    query_y,
+    height,
+    nodata=254,
+    out_srid=None,
+    circle=False,
+    engine='fishnet',
+    output_format='tiff',
+    output_driver: str='GTiff',
+    creation_options: list=None
+    ):
+    """
+    one statement rasterizing several tables onto the same grid and selection,
+    returning a row of (raster, band labels, band feature counts) with the bands of every layer in order.
+
+    layers: dicts of table, geom_column, class_column, class_query, positive, negative, classes_to_bands,
+        subdivide, simplify and label, the band label of a single band layer and the prefix of label:class otherwise.
+        Every table has the srid of grid.
+    The selection and its mask are computed once, every layer runs the engine in its own scope (nested WITH)
+    on the mask valued with its negative value.
+    """
+    if engine not in ('fishnet', 'burn'):
+        raise ValueError(f"engine should be 'fishnet' or 'burn' for layers, got {engine!r}")
+    if out_srid is None:
+        out_srid = grid.srid
+
+    def layer_sql(i, layer):
+        clip = bool(layer.get('subdivide') or layer.get('simplify'))
+        if engine == 'burn':
+            engine_query = burn_sql(layer['positive'], nodata, classes_to_bands=layer['classes_to_bands'])
+        else:
+            engine_query = fishnet_sql(layer['positive'], classes_to_bands=layer['classes_to_bands'])
+        if layer['classes_to_bands']:
+            # A layer without classes in the selection keeps its single band of negative values
+            mapping = f"""
+                COALESCE((SELECT array_agg({literal(layer['label'] + ':')} || b.class ORDER BY b.idx) FROM bands b), ARRAY[{literal(layer['label'])}]) AS classes,
+                COALESCE((SELECT array_agg(b.num_features ORDER BY b.idx) FROM bands b), ARRAY[0::bigint]) AS counts
+            """
+        else:
+            mapping = f"""
+                ARRAY[{literal(layer['label'])}]::text[] AS classes,
+                ARRAY[(SELECT COUNT(*) FILTER (WHERE f.part = 1) FROM features f)] AS counts
+            """
+        return f"""
+        layer_{i} AS (
+            WITH q_ras AS (
+                SELECT ST_MapAlgebra(m.ras, 1, '8BUI', '{layer['negative']}', {nodata}) AS ras FROM q_mask m
+            ),
+
+            {features_sql(
+                layer['table'],
+                layer['geom_column'],
+                layer['class_column'],
+                layer['class_query'],
+                grid=grid,
+                clip=clip,
+                subdivide=layer.get('subdivide'),
+                simplify=layer.get('simplify')
+            )},
+
+            {engine_query}
+
+            SELECT
+                {i} AS layer,
+                r.ras,
+                {mapping}
+            FROM
+                raster_w_values r
+        )
+    """
+
+    layers_query = "\n            UNION ALL\n            ".join(f"SELECT * FROM layer_{i}" for i in range(len(layers)))
+    return f"""
+        WITH {selection_sql(selection_geom_sql(grid, query_x, query_y, height, circle=circle))},
+
+        {selection_rasterize_sql(raster_template_sql(grid, nodata), 0, nodata, name='q_mask')},
+
+        {",".join(layer_sql(i, layer) for i, layer in enumerate(layers))},
+
+        layers AS (
+            {layers_query}
+        ),
+
+        raster_w_values AS (
+            SELECT
+                ST_AddBand(
+                    ST_MakeEmptyRaster(q_mask.ras),
+                    (
+                        SELECT array_agg(ST_Band(l.ras, n) ORDER BY l.layer, n)
+                        FROM layers l, generate_series(1, ST_NumBands(l.ras)) n
+                    )
+                ) AS ras
+            FROM
+                q_mask
+        ),
+
+        {out_raster_transform_sql(grid, out_srid)}
+
+        SELECT
+            {output_sql(output_format, output_driver, creation_options)},
+            (SELECT array_agg(c ORDER BY l.layer, o) FROM layers l, unnest(l.classes) WITH ORDINALITY u(c, o)),
+            (SELECT array_agg(c ORDER BY l.layer, o) FROM layers l, unnest(l.counts) WITH ORDINALITY u(c, o))
+        FROM out_raster
+    """
+
+
+def feature_stream_sql(
+    table,
+    grid: Grid,
+    query_x,
+    query_y,
+    height,
+    class_query,
+    class_column='fclass',
+    geom_column='wkb_geometry',
+    circle=False
+    ):
+    """
+    selection geometry (kind 0) and the features intersecting it (kind 1) as WKB for client side rasterization.
+
+    The database only runs the indexed ST_Intersects selection, features are clipped to the grid extent plus one cell.
+    """
+    table, geom_column, class_column = quote_identifier(table), quote_identifier(geom_column), quote_identifier(class_column)
+    return f"""
+        WITH {selection_sql(selection_geom_sql(grid, query_x, query_y, height, circle=circle))},
+
+        box AS (
+            SELECT ST_Expand(
+                ST_MakeEnvelope({grid.x_left}, {grid.y_upper - grid.n_rows*grid.cell_size}, {grid.x_left + grid.n_cols*grid.cell_size}, {grid.y_upper}, {grid.srid}),
+                {grid.cell_size}
+            ) AS geom
+        )
+
+        SELECT
+            0 AS kind,
+            NULL::text AS class,
+            ST_AsBinary(q.geom)
+        FROM q
+
+        UNION ALL
+
+        SELECT
+            1 AS kind,
+            t.{class_column}::text AS class,
+            ST_AsBinary(ST_ClipByBox2D(t.{geom_column}, box.geom))
+        FROM
+            public.{table} t,
+            q,
+            box
+        WHERE
+            ST_Intersects(q.geom, t.{geom_column})
+            AND
+            {class_query}
+    """
@@ -0,0 +1,210 @@
+import math
+import os
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .utils import Grid, query_db
+from .pool import borrow_connection, reserve_connections
+from .sql import feature_to_raster_sql
+from . import config
+
+# Tiled execution, the grid is split in pixel aligned windows which are rasterized one by one
+#
+# Windows are (row_off, col_off, n_rows, n_cols) in pixels of the grid,
+# every window is rasterized by its own statement and written into its part of the output as it arrives.
+# With max_workers > 1 windows run concurrently on pooled connections (psycopg2 releases the GIL while waiting),
+# the rasters are stitched on the client in the main thread. Workers only get the pool slots free when the request
+# starts (reserve_connections), concurrent requests fall back to fewer workers or to the caller's connection.
+
+Window = namedtuple('Window', ['row_off', 'col_off', 'n_rows', 'n_cols'])
+
+
+def iter_windows(grid: Grid, tile_size: int):
+    """pixel aligned windows of at most tile_size x tile_size pixels covering the grid, row by row"""
+    for row_off in range(0, grid.n_rows, tile_size):
+        for col_off in range(0, grid.n_cols, tile_size):
+            yield Window(
+                row_off,
+                col_off,
+                min(tile_size, grid.n_rows - row_off),
+                min(tile_size, grid.n_cols - col_off)
+            )
+
+
+def split_windows(grid: Grid, n: int):
+    """grid split in n pixel aligned strips of rows, about the same size"""
+    n = max(1, min(n, grid.n_rows))
+    bounds = [round(i*grid.n_rows/n) for i in range(n + 1)]
+    return [Window(bounds[i], 0, bounds[i+1] - bounds[i], grid.n_cols) for i in range(n)]
+
+
+def window_grid(grid: Grid, window: Window) -> Grid:
+    """part of the grid covered by window, same cell size and alignment"""
+    x_left = grid.x_left + window.col_off*grid.cell_size
+    y_upper = grid.y_upper - window.row_off*grid.cell_size
+    return Grid(
+        grid.srid,
+        x_left,
+        y_upper - window.n_rows*grid.cell_size,
+        x_left + window.n_cols*grid.cell_size,
+        y_upper,
+        grid.cell_size,
+        window.n_rows,
+        window.n_cols
+    )
+
+
+def tiled_creation_options(block_size: int=256):
+    return ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+
+def _rasterize_window(grid: Grid, window: Window, statement_kwargs: dict, band_classes: list=None, connection=None):
+    from .raster_wkb import read_raster_wkb
+
+    # Raw band bytes, no GeoTIFF encode on the server and decode here
+    sql = feature_to_raster_sql(
+        grid=grid,
+        window=window_grid(grid, window),
+        band_classes=band_classes,
+        output_format='wkb',
+        **statement_kwargs
+    )
+    raster = query_db(sql, connection=connection)[0][0]
+    if raster is None:
+        # Window outside the selection
+        return None
+    array, transform, _, _ = read_raster_wkb(raster)
+    return array, transform
+
+
+def _rasterize_window_reserved(grid: Grid, window: Window, statement_kwargs: dict, band_classes: list=None):
+    # Worker thread, on a pool slot reserved by rasterize_windows
+    with borrow_connection(reserved=True) as connection:
+        return _rasterize_window(grid, window, statement_kwargs, band_classes, connection=connection)
+
+
+def rasterize_windows(grid: Grid, windows, statement_kwargs: dict, ds, connection=None, band_classes: list=None, max_workers: int=1):
+    """
+    rasterizes windows of grid and writes them into the GDAL dataset ds on grid.
+
+    Peak memory is max_workers windows. statement_kwargs are passed to sql.feature_to_raster_sql.
+    max_workers: windows rasterized at the same time, each on its own pooled connection,
+        fewer when fewer pool slots are free, one by one on connection when at most one is.
+    """
+    from .writers import write_window
+
+    if max_workers > 1:
+        with reserve_connections(max_workers) as reserved:
+            if reserved > 1:
+                _rasterize_concurrently(grid, windows, statement_kwargs, ds, band_classes, reserved)
+                return
+
+    for window in windows:
+        result = _rasterize_window(grid, window, statement_kwargs, band_classes, connection=connection)
+        if result is not None:
+            write_window(ds, grid, *result, window=window)
+
+
+def _rasterize_concurrently(grid: Grid, windows, statement_kwargs: dict, ds, band_classes: list, max_workers: int):
+    from .writers import write_window
+
+    # At most max_workers windows in flight, GDAL writes stay in this thread
+    windows = iter(windows)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        while True:
+            for window in windows:
+                future = executor.submit(_rasterize_window_reserved, grid, window, statement_kwargs, band_classes)
+                pending[future] = window
+                if len(pending) >= max_workers:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window = pending.pop(future)
+                result = future.result()
+                if result is not None:
+                    write_window(ds, grid, *result, window=window)
+
+
+def get_max_workers(max_workers: int=None):
+    # Concurrency of one request, capped so that one request can not take the whole pool
+    # and leaving a connection for the calling thread, rasterize_windows reserves what is free of it
+    if not max_workers:
+        return 1
+    return max(1, min(max_workers, config.max_workers_per_request, config.pool_maxconn - 1))
+
+
+def analysis_tiled(
+    output_raster: str,
+    grid: Grid,
+    statement_kwargs: dict,
+    tile_size: int=None,
+    nodata=254,
+    out_srid: int=None,
+    band_classes: list=None,
+    max_workers: int=None,
+    as_array: bool=False,
+    profile: 'writers.OutputProfile'=None,
+    connection: 'psycopg2 connection'=None
+    ):
+    """
+    writes the analysis raster tile by tile into a tiled GeoTIFF, warped to out_srid afterwards when it differs.
+    With as_array the tiles are stitched in memory and a raster_wkb.RasterArray is returned instead.
+
+    tile_size: tiles of tile_size x tile_size pixels, by default the grid is split in one strip per worker.
+    band_classes: band classes of classes_to_bands, the same bands for every tile.
+    max_workers: tiles rasterized concurrently on pooled connections, capped by config.max_workers_per_request.
+    profile: writers.OutputProfile of output_raster, the tiles are written into a temporary GeoTIFF copied to it at the end.
+    """
+    from .writers import create_geotiff, warp_geotiff, warp_to_memory, dataset_to_raster_array, copy_geotiff
+
+    max_workers = get_max_workers(max_workers)
+    if tile_size:
+        windows = iter_windows(grid, tile_size)
+    else:
+        windows = split_windows(grid, max_workers)
+        tile_size = max(w.n_rows for w in windows)
+
+    n_bands = 1 if band_classes is None else max(len(band_classes), 1)
+    block_size = 256 if tile_size >= 256 else 16*max(1, math.ceil(tile_size/16))
+    creation_options = tiled_creation_options(block_size)
+
+    warp = out_srid is not None and out_srid != grid.srid
+    statement_kwargs = dict(statement_kwargs, out_srid=grid.srid, nodata=nodata)
+
+    if as_array:
+        ds = create_geotiff('', grid, n_bands, nodata=nodata, driver='MEM')
+        rasterize_windows(grid, windows, statement_kwargs, ds, connection=connection, band_classes=band_classes, max_workers=max_workers)
+        if warp:
+            ds = warp_to_memory(ds, out_srid, nodata=nodata)
+        return dataset_to_raster_array(ds, nodata=nodata)
+
+    target = f"{output_raster}.{uuid.uuid4().hex}.tmp.tif" if warp or profile is not None else output_raster
+    warped = f"{output_raster}.{uuid.uuid4().hex}.warp.tif" if warp and profile is not None else output_raster
+
+    ds = create_geotiff(target, grid, n_bands, nodata=nodata, creation_options=creation_options)
+    try:
+        rasterize_windows(
+            grid,
+            windows,
+            statement_kwargs,
+            ds,
+            connection=connection,
+            band_classes=band_classes,
+            max_workers=max_workers
+        )
+        ds.FlushCache()
+        ds = None
+        if warp:
+            warp_geotiff(target, warped, out_srid, nodata=nodata, creation_options=creation_options)
+        if profile is not None:
+            copy_geotiff(warped if warp else target, output_raster, profile)
+    finally:
+        ds = None
+        for path in {target, warped} - {output_raster}:
+            if os.path.exists(path):
+                os.remove(path)
+    return True
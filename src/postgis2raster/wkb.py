@@ -0,0 +1,98 @@
+import struct
+
+import numpy as np
+
+# Minimal WKB reader for the client side engines
+#
+# Only x and y are read, z and m ordinates are skipped. ISO (ST_AsBinary) and EWKB (ST_AsEWKB) are both supported.
+# Geometries are flattened into the parts the rasterizer burns:
+#   points      (n, 2) arrays
+#   lines       (n, 2) arrays, one per linestring and polygon ring
+#   rings       (n, 2) arrays, one per polygon ring, ring_polygon holds the polygon id of every ring
+
+_POINT, _LINESTRING, _POLYGON = 1, 2, 3
+_MULTIPOINT, _MULTILINESTRING, _MULTIPOLYGON, _COLLECTION = 4, 5, 6, 7
+
+_EWKB_Z, _EWKB_M, _EWKB_SRID = 0x80000000, 0x40000000, 0x20000000
+
+
+class GeometryParts:
+    def __init__(self):
+        self.points = []
+        self.lines = []
+        self.rings = []
+        self.ring_polygon = []
+        self.n_polygons = 0
+
+    def __bool__(self):
+        return bool(self.points or self.lines or self.rings)
+
+
+def _read_header(buf, pos):
+    byteorder = '<' if buf[pos] == 1 else '>'
+    (geom_type,) = struct.unpack_from(byteorder + 'I', buf, pos+1)
+    pos += 5
+
+    n_dims = 2
+    if geom_type & (_EWKB_Z | _EWKB_M | _EWKB_SRID):
+        n_dims += bool(geom_type & _EWKB_Z) + bool(geom_type & _EWKB_M)
+        if geom_type & _EWKB_SRID:
+            pos += 4
+        geom_type &= 0x0fffffff
+    else:
+        # ISO WKB, 1000 Z, 2000 M, 3000 ZM
+        n_dims += {0: 0, 1: 1, 2: 1, 3: 2}[geom_type // 1000]
+        geom_type %= 1000
+    return byteorder, geom_type, n_dims, pos
+
+
+def _read_coords(buf, pos, byteorder, n_dims):
+    (n,) = struct.unpack_from(byteorder + 'I', buf, pos)
+    pos += 4
+    coords = np.frombuffer(buf, dtype=byteorder + 'f8', count=n*n_dims, offset=pos).reshape(n, n_dims)[:, :2]
+    return coords, pos + 8*n*n_dims
+
+
+def _read_geometry(buf, pos, parts: GeometryParts):
+    byteorder, geom_type, n_dims, pos = _read_header(buf, pos)
+
+    if geom_type == _POINT:
+        coords = np.frombuffer(buf, dtype=byteorder + 'f8', count=n_dims, offset=pos)[:2]
+        if not np.isnan(coords).any():  # POINT EMPTY
+            parts.points.append(coords.reshape(1, 2))
+        return pos + 8*n_dims
+
+    if geom_type == _LINESTRING:
+        coords, pos = _read_coords(buf, pos, byteorder, n_dims)
+        if len(coords):
+            parts.lines.append(coords)
+        return pos
+
+    if geom_type == _POLYGON:
+        (n_rings,) = struct.unpack_from(byteorder + 'I', buf, pos)
+        pos += 4
+        for _ in range(n_rings):
+            coords, pos = _read_coords(buf, pos, byteorder, n_dims)
+            if len(coords):
+                parts.rings.append(coords)
+                parts.ring_polygon.append(parts.n_polygons)
+                parts.lines.append(coords)
+        parts.n_polygons += 1
+        return pos
+
+    if geom_type in (_MULTIPOINT, _MULTILINESTRING, _MULTIPOLYGON, _COLLECTION):
+        (n_geoms,) = struct.unpack_from(byteorder + 'I', buf, pos)
+        pos += 4
+        for _ in range(n_geoms):
+            pos = _read_geometry(buf, pos, parts)
+        return pos
+
+    raise ValueError(f"unsupported WKB geometry type {geom_type}")
+
+
+def read_wkb(buf, parts: GeometryParts=None) -> GeometryParts:
+    """adds the points, lines and polygon rings of a WKB / EWKB geometry to parts"""
+    if parts is None:
+        parts = GeometryParts()
+    _read_geometry(buf, 0, parts)
+    return parts
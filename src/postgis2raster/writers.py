@@ -0,0 +1,310 @@
+import math
+import uuid
+from collections import namedtuple
+
+from . import config
+
+# GeoTIFF output of the client side engines, needs GDAL
+
+def _gdal():
+    try:
+        from osgeo import gdal, osr
+    except ImportError:
+        raise ImportError("please install gdal to write rasters on the client.")
+    gdal.UseExceptions()
+    return gdal, osr
+
+
+def geotransform(grid):
+    return (grid.x_left, grid.cell_size, 0, grid.y_upper, 0, -grid.cell_size)
+
+
+def create_geotiff(path: str, grid, n_bands: int, nodata=254, creation_options: list=None, driver: str='GTiff'):
+    """empty uint8 GeoTIFF dataset on grid, pixels never written read as nodata. driver='MEM' for an in memory dataset"""
+    gdal, osr = _gdal()
+    driver = gdal.GetDriverByName(driver)
+    ds = driver.Create(path, grid.n_cols, grid.n_rows, n_bands, gdal.GDT_Byte, options=creation_options or [])
+    ds.SetGeoTransform(geotransform(grid))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(grid.srid))
+    ds.SetProjection(srs.ExportToWkt())
+    for i in range(n_bands):
+        ds.GetRasterBand(i+1).SetNoDataValue(nodata)
+    return ds
+
+
+def read_geotiff_bytes(data):
+    """(bands, rows, cols) array and geotransform of GeoTIFF bytes, decoded in memory"""
+    gdal, _ = _gdal()
+    path = f"/vsimem/postgis2raster_{uuid.uuid4().hex}.tif"
+    gdal.FileFromMemBuffer(path, bytes(data))
+    try:
+        ds = gdal.Open(path)
+        array = ds.ReadAsArray()
+        if array.ndim == 2:
+            array = array[None]
+        transform = ds.GetGeoTransform()
+        ds = None
+    finally:
+        gdal.Unlink(path)
+    return array, transform
+
+
+def write_window(ds, grid, array, transform, window=None):
+    """
+    writes a (bands, rows, cols) array with geotransform transform into ds on grid.
+
+    Only the part inside window (row_off, col_off, n_rows, n_cols) of grid is written, the whole grid when None.
+    """
+    if window is None:
+        window = (0, 0, grid.n_rows, grid.n_cols)
+    w_row, w_col, w_rows, w_cols = window
+
+    # Position of the array on the grid, both are pixel aligned
+    row_off = int(round((grid.y_upper - transform[3]) / grid.cell_size))
+    col_off = int(round((transform[0] - grid.x_left) / grid.cell_size))
+
+    row_start, row_end = max(row_off, w_row), min(row_off + array.shape[1], w_row + w_rows)
+    col_start, col_end = max(col_off, w_col), min(col_off + array.shape[2], w_col + w_cols)
+    if row_end <= row_start or col_end <= col_start:
+        return
+
+    part = array[:, row_start - row_off:row_end - row_off, col_start - col_off:col_end - col_off]
+    for i in range(part.shape[0]):
+        ds.GetRasterBand(i+1).WriteArray(part[i], xoff=col_start, yoff=row_start)
+
+
+def warp_to_memory(src, out_srid: int, nodata=254):
+    """in memory (MEM) dataset of src warped to out_srid with nearest neighbour resampling"""
+    gdal, _ = _gdal()
+    return gdal.Warp(
+        '',
+        src,
+        format='MEM',
+        dstSRS=f"EPSG:{out_srid}",
+        resampleAlg='near',
+        srcNodata=nodata,
+        dstNodata=nodata
+    )
+
+
+def dataset_to_raster_array(ds, nodata=254, band_mapping=None):
+    from .raster_wkb import RasterArray
+
+    array = ds.ReadAsArray()
+    if array.ndim == 2:
+        array = array[None]
+    srs = ds.GetSpatialRef()
+    return RasterArray(
+        array=array,
+        geotransform=ds.GetGeoTransform(),
+        crs=f"EPSG:{srs.GetAuthorityCode(None)}",
+        nodata=nodata,
+        band_mapping=band_mapping
+    )
+
+
+def array_to_raster_array(array, grid, nodata=254, out_srid: int=None, band_mapping=None):
+    """RasterArray of a (bands, rows, cols) array on grid, warped in memory when out_srid differs"""
+    from .raster_wkb import RasterArray
+
+    if out_srid is None or out_srid == grid.srid:
+        return RasterArray(
+            array=array,
+            geotransform=geotransform(grid),
+            crs=f"EPSG:{grid.srid}",
+            nodata=nodata,
+            band_mapping=band_mapping
+        )
+    ds = create_geotiff('', grid, array.shape[0], nodata=nodata, driver='MEM')
+    for i in range(array.shape[0]):
+        ds.GetRasterBand(i+1).WriteArray(array[i])
+    return dataset_to_raster_array(warp_to_memory(ds, out_srid, nodata=nodata), nodata=nodata, band_mapping=band_mapping)
+
+
+def warp_geotiff(src: str, path: str, out_srid: int, nodata=254, creation_options: list=None):
+    """warps a GeoTIFF to out_srid with nearest neighbour resampling"""
+    gdal, _ = _gdal()
+    gdal.Warp(
+        path,
+        src,
+        dstSRS=f"EPSG:{out_srid}",
+        resampleAlg='near',
+        srcNodata=nodata,
+        dstNodata=nodata,
+        creationOptions=creation_options or []
+    )
+
+
+def write_geotiff(path: str, array, grid, nodata=254, out_srid: int=None, creation_options: list=None) -> bool:
+    """
+    writes a (bands, rows, cols) uint8 array on grid to a GeoTIFF, warped to out_srid when it differs from the grid srid.
+    """
+    gdal, _ = _gdal()
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW']
+
+    warp = out_srid is not None and out_srid != grid.srid
+    target = f"/vsimem/postgis2raster_{uuid.uuid4().hex}.tif" if warp else path
+
+    ds = create_geotiff(target, grid, array.shape[0], nodata=nodata, creation_options=[] if warp else creation_options)
+    for i in range(array.shape[0]):
+        ds.GetRasterBand(i+1).WriteArray(array[i])
+    ds.FlushCache()
+    ds = None
+
+    if warp:
+        warp_geotiff(target, path, out_srid, nodata=nodata, creation_options=creation_options)
+        gdal.Unlink(target)
+    return True
+
+
+## Output Profiles start ##
+
+# GeoTIFF layout and compression of written rasters
+#
+#   cog          Cloud Optimized GeoTIFF, internally tiled with overviews, windows and overview levels are read with ranged requests
+#   block_size   internal tiles of block_size x block_size pixels, striped when None (tiled whenever cog)
+#   compress     'LZW', 'DEFLATE', 'ZSTD', 'PACKBITS' or 'NONE', ZSTD needs a GDAL built with it (on the server for encode='server')
+#   level        compression level of DEFLATE (1-12) and ZSTD (1-22), GDAL default when None
+#   predictor    2 horizontal differencing for integer bands, 3 floating point predictor, None for none
+#   nbits        1, 2 or 4 bits per pixel for masks, every value (positive, negative and nodata) has to fit
+#   overview_resampling  resampling of the cog overviews, 'NEAREST' keeps the mask values
+#   encode       'server' the database encodes the GeoTIFF, 'client' raw bands are fetched and encoded by GDAL here
+#
+# Profiles are given by name (config.output_profiles), as OutputProfile or as a dict of its fields.
+
+OutputProfile = namedtuple(
+    'OutputProfile',
+    ['cog', 'block_size', 'compress', 'level', 'predictor', 'nbits', 'overview_resampling', 'encode'],
+    defaults=(False, None, 'LZW', None, None, None, 'NEAREST', 'server')
+)
+
+COMPRESSIONS = ('LZW', 'DEFLATE', 'ZSTD', 'PACKBITS', 'NONE')
+
+
+def get_output_profile(profile) -> OutputProfile:
+    """OutputProfile of a profile name, dict or OutputProfile, None for None"""
+    if profile is None or isinstance(profile, OutputProfile):
+        pass
+    elif isinstance(profile, str):
+        if profile not in config.output_profiles:
+            raise ValueError(f"output_profile should be one of {tuple(config.output_profiles)}, got {profile!r}")
+        profile = OutputProfile(**config.output_profiles[profile])
+    else:
+        profile = OutputProfile(**profile)
+    if profile is None:
+        return None
+
+    if profile.compress.upper() not in COMPRESSIONS:
+        raise ValueError(f"compress should be one of {COMPRESSIONS}, got {profile.compress!r}")
+    if profile.encode not in ('server', 'client'):
+        raise ValueError(f"encode should be 'server' or 'client', got {profile.encode!r}")
+    if profile.nbits not in (None, 1, 2, 4):
+        raise ValueError(f"nbits should be 1, 2 or 4, got {profile.nbits!r}")
+    if profile.predictor not in (None, 2, 3):
+        raise ValueError(f"predictor should be 2 or 3, got {profile.predictor!r}")
+    if profile.nbits and profile.cog and profile.encode == 'server':
+        # The COG driver of the server does not pack bits
+        raise ValueError("nbits of a cog needs encode='client'")
+    return profile._replace(compress=profile.compress.upper())
+
+
+def check_profile_values(profile: OutputProfile, values):
+    # Packed pixels hold 2**nbits values, anything else would be silently truncated
+    if profile is None or not profile.nbits:
+        return
+    # values are (positive, negative, nodata), nodata last
+    too_large = [v for v in values if not 0 <= v < 2**profile.nbits]
+    if too_large:
+        message = f"nbits={profile.nbits} holds 0 to {2**profile.nbits - 1}, got values {too_large} (positive, negative, nodata)"
+        if too_large[-1] == values[-1]:
+            # The default nodata 254 needs 8 bits, the largest value not taken by the mask is suggested
+            free = [v for v in range(2**profile.nbits - 1, -1, -1) if v not in values[:-1]]
+            message += f", pass nodata={free[0]}" if free else ", no value is left for nodata, use a larger nbits"
+        raise ValueError(message)
+
+
+def _level_option(profile: OutputProfile, cog_driver=False):
+    if profile.level is None or profile.compress not in ('DEFLATE', 'ZSTD'):
+        return []
+    if cog_driver:
+        return [f'LEVEL={profile.level}']
+    return [f"{'ZLEVEL' if profile.compress == 'DEFLATE' else 'ZSTD_LEVEL'}={profile.level}"]
+
+
+def creation_options(profile: OutputProfile) -> list:
+    """GTiff creation options of a profile, cog layout through COPY_SRC_OVERVIEWS of a dataset with overviews"""
+    options = [f'COMPRESS={profile.compress}', 'BIGTIFF=IF_SAFER'] + _level_option(profile)
+    if profile.predictor:
+        options.append(f'PREDICTOR={profile.predictor}')
+    if profile.nbits:
+        options.append(f'NBITS={profile.nbits}')
+    if profile.cog or profile.block_size:
+        block_size = profile.block_size or 512
+        options += ['TILED=YES', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}']
+    if profile.cog:
+        options.append('COPY_SRC_OVERVIEWS=YES')
+    return options
+
+
+def server_driver_options(profile: OutputProfile):
+    """(GDAL driver, creation options) of ST_AsGDALRaster on the server, the COG driver for a cog (GDAL 3.1+)"""
+    if not profile.cog:
+        return 'GTiff', [o for o in creation_options(profile) if not o.startswith('COPY_SRC_OVERVIEWS')]
+    options = [f'COMPRESS={profile.compress}', 'BIGTIFF=IF_SAFER', f'OVERVIEW_RESAMPLING={profile.overview_resampling}']
+    options += _level_option(profile, cog_driver=True)
+    if profile.predictor:
+        options.append(f"PREDICTOR={'STANDARD' if profile.predictor == 2 else 'FLOATING_POINT'}")
+    if profile.block_size:
+        options.append(f'BLOCKSIZE={profile.block_size}')
+    return 'COG', options
+
+
+def overview_factors(n_rows: int, n_cols: int, block_size: int) -> list:
+    """2, 4, 8, ... until the smallest overview fits in one block"""
+    levels = max(0, math.ceil(math.log2(max(n_rows, n_cols) / block_size)))
+    return [2**i for i in range(1, levels + 1)]
+
+
+def write_dataset(src, path: str, profile: OutputProfile):
+    """copies the GDAL dataset src to a GeoTIFF of profile at path, overviews are built on src for a cog"""
+    gdal, _ = _gdal()
+    if profile.cog:
+        factors = overview_factors(src.RasterYSize, src.RasterXSize, profile.block_size or 512)
+        if factors:
+            src.BuildOverviews(profile.overview_resampling, factors)
+    gdal.GetDriverByName('GTiff').CreateCopy(path, src, options=creation_options(profile))
+
+
+def copy_geotiff(src: str, path: str, profile: OutputProfile):
+    """copies the GeoTIFF src to a GeoTIFF of profile at path, cog overviews are added to src first"""
+    gdal, _ = _gdal()
+    ds = gdal.Open(src, gdal.GA_Update)
+    write_dataset(ds, path, profile)
+    ds = None
+
+
+def write_raster(path: str, raster, profile: OutputProfile) -> bool:
+    """writes a raster_wkb.RasterArray to a GeoTIFF of profile, encoded here"""
+    gdal, osr = _gdal()
+    from osgeo import gdal_array
+
+    n_bands, n_rows, n_cols = raster.array.shape
+    ds = gdal.GetDriverByName('MEM').Create(
+        '', n_cols, n_rows, n_bands, gdal_array.NumericTypeCodeToGDALTypeCode(raster.array.dtype)
+    )
+    ds.SetGeoTransform(raster.geotransform)
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(raster.crs)
+    ds.SetProjection(srs.ExportToWkt())
+    for i in range(n_bands):
+        band = ds.GetRasterBand(i+1)
+        if raster.nodata is not None:
+            band.SetNoDataValue(raster.nodata)
+        band.WriteArray(raster.array[i])
+    write_dataset(ds, path, profile)
+    ds = None
+    return True
+
+## Output Profiles end ##
@@ -1,9 +1,9 @@
 import geopandas as gpd
-from shapely.geometry import Point
-from .utils import select_by_location_polygon, fishnet_helper_rectangle, parameterize_fishnet, save_raster
+import shapely
+from .utils import select_by_location_polygon, select_by_location_df, project_xy, center_hw_to_polygon, fishnet_shape, rasterize_fishnet, mask_circle, fishnet_geotransform, save_raster_array
 
 # Highest Level Functions
-def analysis_circle(table:str, output_raster: str, query_x: float='latitude', query_y: float='longitude', radius: float='meter', cell_size: float='meter', classes: list=None, class_column: str='fclass', geom_column: str='wkb_geometry') -> bool:
+def analysis_circle(table:str, output_raster: str, query_x: float='latitude', query_y: float='longitude', radius: float='meter', cell_size: float='meter', classes: list=None, class_column: str='fclass', geom_column: str='wkb_geometry', out_crs: int=4326) -> bool:
     height = width = radius*2
     return analysis_polygon(
         table=table,
@@ -16,39 +16,45 @@ def analysis_circle(table:str, output_raster: str, query_x: float='latitude', qu
         classes=classes,
         class_column=class_column,
         geom_column=geom_column,
-        circle=True
+        circle=True,
+        out_crs=out_crs
     )
 
 
-def analysis_polygon(table:str, output_raster: str, query_x: float='latitude', query_y: float='longitude', height: float='meter', width: float='meter', cell_size: float='meter', classes: list=None, class_column: str='fclass', geom_column: str='wkb_geometry', circle=False) -> bool:
-    
-    df = select_by_location_polygon(
-        table=table,
-        query_x=query_x,
-        query_y=query_y,
-        height=height,
-        width=width,
-        classes=classes,
-        class_column=class_column,
-        geom_column=geom_column,
-    )
-
-    f_df = fishnet_helper_rectangle(
-        center_x=query_x,
-        center_y=query_y,
-        height=height,
-        width=width,
-        grid_cell_size=cell_size
-    )
-
-    p_df = parameterize_fishnet(f_df, df)
+def analysis_polygon(table: [str, gpd.GeoDataFrame], output_raster: str, query_x: float='latitude', query_y: float='longitude', height: float='meter', width: float='meter', cell_size: float='meter', classes: list=None, class_column: str='fclass', geom_column: str='wkb_geometry', circle=False, out_crs: int=4326) -> bool:
+    # table is a PostGIS table name or a GeoDataFrame for offline use
+    # The fishnet is made in EPSG:3857, the raster is written in out_crs: 4326 by default like before (bounds of the fishnet
+    # in 4326, cells approximated), 3857 for the exact cells
+
+    px, py = project_xy(query_x, query_y, 4326, 3857)
+    x_left, y_lower, x_right, y_upper = center_hw_to_polygon(x=px, y=py, height=height, width=width)
+
+    if isinstance(table, gpd.GeoDataFrame):
+        df = select_by_location_df(
+            table,
+            shapely.box(x_left, y_lower, x_right, y_upper),
+            selection_crs=3857,
+            classes=classes,
+            class_column=class_column
+        )
+    else:
+        df = select_by_location_polygon(
+            table=table,
+            query_x=query_x,
+            query_y=query_y,
+            height=height,
+            width=width,
+            classes=classes,
+            class_column=class_column,
+            geom_column=geom_column,
+        )
+
+    n_rows, n_cols = fishnet_shape(x_left, y_lower, x_right, y_upper, cell_size)
+    arr = rasterize_fishnet(df.to_crs(epsg=3857).geometry.values, x_left, y_upper, cell_size, n_rows, n_cols)
 
     if circle:
-        query_df = gpd.GeoDataFrame(geometry=[Point(query_x, query_y)], crs={"init": "epsg:4326"})
         radius = (height / 2) - cell_size
-        query_df = query_df.to_crs(epsg=3857).buffer(radius).to_crs(epsg=4326)
-
-        con = ~p_df.intersects(query_df.geometry[0])
-        p_df.loc[con, 'pxvalue'] = 99
+        mask_circle(arr, x_left, y_upper, cell_size, px, py, radius, nodata=99)
 
-    return save_raster(str(output_raster), p_df)
\ No newline at end of file
+    geotransform = fishnet_geotransform(x_left, y_upper, cell_size, n_rows, n_cols, crs=out_crs)
+    return save_raster_array(str(output_raster), arr, geotransform, crs=out_crs, nodata=99)
@@ -1,10 +1,9 @@
-from shapely.geometry import Point, Polygon
-from shapely.ops import transform
+from functools import lru_cache
+import shapely
 import pyproj
 import pandas as pd
 import geopandas as gpd
 from sqlalchemy import create_engine
-import gdal
 from .config import host, port, database, user, password
 from osgeo import gdal, osr
 import numpy as np
@@ -20,8 +19,12 @@ def get_engine():
 
 connection = get_engine() 
 
+@lru_cache(maxsize=16)
+def get_transformer(source_srs: int, target_srs: int):
+    return pyproj.Transformer.from_crs(f'epsg:{source_srs}', f'epsg:{target_srs}', always_xy=True)
+
 def project_xy(x: float, y: float, source_srs: int, target_srs: int):
-    return pyproj.transform(pyproj.Proj(init=f'epsg:{source_srs}'), pyproj.Proj(init=f'epsg:{target_srs}'), x, y)
+    return get_transformer(source_srs, target_srs).transform(x, y)
 
 def get_class_query(classes, class_column):
     class_query = "1=1"
@@ -43,31 +46,35 @@ def select_by_location(table: str, selection_geometry_syntax: str, classes: list
             SELECT 
                 ST_Transform(q.geom, {table_srid}) AS geom 
             FROM q
-        ),
-        q2 AS (
-            SELECT
-                p.{geom_column} as geom
-            FROM 
-                public.{table} p,
-                q1
-            WHERE 
-                ST_Intersects(
-                    p.wkb_geometry, 
-                    q1.geom
-                )
-                AND
-                {class_query}
-            LIMIT 1000
         )
         
         SELECT
-            geom 
-        FROM q2
+            p.{geom_column} as geom
+        FROM 
+            public.{table} p,
+            q1
+        WHERE 
+            ST_Intersects(
+                p.{geom_column}, 
+                q1.geom
+            )
+            AND
+            {class_query}
     """
     df = gpd.GeoDataFrame.from_postgis(query, connection, geom_col='geom' )
     return df
 
 
+def select_by_location_df(df: gpd.GeoDataFrame, selection_geometry, selection_crs=3857, classes: list=None, class_column: str='fclass') -> gpd.GeoDataFrame:
+    # Offline selection from a GeoDataFrame with its spatial index, selection_geometry is a shapely geometry in selection_crs
+    selection = gpd.GeoSeries([selection_geometry], crs=f"epsg:{selection_crs}").to_crs(df.crs).iloc[0]
+    idx = df.sindex.query(selection, predicate='intersects')
+    df = df.iloc[np.sort(idx)]
+    if classes is not None:
+        df = df[df[class_column].astype(str).isin([str(c) for c in classes])]
+    return df
+
+
 def select_by_location_circle(table: str, query_x: float, query_y: float, radius: float, classes: list=None, class_column: str='fclass', geom_column: str='wkb_geometry'):
     selection_geometry_syntax = f"""
         WITH q AS (
@@ -135,40 +142,130 @@ def center_hw_to_polygon(x, y, height, width):
     return x_left, y_lower, x_right, y_upper
 
 # Fishnet
+# The grid is kept as its upper left corner, cell size and shape, cell (row, col) with 0 based row from the top covers
+#   x: x_left + col*cell_size .. x_left + (col+1)*cell_size
+#   y: y_upper - (row+1)*cell_size .. y_upper - row*cell_size
+# cell polygons are only built a few rows at a time where a geometry test needs them.
+
+def fishnet_shape(x_left: float, y_lower: float, x_right: float, y_upper: float, grid_cell_size: float):
+    # Same number of rows and cols as stepping cell by cell from the upper left corner
+    n_rows = int(np.ceil((y_upper - y_lower) / grid_cell_size))
+    n_cols = int(np.ceil((x_right - x_left) / grid_cell_size))
+    return n_rows, n_cols
+
+
+def fishnet_cells(x_left: float, y_upper: float, grid_cell_size: float, rows, cols):
+    # Polygons of the cells (rows[i], cols[i]) with one vectorized constructor
+    x0 = x_left + np.asarray(cols)*grid_cell_size
+    y1 = y_upper - np.asarray(rows)*grid_cell_size
+    return shapely.box(x0, y1 - grid_cell_size, x0 + grid_cell_size, y1)
+
+
 def create_fishnet(x_left: 'longitude', y_lower: 'latitude', x_right: 'longitude', y_upper: 'latitude', grid_cell_size: 'float meters', crs=3857) -> gpd.GeoDataFrame:
-    #x1, y1 = project_xy(16.55268272, 40.82717010, 4326, 3857)
-    row_idx = 0
-    geom_store = []
-    attribute_store = []
-    y1 = y_upper
-    while y1 > y_lower:
-        row_idx+=1
-        col_idx = 0
-        _y1 = y1 - grid_cell_size
-        x1 = x_left
-        while x1 < x_right:
-            col_idx+=1  
-            _x1 = x1 + grid_cell_size
-
-            # Get Geometry
-            coords = [(x1, y1), (x1, _y1), (_x1, _y1), (_x1, y1), (x1, y1)]
-            geom = Polygon(coords)
-            geom_store.append(geom)
-
-            # Get Attributes
-            row = {
-                "row": row_idx,
-                "col": col_idx
-            }
-            attribute_store.append(row)
-
-            # 
-            x1 = _x1
-        y1 = _y1
-    df = gpd.GeoDataFrame(attribute_store, geometry=geom_store, crs={'init': f"epsg:{crs}"})
+    n_rows, n_cols = fishnet_shape(x_left, y_lower, x_right, y_upper, grid_cell_size)
+    rows = np.repeat(np.arange(n_rows), n_cols)
+    cols = np.tile(np.arange(n_cols), n_rows)
+    geom_store = fishnet_cells(x_left, y_upper, grid_cell_size, rows, cols)
+    attribute_store = {
+        "row": rows + 1,
+        "col": cols + 1
+    }
+    df = gpd.GeoDataFrame(attribute_store, geometry=geom_store, crs=f"epsg:{crs}")
     return df
 
 
+def candidate_cells(geometries, x_left: float, y_upper: float, grid_cell_size: float, n_rows: int, n_cols: int) -> np.ndarray:
+    # Flat indices of the cells within one cell of the bounds of a geometry, marked with a 2d difference array
+    b = shapely.bounds(geometries)
+    c_min = np.clip(np.floor((b[:, 0] - x_left) / grid_cell_size) - 1, 0, n_cols).astype(np.intp)
+    c_max = np.clip(np.floor((b[:, 2] - x_left) / grid_cell_size) + 1, -1, n_cols - 1).astype(np.intp)
+    r_min = np.clip(np.floor((y_upper - b[:, 3]) / grid_cell_size) - 1, 0, n_rows).astype(np.intp)
+    r_max = np.clip(np.floor((y_upper - b[:, 1]) / grid_cell_size) + 1, -1, n_rows - 1).astype(np.intp)
+    keep = (c_min <= c_max) & (r_min <= r_max)
+    c_min, c_max, r_min, r_max = c_min[keep], c_max[keep], r_min[keep], r_max[keep]
+
+    diff = np.zeros((n_rows + 1, n_cols + 1), dtype=np.int32)
+    np.add.at(diff, (r_min, c_min), 1)
+    np.add.at(diff, (r_min, c_max + 1), -1)
+    np.add.at(diff, (r_max + 1, c_min), -1)
+    np.add.at(diff, (r_max + 1, c_max + 1), 1)
+    covered = np.cumsum(np.cumsum(diff, axis=0), axis=1)[:n_rows, :n_cols] > 0
+    return np.flatnonzero(covered)
+
+
+def cells_inside(geometries, x_left: float, y_upper: float, grid_cell_size: float, n_rows: int, n_cols: int, chunk_cells: int=1 << 20) -> np.ndarray:
+    # Flat indices of the cells with their center inside a polygon, these intersect it without building a cell polygon
+    polygons = geometries[np.isin(shapely.get_type_id(geometries), (3, 6))]
+    if not len(polygons):
+        return np.empty(0, dtype=np.intp)
+    shapely.prepare(polygons)
+
+    # Cell centers inside the bounds of every polygon
+    b = shapely.bounds(polygons)
+    c_min = np.clip(np.ceil((b[:, 0] - x_left) / grid_cell_size - .5), 0, n_cols).astype(np.intp)
+    c_max = np.clip(np.floor((b[:, 2] - x_left) / grid_cell_size - .5), -1, n_cols - 1).astype(np.intp)
+    r_min = np.clip(np.ceil((y_upper - b[:, 3]) / grid_cell_size - .5), 0, n_rows).astype(np.intp)
+    r_max = np.clip(np.floor((y_upper - b[:, 1]) / grid_cell_size - .5), -1, n_rows - 1).astype(np.intp)
+    n_c = np.maximum(c_max - c_min + 1, 0)
+    n_cells = n_c * np.maximum(r_max - r_min + 1, 0)
+
+    # (polygon, cell) pairs tested chunk_cells at a time
+    ends = np.cumsum(n_cells)
+    hits = []
+    first = 0
+    while first < len(polygons):
+        done = ends[first - 1] if first else 0
+        last = max(int(np.searchsorted(ends, done + chunk_cells, side='right')), first + 1)
+        n = n_cells[first:last]
+        idx = np.repeat(np.arange(first, last), n)
+        k = np.arange(len(idx)) - np.repeat(np.cumsum(n) - n, n)
+        cols = c_min[idx] + k % n_c[idx]
+        rows = r_min[idx] + k // n_c[idx]
+        inside = shapely.contains_xy(polygons[idx], x_left + (cols + .5)*grid_cell_size, y_upper - (rows + .5)*grid_cell_size)
+        hits.append(rows[inside]*n_cols + cols[inside])
+        first = last
+    return np.concatenate(hits)
+
+
+def rasterize_fishnet(geometries, x_left: float, y_upper: float, grid_cell_size: float, n_rows: int, n_cols: int, chunk_cells: int=65536, value: int=1, arr=None) -> np.ndarray:
+    """
+    (n_rows, n_cols) uint8 array with value in every cell intersecting one of geometries, 0 elsewhere.
+
+    Cells with their center inside a polygon are hits without a geometry test, the other cells near a geometry
+    get a polygon and are queried in bulk chunk_cells at a time against an STRtree of geometries,
+    the hits are written straight into the array.
+    """
+    if arr is None:
+        arr = np.zeros((n_rows, n_cols), dtype=np.uint8)
+    # A cell intersects a multi part geometry when it intersects one of its parts, parts have tighter bounds
+    geometries = shapely.get_parts(np.asarray(geometries, dtype=object))
+    geometries = geometries[~shapely.is_empty(geometries)]
+    if not len(geometries):
+        return arr
+    tree = shapely.STRtree(geometries)
+
+    flat = arr.reshape(-1)
+    flat[cells_inside(geometries, x_left, y_upper, grid_cell_size, n_rows, n_cols)] = value
+    candidates = candidate_cells(geometries, x_left, y_upper, grid_cell_size, n_rows, n_cols)
+    candidates = candidates[flat[candidates] != value]
+    for start in range(0, len(candidates), chunk_cells):
+        idx = candidates[start:start + chunk_cells]
+        cells = fishnet_cells(x_left, y_upper, grid_cell_size, idx // n_cols, idx % n_cols)
+        hit = tree.query(cells, predicate='intersects')[0]
+        flat[idx[hit]] = value
+    return arr
+
+
+def mask_circle(arr: np.ndarray, x_left: float, y_upper: float, grid_cell_size: float, center_x: float, center_y: float, radius: float, nodata: int=99) -> np.ndarray:
+    # Cells not touching the circle get nodata, distance from the center to the nearest point of every cell
+    n_rows, n_cols = arr.shape
+    dx = np.abs(x_left + (np.arange(n_cols) + .5)*grid_cell_size - center_x) - grid_cell_size/2
+    dy = np.abs(y_upper - (np.arange(n_rows) + .5)*grid_cell_size - center_y) - grid_cell_size/2
+    outside = np.add.outer(np.maximum(dy, 0)**2, np.maximum(dx, 0)**2) > radius**2
+    arr[outside] = nodata
+    return arr
+
+
 def fishnet_helper_rectangle(center_x: 'longitude', center_y: 'latitude', height: 'float meters', width: 'float meters', grid_cell_size: 'float meters') -> gpd.GeoDataFrame:
     px, py = project_xy(
         x=center_x,
@@ -207,16 +304,13 @@ def fishnet_helper_circle(center_x: 'longitude', center_y: 'latitude', radius: '
 
 def parameterize_fishnet(fishnet_df: gpd.GeoDataFrame, parameter_df: gpd.GeoDataFrame):
     
-    # Create pixel value column
-    fishnet_df['pxvalue'] = 0
-
-    joined_df = gpd.sjoin(fishnet_df, parameter_df, how="left", op='intersects')
-    joined_df = joined_df[~joined_df.index_right.isna()]
-    joined_df = joined_df.reset_index()
-    joined_df['left_idx'] = joined_df['index']
-    joined_df = joined_df[['left_idx']]
-    joined_df = joined_df.drop_duplicates(subset=['left_idx'])
-    fishnet_df.loc[joined_df.left_idx.values, 'pxvalue'] = 1
+    # Create pixel value column, one bulk spatial index query instead of a join
+    pxvalue = np.zeros(len(fishnet_df), dtype=np.uint8)
+    if len(parameter_df):
+        parameter_df = parameter_df.to_crs(fishnet_df.crs)
+        hit = shapely.STRtree(parameter_df.geometry.values).query(fishnet_df.geometry.values, predicate='intersects')[0]
+        pxvalue[hit] = 1
+    fishnet_df['pxvalue'] = pxvalue
 
     return fishnet_df
 
@@ -258,4 +352,32 @@ def save_raster(raster_path: str, parameterized_fishnet_df: gpd.GeoDataFrame) ->
     return True
 
 
+def fishnet_geotransform(x_left: float, y_upper: float, grid_cell_size: float, n_rows: int, n_cols: int, crs: int=4326) -> tuple:
+    # GDAL geotransform of a 3857 fishnet georeferenced in crs by the bounds of its corners like save_raster,
+    # exact for 3857, the rows of 4326 are spaced evenly in latitude and only approximate the 3857 cells
+    if crs == 3857:
+        return (x_left, grid_cell_size, 0, y_upper, 0, -grid_cell_size)
+    xmin, ymax = project_xy(x_left, y_upper, 3857, crs)
+    xmax, ymin = project_xy(x_left + n_cols*grid_cell_size, y_upper - n_rows*grid_cell_size, 3857, crs)
+    return (xmin, (xmax - xmin)/float(n_cols), 0, ymax, 0, -(ymax - ymin)/float(n_rows))
+
+
+def save_raster_array(raster_path: str, arr: np.ndarray, geotransform: tuple, crs: int=4326, nodata: int=99) -> bool:
+
+    if not '.tif' in raster_path.lower():
+        raster_path+='.tif'
+
+    # Create TIFF
+    nrows, ncols = arr.shape
+    driver = gdal.GetDriverByName('GTiff')
+    output_raster = driver.Create(raster_path, ncols, nrows, 1 , gdal.GDT_Byte, options=['COMPRESS=LZW'])
+    output_raster.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(crs)
+    output_raster.SetProjection(srs.ExportToWkt())
+    band = output_raster.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(arr)
+    output_raster.FlushCache()
 
+    return True
@@ -0,0 +1,147 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from postgis2raster import aio, config
+from postgis2raster.metadata import metadata_cache
+from postgis2raster.sources import MemorySource
+
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+
+
+class FakeCursor:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def execute(self, sql, params=None):
+        self.pool.statements.append((sql, params))
+        self.pool.running += 1
+        self.pool.max_running = max(self.pool.max_running, self.pool.running)
+        await asyncio.sleep(0.01)
+        self.pool.running -= 1
+
+    async def fetchall(self):
+        return self.pool.rows
+
+    async def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self):
+        return FakeCursor(self.pool)
+
+
+class FakePool:
+    """psycopg_pool.AsyncConnectionPool of the statements run and the most running at the same time"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+        self.running = self.max_running = 0
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def connection(self):
+        pool = self
+
+        class Connection:
+            async def __aenter__(self):
+                return FakeConnection(pool)
+
+            async def __aexit__(self, *exc_info):
+                return False
+        return Connection()
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    def make(rows, max_in_flight):
+        pool = FakePool(rows)
+        monkeypatch.setattr(aio, '_pool', pool)
+        monkeypatch.setattr(aio, '_slots', asyncio.BoundedSemaphore(max_in_flight))
+        return pool
+    return make
+
+
+def test_query_db_async_back_pressure(fake_pool):
+    pool = fake_pool([(1,)], max_in_flight=2)
+
+    async def run():
+        return await asyncio.gather(*(aio.query_db_async('SELECT 1') for _ in range(6)))
+
+    assert asyncio.run(run()) == [[(1,)]]*6
+    assert len(pool.statements) == 6
+    assert pool.max_running == 2
+
+
+def test_get_table_metadata_async_cache(fake_pool, monkeypatch):
+    monkeypatch.setattr(config, 'dsn', 'postgresql://test@localhost/aio')
+    pool = fake_pool([(3857, 'LINESTRING', 0, 0, 1, 1, 10, 1, 2, 3)], max_in_flight=1)
+    try:
+        metadata = asyncio.run(aio.get_table_metadata_async('roads'))
+        assert metadata.srid == 3857 and metadata.stamp == (1, 2, 3)
+        assert asyncio.run(aio.get_table_metadata_async('roads')) == metadata
+        assert len(pool.statements) == 1
+
+        # Expired, kept when the stamp did not change
+        monkeypatch.setattr(metadata_cache, 'ttl', 0)
+        pool.rows = [(1, 2, 3)]
+        assert asyncio.run(aio.get_table_metadata_async('roads')) == metadata
+        assert len(pool.statements) == 2
+    finally:
+        metadata_cache.invalidate(table='roads', dsn=config.dsn)
+
+
+@pytest.mark.parametrize('arguments, message', [
+    (dict(engine='numpy'), "'fishnet' or 'burn'"),
+    (dict(engine='pyramid'), "'fishnet' or 'burn'"),
+    (dict(statistics=['count'], classes_to_bands=True), 'classes_to_bands'),
+])
+def test_analysis_polygon_async_arguments(arguments, message):
+    with pytest.raises(ValueError, match=message):
+        asyncio.run(aio.analysis_polygon_async(table='roads', output_raster=None, as_array=True, **arguments, **QUERY))
+
+
+def test_analysis_polygon_async_sources():
+    with pytest.raises(ValueError, match='PostGIS tables'):
+        asyncio.run(aio.analysis_polygon_async(table=MemorySource([], srid=3857), output_raster=None, as_array=True, **QUERY))
+
+
+def test_configure_async_pool(monkeypatch):
+    for name in ('async_pool_min_size', 'async_pool_max_size', 'async_max_in_flight'):
+        monkeypatch.setattr(config, name, getattr(config, name))
+    asyncio.run(aio.configure_async_pool(min_size=2, max_size=8, max_in_flight=3))
+    assert (config.async_pool_min_size, config.async_pool_max_size, config.async_max_in_flight) == (2, 8, 3)
+    assert aio._pool is None
+
+
+def test_analysis_polygon_async(make_table):
+    pytest.importorskip('psycopg')
+    pytest.importorskip('psycopg_pool')
+    shapely = pytest.importorskip('shapely')
+    import postgis2raster
+
+    table = make_table([('road', shapely.to_wkb(shapely.LineString([(77.2085, 28.6135), (77.2095, 28.6145)])))], srid=4326)
+
+    async def run():
+        await aio.configure_async_pool(min_size=1, max_size=2)
+        try:
+            return await asyncio.gather(*(
+                aio.analysis_polygon_async(table=table, output_raster=None, as_array=True, engine=engine, **QUERY)
+                for engine in ('fishnet', 'burn')
+            ))
+        finally:
+            await aio.close_async_pool()
+
+    expected = postgis2raster.analysis_polygon(table=table, output_raster=None, as_array=True, **QUERY).array
+    for result in asyncio.run(run()):
+        assert np.array_equal(result.array, expected)
@@ -0,0 +1,60 @@
+import os
+import re
+
+import psycopg2
+import pytest
+
+from postgis2raster import batch
+
+
+class FakeConnection:
+    autocommit = True
+    closed = 0
+
+
+@pytest.fixture
+def fake_stream(monkeypatch):
+    """batch statements of the query points in failing raise, the others return a raster per point"""
+    statements, failing = [], set()
+
+    def stream_db(sql, connection, batch_size=None):
+        idxs = [int(idx) for idx in re.findall(r'(?:VALUES|^)\s*\((\d+), ', sql, flags=re.MULTILINE)]
+        statements.append(idxs)
+        if failing.intersection(idxs):
+            raise psycopg2.DataError(f'bad geometry of {sorted(failing.intersection(idxs))}')
+        yield [(idx, b'II*\x00', None, None) for idx in idxs]
+
+    monkeypatch.setattr(batch, 'get_srid', lambda table, geom_column, connection: 3857)
+    monkeypatch.setattr(batch, 'stream_db', stream_db)
+    return statements, failing
+
+
+def run(tmp_path, n, **kwargs):
+    paths = [str(tmp_path / f'r{i}.tif') for i in range(n)]
+    return paths, batch.analysis_batch(
+        table='roads', output_rasters=paths, query_x=[77.2 + i*1e-3 for i in range(n)], query_y=n*[28.6],
+        height=200, width=200, cell_size=10, connection=FakeConnection(), **kwargs
+    )
+
+
+def test_failing_point_bisected(tmp_path, fake_stream):
+    statements, failing = fake_stream
+    failing.add(5)
+    paths, results = run(tmp_path, 8, chunk_size=8)
+    assert [r is True for r in results] == [i != 5 for i in range(8)]
+    assert isinstance(results[5], psycopg2.DataError)
+    # The chunk, then halves of the pending points down to the failing one
+    assert statements == [list(range(8)), [0, 1, 2, 3], [4, 5, 6, 7], [4, 5], [4], [5], [6, 7]]
+    assert sorted(os.listdir(tmp_path)) == sorted(f'r{i}.tif' for i in range(8) if i != 5)
+
+
+def test_write_error_fails_its_point(tmp_path, fake_stream):
+    statements, _ = fake_stream
+    paths = [str(tmp_path / 'r0.tif'), str(tmp_path / 'missing' / 'r1.tif'), str(tmp_path / 'r2.tif')]
+    results = batch.analysis_batch(
+        table='roads', output_rasters=paths, query_x=[77.2, 77.3, 77.4], query_y=28.6,
+        height=200, width=200, cell_size=10, connection=FakeConnection()
+    )
+    assert results[0] is True and results[2] is True
+    assert isinstance(results[1], FileNotFoundError)
+    assert len(statements) == 1
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from compare_runs import case_key, compare
+from run_suite import percentile, query_points, summary
+from synthetic_data import CENTER, synthetic_sql, table_name
+
+
+def test_percentile():
+    values = [4, 1, 3, 2]
+    assert percentile(values, 0) == 1 and percentile(values, 1) == 4
+    # Linear between the closest ranks
+    assert percentile(values, .5) == 2.5
+    assert percentile([7], .99) == 7
+
+
+def test_summary():
+    s = summary([1., 2., 3., 4., 10.])
+    assert s['n'] == 5 and s['mean'] == 4. and s['p50'] == 3. and s['max'] == 10.
+
+
+def test_query_points_reproducible():
+    points = query_points(20, 40, seed=3)
+    assert points == query_points(20, 40, seed=3) and points != query_points(20, 40, seed=4)
+    # Inner half of the synthetic extent
+    assert all(abs(x - CENTER[0]) <= 10/111.32 and abs(y - CENTER[1]) <= 10/110.57 for x, y in points)
+
+
+def test_compare_regressions():
+    def run(p50):
+        case = {'engine': 'burn', 'radius': 1000}
+        return {case_key(case): {'case': case, 'latency_s': {'p50': p50, 'p90': p50*2}}}
+    rows = compare(run(.100), run(.125), threshold=.1)
+    assert [row[1] for row in rows] == ['p50', 'p90'] and all(row[-1] for row in rows)
+    assert not any(row[-1] for row in compare(run(.100), run(.105), threshold=.1))
+    # Cases of only one run are not compared
+    assert compare({}, run(.1)) == []
+
+
+def test_synthetic_sql():
+    name = table_name('roads', 12.5, 20, 40)
+    assert name == 'bench_roads_12_5_20_40'
+    sql = synthetic_sql(name, kind='roads', density=12.5, classes=20, extent_km=40)
+    assert f"CREATE TABLE public.{name}" in sql and 'USING gist (wkb_geometry)' in sql
+
+
+def test_synthetic_table(postgis_dsn):
+    import psycopg2
+    from synthetic_data import create_table
+
+    name = create_table(postgis_dsn, 'landuse', density=1, classes=3, extent_km=2)
+    con = psycopg2.connect(postgis_dsn)
+    con.autocommit = True
+    cur = con.cursor()
+    try:
+        cur.execute(f"SELECT count(*), count(DISTINCT fclass), min(ST_SRID(wkb_geometry)) FROM public.{name}")
+        n, classes, srid = cur.fetchone()
+        assert n == 4 and classes <= 3 and srid == 4326
+    finally:
+        cur.execute(f"DROP TABLE public.{name}")
+        con.close()
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+import postgis2raster
+from postgis2raster.cache import ResultCache, request_key
+from postgis2raster.raster_wkb import RasterArray
+
+PARAMETERS = dict(
+    table='roads', output_raster='out.tif', query_x=77.2, query_y=28.6, height=200, width=200, cell_size=10,
+    classes=['primary', 'secondary'], class_column='fclass', positive=1, negative=0, nodata=254, engine='burn',
+)
+
+
+def key(version=(1, 2, 3), dsn='postgresql://db', **changes):
+    return request_key(dict(PARAMETERS, **changes), version, dsn=dsn)
+
+
+def test_key_numbers():
+    # 30 and 30.0 or numpy scalars are the same request
+    assert key(cell_size=10) == key(cell_size=10.0) == key(cell_size=np.float32(10)) == key(cell_size=np.int64(10))
+    assert key(positive=[1, 2]) == key(positive=(1.0, 2.0))
+    assert key(cell_size=10) != key(cell_size=10.5)
+
+
+def test_key_booleans_are_not_numbers():
+    assert key(classes_to_bands=True) != key(classes_to_bands=1)
+    assert key(circle=False) != key(circle=0)
+
+
+def test_key_classes_order():
+    assert key(classes=['secondary', 'primary']) == key(classes=['primary', 'secondary'])
+    # Compared as text like the class column
+    assert key(classes=[1, 2]) == key(classes=['2', '1'])
+    assert key(classes=None) != key(classes=[])
+
+
+def test_key_ignored_parameters():
+    assert key(output_raster='a.tif', batch_size=10, tile_size=256, max_workers=4, as_array=True, subdivide=True) == key()
+
+
+def test_key_version_and_database():
+    assert key() != key(positive=2)
+    assert key(version=(1, 2, 4)) != key()
+    assert key(dsn='postgresql://other') != key()
+    assert key(version='v1') != key(version='v2')
+
+def test_analysis_cache_miss_then_hit():
+    shapely = pytest.importorskip('shapely')
+    source = postgis2raster.MemorySource([shapely.Point(77.2, 28.6).buffer(0.0003)], srid=4326)
+    cache = ResultCache()
+    kwargs = dict(table=source, output_raster=None, query_x=77.2, query_y=28.6, height=200, width=200, cell_size=10, as_array=True)
+
+    first = postgis2raster.analysis_polygon(cache=cache, **kwargs)
+    second = postgis2raster.analysis_polygon(cache=cache, **kwargs)
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 1
+    assert np.array_equal(second.array, first.array)
+    assert first.array.flags.writeable and not second.array.flags.writeable
+    assert np.array_equal(first.array, postgis2raster.analysis_polygon(**kwargs).array)
+
+
+def test_array_lru():
+    raster = FakeRaster()
+    cache = ResultCache(max_array_bytes=2*raster.array.nbytes)
+    for name in 'abc':
+        cache.put_array(name, FakeRaster())
+    assert cache.get_array('a') is None and cache.get_array('c') is not None
+    assert cache.stats()['evictions'] == 1
+    # Cached arrays are read only copies, the array put stays writable
+    raster = FakeRaster()
+    cache.put_array('d', raster)
+    assert not cache.get_array('d').array.flags.writeable
+    assert raster.array.flags.writeable
+    raster.array[:] = 1
+    assert not cache.get_array('d').array.any()
+
+
+def test_file_cache(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    output = tmp_path / 'out.tif'
+    output.write_bytes(b'raster')
+    cache.put_file('k', str(output))
+    copy = tmp_path / 'copy.tif'
+    assert cache.get_file('k', str(copy)) and copy.read_bytes() == b'raster'
+    assert not cache.get_file('missing', str(copy))
+    # The index is read back from the directory
+    assert ResultCache(str(tmp_path / 'cache')).stats()['files'] == 1
+
+
+def test_file_cache_shared_directory(tmp_path):
+    import os
+    import time
+
+    directory = str(tmp_path / 'cache')
+    first, second = ResultCache(directory, max_bytes=12), ResultCache(directory, max_bytes=12)
+    output = tmp_path / 'out.tif'
+    output.write_bytes(b'raster')
+    first.put_file('a', str(output))
+    # Cached by the other process, found on disk
+    copy = tmp_path / 'copy.tif'
+    assert second.get_file('a', str(copy)) and copy.read_bytes() == b'raster'
+    # Older than the hit above, the entries of both caches count against max_bytes
+    past = time.time() - 60
+    first.put_file('b', str(output))
+    os.utime(os.path.join(directory, 'b.tif'), (past, past))
+    second.put_file('c', str(output))
+    assert sorted(os.listdir(directory)) == ['a.tif', 'c.tif']
+    assert not first.get_file('b', str(copy))
+    # Evicted by the other process
+    os.remove(os.path.join(directory, 'a.tif'))
+    assert not first.get_file('a', str(copy))
+    assert ResultCache(directory).stats()['files'] == 1
+
+
+def FakeRaster():
+    return RasterArray(np.zeros((1, 2, 2), dtype=np.uint8), None, 'EPSG:3857', 254, None)
+
+
+def test_table_stamp_read_every_call(monkeypatch):
+    # The stamp comes from the table on every call, not from the metadata cache
+    from contextlib import nullcontext
+    from postgis2raster import cache as cache_module
+
+    stamps = iter([(1, 1, 10), (1, 1, 10), (1, 1, 11)])
+    monkeypatch.setattr(cache_module, 'borrow_connection', lambda connection: nullcontext(connection))
+    monkeypatch.setattr(cache_module, '_fetch_stamp', lambda con, schema, table: next(stamps))
+    calls = []
+
+    def analysis(**parameters):
+        calls.append(parameters)
+        return FakeRaster()
+
+    cache = ResultCache()
+    parameters = dict(table='roads', output_raster=None, cell_size=10, as_array=True, connection=None)
+    for _ in range(3):
+        cache_module.cached_analysis(cache, analysis, parameters)
+    assert len(calls) == 2
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+
+def test_table_change_is_a_miss(make_table):
+    import time
+    shapely = pytest.importorskip('shapely')
+    from postgis2raster.metadata import _fetch_stamp
+    from postgis2raster.pool import borrow_connection
+
+    point = shapely.Point(77.2, 28.6)
+    table = make_table([('road', shapely.to_wkb(point.buffer(0.0003)))], srid=4326)
+    cache = ResultCache()
+    kwargs = dict(table=table, output_raster=None, query_x=77.2, query_y=28.6, height=200, width=200, cell_size=10, engine='burn', as_array=True)
+    postgis2raster.analysis_polygon(cache=cache, **kwargs)
+    # Warms the metadata cache too
+    postgis2raster.analysis_polygon(cache=cache, **kwargs)
+
+    with borrow_connection() as con:
+        before = _fetch_stamp(con, 'public', table)
+        con.cursor().execute(f"INSERT INTO public.{table} (fclass, wkb_geometry) VALUES ('rail', ST_GeomFromText('POINT(77.2 28.6)', 4326))")
+        # The statistics collector publishes the counters with a delay
+        deadline = time.monotonic() + 10
+        while _fetch_stamp(con, 'public', table) == before and time.monotonic() < deadline:
+            time.sleep(.2)
+    postgis2raster.analysis_polygon(cache=cache, **kwargs)
+    assert cache.stats()['misses'] == 2 and cache.stats()['hits'] == 1
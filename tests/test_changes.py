@@ -0,0 +1,160 @@
+import re
+
+import pytest
+
+from postgis2raster import changes
+from postgis2raster.changes import (
+    _feature_sql, changed_aois, disable_change_tracking, enable_change_tracking, latest_change, prune_changes, record_changes
+)
+
+
+def test_feature_sql_identifiers():
+    sql = _feature_sql('Roads', 'the geom', 'Road Class', 'osm')
+    assert 'md5(ST_AsEWKB(t."the geom")::text || COALESCE(t."Road Class"::text, \'\')) AS hash' in sql
+    assert '"osm"."Roads" t' in sql
+    assert 't."the geom" IS NOT NULL' in sql
+    # Classes ignored
+    assert "|| '') AS hash" in _feature_sql('roads', 'wkb_geometry', None, 'public')
+
+
+def test_snapshot_table_name():
+    assert changes.snapshot_table_name('Roads', 'osm data') == '"osm data"."Roads_changes_snapshot"'
+    assert changes.snapshot_table_name('roads"x') == '"public"."roads""x_changes_snapshot"'
+
+
+def test_enable_change_tracking_method():
+    with pytest.raises(ValueError, match="'trigger' or 'snapshot'"):
+        enable_change_tracking('roads', method='replication', connection=object())
+
+
+class FakeQueries:
+    """changes.query_db of a change log with changes at the xmin of changed, every AOI row is (idx, since, xmin, ymin, xmax, ymax)"""
+
+    def __init__(self, changed, log=True):
+        self.changed, self.log = changed, log
+        self.statements = []
+
+    def __call__(self, sql, connection=None, params=None):
+        self.statements.append((sql, params))
+        if 'to_regclass' in sql:
+            return [('public.postgis2raster_changes' if self.log else None,)]
+        rows = re.findall(r'\((\d+), (\d+), ([-\d.]+),', sql)
+        return [(int(idx),) for idx, _, xmin in rows if float(xmin) in self.changed]
+
+
+def test_changed_aois(monkeypatch):
+    aois = {f'aoi_{i}': (i, 0, i + 1, 1) for i in range(5)}
+    queries = FakeQueries({1, 3})
+    monkeypatch.setattr(changes, 'query_db', queries)
+
+    assert changed_aois('roads', aois, 3857, since={'aoi_1': 7}, chunk_size=2, connection=object()) == {'aoi_1', 'aoi_3'}
+    # One statement per chunk of AOIs after the log lookup, every AOI with its watermark and envelope
+    statements = queries.statements[1:]
+    assert len(statements) == 3
+    assert '(2, 0, 2.0, 0.0, 3.0, 1.0)' in statements[1][0]
+    assert '(1, 7, 1.0, 0.0, 2.0, 1.0)' in statements[0][0]
+    assert all(params == ('public', 'roads') for _, params in statements)
+    assert 'ST_MakeEnvelope(a.xmin, a.ymin, a.xmax, a.ymax, 3857)' in statements[0][0]
+    # Watermarks are snapshot xmins, changes of transactions from it on count
+    assert 'c.txid >= a.since' in statements[0][0]
+
+
+def test_changed_aois_without_log(monkeypatch):
+    queries = FakeQueries({0}, log=False)
+    monkeypatch.setattr(changes, 'query_db', queries)
+    assert changed_aois('roads', {'a': (0, 0, 1, 1)}, 3857, connection=object()) == set()
+    assert len(queries.statements) == 1
+
+
+@pytest.fixture
+def tracked(make_table):
+    """make_table with change tracking of method, its tracking and changes are dropped after the test"""
+    names = []
+
+    def make(rows, method):
+        table = make_table(rows)
+        enable_change_tracking(table, method=method)
+        names.append(table)
+        return table
+
+    yield make
+    for table in names:
+        disable_change_tracking(table)
+        prune_changes(table, latest_change(table))
+
+
+def box(xmin, ymin, xmax, ymax):
+    shapely = pytest.importorskip('shapely')
+    return shapely.to_wkb(shapely.box(xmin, ymin, xmax, ymax))
+
+
+def test_trigger_tracking(tracked, postgis):
+    import psycopg2
+
+    table = tracked([('forest', box(0, 0, 10, 10)), ('farmland', box(100, 0, 110, 10))], method='trigger')
+    aois = {'west': (-5, -5, 15, 15), 'east': (95, -5, 115, 15), 'north': (0, 500, 10, 510)}
+    assert latest_change(table) == 0
+    assert changed_aois(table, aois, 3857) == set()
+
+    con = psycopg2.connect(postgis)
+    con.autocommit = True
+    cur = con.cursor()
+    cur.execute(f"UPDATE public.{table} SET fclass = 'park' WHERE fclass = 'forest'")
+    watermark = latest_change(table)
+    # Old and new envelope of the updated row
+    assert watermark > 0
+    assert changed_aois(table, aois, 3857) == {'west'}
+    assert changed_aois(table, aois, 3857, since=watermark) == set()
+
+    cur.execute(f"DELETE FROM public.{table} WHERE fclass = 'farmland'")
+    assert changed_aois(table, aois, 3857, since={'west': latest_change(table), 'east': watermark, 'north': 0}) == {'east'}
+    # Every AOI after a truncate
+    cur.execute(f"TRUNCATE public.{table}")
+    assert changed_aois(table, aois, 3857, since=watermark) == set(aois)
+    con.close()
+    assert record_changes(table) == 0
+
+
+def test_snapshot_tracking(tracked, postgis):
+    import psycopg2
+
+    table = tracked([('forest', box(0, 0, 10, 10)), ('farmland', box(100, 0, 110, 10))], method='snapshot')
+    aois = {'west': (-5, -5, 15, 15), 'east': (95, -5, 115, 15)}
+    assert record_changes(table) == 0
+
+    # An import replacing every row, only the changed feature is recorded
+    con = psycopg2.connect(postgis)
+    con.autocommit = True
+    cur = con.cursor()
+    cur.execute(f"DELETE FROM public.{table}")
+    cur.execute(
+        f"INSERT INTO public.{table} (fclass, wkb_geometry) VALUES ('forest', ST_SetSRID(ST_GeomFromWKB(%s), 3857)), ('farmland', ST_SetSRID(ST_GeomFromWKB(%s), 3857))",
+        (psycopg2.Binary(box(0, 0, 10, 10)), psycopg2.Binary(box(100, 0, 120, 10)))
+    )
+    con.close()
+    # Old feature deleted, new one inserted
+    assert record_changes(table) == 2
+    assert changed_aois(table, aois, 3857) == {'east'}
+    watermark = latest_change(table)
+    assert record_changes(table) == 0
+    assert changed_aois(table, aois, 3857, since=watermark) == set()
+    assert prune_changes(table, watermark) == 2
+
+
+def test_watermark_of_concurrent_transactions(tracked, postgis):
+    import psycopg2
+
+    table = tracked([('forest', box(0, 0, 10, 10))], method='trigger')
+    aois = {'west': (-5, -5, 15, 15), 'east': (95, -5, 115, 15)}
+    slow, fast = psycopg2.connect(postgis), psycopg2.connect(postgis)
+    fast.autocommit = True
+    try:
+        # The slow import draws its change id first and commits last
+        slow.cursor().execute(f"INSERT INTO public.{table} (fclass, wkb_geometry) VALUES ('farmland', ST_GeomFromText('POINT(100 0)', 3857))")
+        fast.cursor().execute(f"UPDATE public.{table} SET fclass = 'park' WHERE fclass = 'forest'")
+        watermark = latest_change(table)
+        slow.commit()
+        assert 'east' in changed_aois(table, aois, 3857, since=watermark)
+    finally:
+        slow.close()
+        fast.close()
@@ -0,0 +1,174 @@
+import csv
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from postgis2raster import batch, cli, config
+
+
+def write_manifest(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['id', 'query_x', 'query_y', 'radius', 'cell_size', 'classes'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_manifest_items():
+    items = cli.manifest_items([
+        dict(id='a', query_x='77.2', query_y='28.6', radius='100', cell_size='', classes='primary; secondary'),
+        dict(id='', query_x='77.3', query_y='28.7', height='200', width='', classes=''),
+    ], cell_size=10, classes=['track'])
+    assert items[0] == dict(id='a', query_x=77.2, query_y=28.6, circle=True, height=200, width=200, cell_size=10, classes=['primary', 'secondary'])
+    assert items[1] == dict(id='1', query_x=77.3, query_y=28.7, circle=False, height=200, width=200, cell_size=10, classes=['track'])
+
+
+@pytest.mark.parametrize('rows, message', [
+    ([dict(id='a', radius='1', cell_size='1'), dict(id='a', radius='1', cell_size='1')], 'duplicate id'),
+    ([dict(id=os.path.join('..', 'a'), radius='1', cell_size='1')], 'path separator'),
+    ([dict(id='a', cell_size='1')], 'needs radius'),
+    ([dict(id='a', radius='1', cell_size='')], 'needs cell_size'),
+])
+def test_manifest_items_errors(rows, message):
+    with pytest.raises(ValueError, match=message):
+        cli.manifest_items(rows)
+
+
+def test_read_checkpoint(tmp_path):
+    path = tmp_path / 'checkpoint.jsonl'
+    assert cli.read_checkpoint(str(path)) == {}
+    path.write_text(
+        '{"id": "a", "status": "done"}\n'
+        '{"id": "b", "status": "failed", "error": "x"}\n'
+        '{"id": "c", "status": "done"}\n'
+        '{"id": "c", "status": "failed", "error": "x"}\n'
+        '{"id": "b", "status": "done", "change": 7}\n'
+        '{"id": "d", "status": "failed", "error": "x"}\n'
+        '{"id": "e", "sta'
+    )
+    # The last record of a row counts, the torn last line of an interrupted run is ignored
+    assert cli.read_checkpoint(str(path)) == {'a': {'id': 'a', 'status': 'done'}, 'b': {'id': 'b', 'status': 'done', 'change': 7}}
+    assert set(cli.read_checkpoint(str(path), skip_failed=True)) == {'a', 'b', 'c', 'd'}
+
+
+@pytest.fixture
+def fake_batch(monkeypatch):
+    """analysis_batch writing a raster (and band mapping) for every query point but those of query_x in failing"""
+    calls, failing = [], set()
+
+    def analysis_batch(output_rasters, query_x, classes=None, classes_to_bands=False, **kwargs):
+        calls.append(dict(output_rasters=output_rasters, query_x=query_x, classes=classes, **kwargs))
+        outcomes = []
+        for path, x in zip(output_rasters, query_x):
+            with open(path, 'wb') as f:
+                f.write(b'II*\x00')
+            if classes_to_bands:
+                with open(f"{path}.classes_to_bands_mapping.csv", 'w') as f:
+                    f.write('band,class\n')
+            outcomes.append(ValueError(f'no data at {x}') if x in failing else True)
+        return outcomes
+
+    monkeypatch.setattr(batch, 'analysis_batch', analysis_batch)
+    return calls, failing
+
+
+def test_run_chunk(tmp_path, fake_batch):
+    calls, failing = fake_batch
+    failing.add(2.0)
+    items = cli.manifest_items([
+        dict(id='a', query_x='1', query_y='0', radius='5', classes='x'),
+        dict(id='b', query_x='2', query_y='0', radius='5', classes='x'),
+        dict(id='c', query_x='3', query_y='0', height='10', classes=''),
+    ], cell_size=1)
+    results = cli.run_chunk(items, str(tmp_path), dict(table='roads', classes_to_bands=True))
+    assert results == [('a', None), ('b', 'ValueError: no data at 2.0'), ('c', None)]
+    # One call per (circle, classes) group
+    assert [(call['circle'], call['classes']) for call in calls] == [(True, ['x']), (False, None)]
+    # Rasters renamed with their band mapping, nothing left of the failed one
+    assert sorted(os.listdir(tmp_path)) == ['a.tif', 'a.tif.classes_to_bands_mapping.csv', 'c.tif', 'c.tif.classes_to_bands_mapping.csv']
+
+
+def test_run_chunk_failed_batch(tmp_path, monkeypatch):
+    def analysis_batch(**kwargs):
+        raise RuntimeError('server closed the connection')
+    monkeypatch.setattr(batch, 'analysis_batch', analysis_batch)
+    items = cli.manifest_items([dict(id='a', query_x='1', query_y='0'), dict(id='b', query_x='2', query_y='0')], cell_size=1, radius=5)
+    assert cli.run_chunk(items, str(tmp_path), {}) == [(i, 'RuntimeError: server closed the connection') for i in ('a', 'b')]
+    assert os.listdir(tmp_path) == []
+
+
+def test_run_manifest_resume(tmp_path, monkeypatch, fake_batch):
+    calls, failing = fake_batch
+    # Workers in threads of this process, the batch function above is used by run_chunk
+    monkeypatch.setattr(cli, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(cli, '_init_worker', lambda dsn, session_settings: None)
+    manifest = write_manifest(tmp_path / 'manifest.csv', [
+        dict(id=f'r{i}', query_x=str(i), query_y='0', radius='50', cell_size='10', classes='') for i in range(5)
+    ])
+    output_dir = str(tmp_path / 'rasters')
+    kwargs = dict(manifest=manifest, table='roads', output_dir=output_dir, workers=2, chunk_size=2, progress_interval=1000)
+
+    failing.add(3.0)
+    summary = cli.run_manifest(**kwargs)
+    assert {k: summary[k] for k in ('total', 'skipped', 'changed', 'done', 'failed')} == dict(total=5, skipped=0, changed=0, done=4, failed=1)
+    checkpoint = os.path.join(output_dir, config.cli_checkpoint_name)
+    assert sorted((r['id'], r['status']) for r in read_records(checkpoint)) == [
+        ('r0', 'done'), ('r1', 'done'), ('r2', 'done'), ('r3', 'failed'), ('r4', 'done')
+    ]
+    assert calls[0]['table'] == 'roads'
+
+    # Failed rows are skipped with skip_failed, retried otherwise
+    calls.clear()
+    assert cli.run_manifest(skip_failed=True, **kwargs)['skipped'] == 5
+    assert not calls
+    failing.clear()
+    summary = cli.run_manifest(**kwargs)
+    assert (summary['skipped'], summary['done'], summary['failed']) == (4, 1, 0)
+    assert [call['query_x'] for call in calls] == [[3.0]]
+    assert sorted(os.listdir(output_dir)) == sorted([config.cli_checkpoint_name] + [f'r{i}.tif' for i in range(5)])
+    assert cli.read_checkpoint(checkpoint).keys() == {f'r{i}' for i in range(5)}
+
+
+def test_main(monkeypatch):
+    runs = []
+
+    def run_manifest(manifest, **kwargs):
+        runs.append(dict(kwargs, manifest=manifest))
+        return dict(total=3, skipped=1, changed=0, done=1, failed=len(runs) - 1, seconds=1.)
+
+    monkeypatch.setattr(cli, 'run_manifest', run_manifest)
+    argv = ['jobs.csv', '--table', 'roads', '--output-dir', 'out', '--dsn', 'postgresql://localhost/osm',
+            '--set', 'postgis.gdal_enabled_drivers=ENABLE_ALL', '--classes', 'primary', 'secondary', '--engine', 'burn']
+    assert cli.main(argv) == 0
+    assert runs[0]['dsn'] == 'postgresql://localhost/osm'
+    assert runs[0]['session_settings'] == {'postgis.gdal_enabled_drivers': 'ENABLE_ALL'}
+    assert runs[0]['classes'] == ['primary', 'secondary'] and runs[0]['engine'] == 'burn'
+    # Failed rows make the exit status 1
+    assert cli.main(argv) == 1
+    with pytest.raises(SystemExit):
+        cli.main(argv + ['--set', 'no_value'])
+
+
+def test_run_manifest(make_table, postgis_dsn, tmp_path):
+    shapely = pytest.importorskip('shapely')
+    table = make_table([('road', shapely.to_wkb(shapely.LineString([(77.2085, 28.6135), (77.2095, 28.6145)])))], srid=4326)
+    manifest = write_manifest(tmp_path / 'manifest.csv', [
+        dict(id='a', query_x='77.2090', query_y='28.6139', radius='100', cell_size='10', classes=''),
+        dict(id='b', query_x='77.2100', query_y='28.6150', radius='100', cell_size='10', classes='road'),
+    ])
+    output_dir = str(tmp_path / 'rasters')
+    kwargs = dict(manifest=manifest, table=table, output_dir=output_dir, workers=1, dsn=postgis_dsn,
+                  session_settings={'postgis.gdal_enabled_drivers': 'ENABLE_ALL'})
+    summary = cli.run_manifest(**kwargs)
+    assert (summary['done'], summary['failed']) == (2, 0)
+    assert cli.run_manifest(**kwargs)['skipped'] == 2
+    for name in ('a.tif', 'b.tif'):
+        with open(os.path.join(output_dir, name), 'rb') as f:
+            assert f.read(4) in (b'II*\x00', b'MM\x00*')
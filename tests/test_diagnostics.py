@@ -0,0 +1,84 @@
+from contextlib import nullcontext
+
+import pytest
+
+from postgis2raster import diagnostics
+from postgis2raster.metadata import TableMetadata
+
+
+class FakeConnection:
+    autocommit = True
+
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        self.executed.append(sql)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = FakeConnection()
+    metadata = TableMetadata(4326, 'LINESTRING', None, 100, (1, 1, 0), {})
+    queries = []
+
+    def query_db(sql, connection=None, params=None):
+        queries.append(sql)
+        if 'pg_index' in sql:
+            return []
+        if 'pg_stat_user_tables' in sql:
+            return [(None, 0, 100)]
+        return [(10, 5.0, [4, 8, 9], 12)]
+
+    monkeypatch.setattr(diagnostics, 'borrow_connection', lambda connection: nullcontext(connection))
+    monkeypatch.setattr(diagnostics, 'get_table_metadata', lambda *args, **kwargs: metadata)
+    monkeypatch.setattr(diagnostics, 'invalidate_table_metadata', lambda *args, **kwargs: None)
+    monkeypatch.setattr(diagnostics, 'query_db', query_db)
+    connection.queries = queries
+    return connection
+
+
+def test_check_table_quotes_identifiers(connection):
+    report = diagnostics.check_table('My "Roads"', geom_column='Geom', class_column='Road Class', schema='osm', fix=True, connection=connection)
+    assert len(report.issues) == 3
+    assert report.fixed == [
+        'CREATE INDEX CONCURRENTLY ON "osm"."My ""Roads""" USING gist ("Geom")',
+        'CREATE INDEX CONCURRENTLY ON "osm"."My ""Roads""" ("Road Class")',
+        'ANALYZE "osm"."My ""Roads"""',
+    ]
+    assert connection.executed == report.fixed
+    vertices_sql = connection.queries[-1]
+    assert 'ST_NPoints("Geom")' in vertices_sql and 'FROM "osm"."My ""Roads""" TABLESAMPLE' in vertices_sql
+
+
+def test_check_table_without_fix(connection):
+    connection.autocommit = False
+    report = diagnostics.check_table('roads', fix=False, connection=connection)
+    assert report.fixed == [] and connection.executed == []
+    assert report.vertices['p99'] == 9
+
+
+def test_explain_plan(connection, monkeypatch):
+    plan = [{
+        'Planning Time': 1.5,
+        'Execution Time': 20.,
+        'Plan': {
+            'Node Type': 'Aggregate', 'Actual Total Time': 20., 'Actual Loops': 1,
+            'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'roads', 'Actual Total Time': 15., 'Actual Loops': 1, 'Actual Rows': 1000},
+                {'Node Type': 'CTE Scan', 'Subplan Name': 'CTE q_ras', 'CTE Name': 'q_ras', 'Actual Total Time': 2., 'Actual Loops': 2},
+            ],
+        },
+    }]
+    monkeypatch.setattr(diagnostics, 'query_db', lambda sql, connection=None, params=None: [(plan,)])
+    report = diagnostics.explain_plan('SELECT 1', connection=connection)
+    assert report.seq_scans == [('roads', 1000)]
+    assert report.cte_times == {'q_ras': 4.}
+    assert report.slow_nodes[0] == ('Seq Scan on roads', 15.)
+    assert (report.planning_time, report.execution_time) == (1.5, 20.)
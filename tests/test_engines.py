@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip('shapely')
+
+import postgis2raster
+from postgis2raster.sources import MemorySource
+from postgis2raster.utils import get_grid
+
+# Features on the edges and corners of the pixels, where the engines can disagree: 'fishnet' selects the pixels
+# ST_Intersects the feature, 'burn' the pixels GDAL burns with ALL_TOUCHED, 'numpy' the pixels of rasterize.py.
+# 'fishnet' and 'numpy' agree everywhere, 'burn' only away from pixel boundaries
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+SRID = 3857
+GRID = get_grid(QUERY['query_x'], QUERY['query_y'], QUERY['height'], QUERY['width'], QUERY['cell_size'], SRID)
+
+
+def at(col, row):
+    # Map coordinates of a pixel position, integers are pixel corners
+    return GRID.x_left + col*GRID.cell_size, GRID.y_upper - row*GRID.cell_size
+
+
+CASES = {
+    'line_along_edge': shapely.LineString([at(5, 2), at(5, 12)]),
+    'line_through_corners': shapely.LineString([at(2, 3), at(14, 9)]),
+    'line_inside': shapely.LineString([at(1.3, 17.2), at(18.6, 4.9)]),
+    'line_ending_on_corner': shapely.LineString([at(12.5, 12.5), at(15, 15)]),
+    'point_on_corner': shapely.Point(at(7, 7)),
+    'point_on_edge': shapely.Point(at(7, 10.5)),
+    'point_inside': shapely.Point(at(3.5, 12.5)),
+    'polygon_on_edges': shapely.Polygon([at(10, 10), at(15, 10), at(15, 15), at(10, 15)]),
+    'polygon_vertex_on_corner': shapely.Polygon([at(2.5, 15.5), at(4, 18), at(1.2, 18.6)]),
+}
+
+
+def expected_array(geometry):
+    # ST_Intersects of the feature and every pixel polygon, corners like ST_PixelAsPolygons
+    rows, cols = np.mgrid[0:GRID.n_rows, 0:GRID.n_cols]
+    pixels = shapely.box(
+        GRID.x_left + cols*GRID.cell_size, GRID.y_upper - (rows + 1)*GRID.cell_size,
+        GRID.x_left + (cols + 1)*GRID.cell_size, GRID.y_upper - rows*GRID.cell_size,
+    )
+    return np.where(shapely.intersects(pixels, geometry), 1, 0)
+
+
+def analysis_array(table, engine):
+    return postgis2raster.analysis_polygon(table=table, output_raster=None, engine=engine, as_array=True, **QUERY).array[0]
+
+
+def differences(arrays, expected):
+    """engines with the pixels they select differently from expected, (row, col, engine value, expected value)"""
+    return {
+        engine: [(row, col, int(array[row, col]), int(expected[row, col])) for row, col in np.argwhere(array != expected)]
+        for engine, array in arrays.items()
+        if not np.array_equal(array, expected)
+    }
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_numpy_engine(case):
+    source = MemorySource([CASES[case]], srid=SRID)
+    arrays = {'numpy': analysis_array(source, 'numpy')}
+    assert not differences(arrays, expected_array(CASES[case]))
+
+
+# GDAL ALL_TOUCHED of the burn engine on pixel boundaries, see sql.burn_sql. Not run against PostGIS
+# with these exact cases yet, hence not strict
+BURN_BOUNDARY_CASES = {
+    'line_along_edge': 'a line along a pixel edge burns the pixels on one side only',
+    'line_through_corners': 'pixels a line only touches at a corner are not always burnt',
+    'line_ending_on_corner': 'the pixel touched only by the end point on its corner is not burnt',
+    'point_on_corner': 'a point on a pixel corner burns one pixel, not four',
+    'point_on_edge': 'a point on a pixel edge burns one pixel, not two',
+    'polygon_on_edges': 'pixels outside the polygon sharing its edges are not burnt',
+    'polygon_vertex_on_corner': 'the pixel touched only by a vertex on its corner is not burnt',
+}
+
+
+def engine_cases():
+    for engine in ('fishnet', 'burn', 'numpy'):
+        for case in CASES:
+            marks = []
+            if engine == 'burn' and case in BURN_BOUNDARY_CASES:
+                marks = [pytest.mark.xfail(reason=BURN_BOUNDARY_CASES[case], strict=False)]
+            yield pytest.param(engine, case, marks=marks, id=f'{engine}-{case}')
+
+
+@pytest.mark.parametrize('engine, case', list(engine_cases()))
+def test_engines(engine, case, make_table):
+    table = make_table([('road', shapely.to_wkb(CASES[case]))], srid=SRID)
+    differ = differences({engine: analysis_array(table, engine)}, expected_array(CASES[case]))
+    assert not differ, f"{case}: pixels differing from ST_Intersects (row, col, engine, expected): {differ}"
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import postgis2raster
+from postgis2raster import config
+from postgis2raster.layers import Layer, _layer_kwargs, analysis_polygon_layers
+from postgis2raster.sources import PostGISSource
+from postgis2raster.sql import layers_to_raster_sql
+from postgis2raster.utils import get_grid
+
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+SRID = 3857
+GRID = get_grid(QUERY['query_x'], QUERY['query_y'], QUERY['height'], QUERY['width'], QUERY['cell_size'], SRID)
+
+
+def test_layer_kwargs():
+    roads = _layer_kwargs(Layer('roads', classes=['primary'], subdivide=True))
+    assert roads['label'] == 'roads'
+    assert roads['subdivide'] == config.subdivide_max_vertices
+    assert "\"fclass\" IN ('primary')" in roads['class_query']
+
+    landuse = _layer_kwargs(dict(table=PostGISSource('osm_landuse', class_column='type', geom_column='geom'), classes_to_bands=True, name='landuse'))
+    assert (landuse['table'], landuse['class_column'], landuse['geom_column']) == ('osm_landuse', 'type', 'geom')
+    assert landuse['label'] == 'landuse' and landuse['classes_to_bands']
+    assert landuse['subdivide'] is None
+
+
+def test_layers_to_raster_sql():
+    layers = [_layer_kwargs(Layer('roads', positive=2, negative=1)), _layer_kwargs(Layer('landuse', classes_to_bands=True, simplify=0.1))]
+    sql = layers_to_raster_sql(layers, GRID, QUERY['query_x'], QUERY['query_y'], QUERY['height'])
+    # Selection and mask once, every layer in its own scope on the mask valued with its negative value
+    assert sql.count('q AS (') == 1
+    assert sql.count('q_mask AS (') == 1
+    assert 'layer_0 AS (' in sql and 'layer_1 AS (' in sql
+    assert "ST_MapAlgebra(m.ras, 1, '8BUI', '1', 254)" in sql
+    assert "ST_MapAlgebra(m.ras, 1, '8BUI', '0', 254)" in sql
+    assert "ARRAY['roads']::text[] AS classes" in sql
+    assert "'landuse:' || b.class" in sql
+    # Only the simplified layer is clipped
+    assert sql.count('ST_ClipByBox2D') == 1
+    with pytest.raises(ValueError, match="'fishnet' or 'burn'"):
+        layers_to_raster_sql(layers, GRID, QUERY['query_x'], QUERY['query_y'], QUERY['height'], engine='pyramid')
+
+
+def test_analysis_polygon_layers_arguments():
+    with pytest.raises(ValueError, match='at least one layer'):
+        analysis_polygon_layers([], output_raster=None, as_array=True, **QUERY)
+    with pytest.raises(ValueError, match="'fishnet' or 'burn'"):
+        analysis_polygon_layers([Layer('roads')], output_raster=None, as_array=True, engine='numpy', **QUERY)
+
+
+@pytest.mark.parametrize('engine', ['fishnet', 'burn'])
+def test_layers_match_single_tables(make_table, engine):
+    shapely = pytest.importorskip('shapely')
+
+    def at(col, row):
+        return GRID.x_left + col*GRID.cell_size, GRID.y_upper - row*GRID.cell_size
+
+    roads = make_table([
+        ('primary', shapely.to_wkb(shapely.LineString([at(1.5, 2.5), at(17.5, 15.5)]))),
+        ('track', shapely.to_wkb(shapely.LineString([at(3.5, 18.5), at(16.5, 1.5)]))),
+    ], srid=SRID)
+    landuse = make_table([
+        ('forest', shapely.to_wkb(shapely.box(*at(2.5, 9.5), *at(7.5, 4.5)))),
+        ('farmland', shapely.to_wkb(shapely.box(*at(11.5, 17.5), *at(18.5, 12.5)))),
+    ], srid=SRID)
+
+    result = analysis_polygon_layers(
+        [Layer(roads, name='roads', positive=2, negative=1), Layer(landuse, name='landuse', classes_to_bands=True)],
+        output_raster=None,
+        engine=engine,
+        as_array=True,
+        **QUERY
+    )
+    assert result.band_mapping == [('roads', 2), ('landuse:farmland', 1), ('landuse:forest', 1)]
+
+    kwargs = dict(output_raster=None, engine=engine, as_array=True, **QUERY)
+    single = postgis2raster.analysis_polygon(table=roads, positive=2, negative=1, **kwargs).array
+    bands = postgis2raster.analysis_polygon(table=landuse, classes_to_bands=True, **kwargs).array
+    assert np.array_equal(result.array, np.concatenate([single, bands]))
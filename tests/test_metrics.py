@@ -0,0 +1,52 @@
+import pytest
+
+import postgis2raster
+from postgis2raster import config
+from postgis2raster.metrics import add_metrics_hook, remove_metrics_hook
+
+
+@pytest.fixture
+def records():
+    records = []
+    hook = add_metrics_hook(records.append)
+    yield records
+    remove_metrics_hook(hook)
+
+
+def test_features_counted_from_streamed_rows(records, monkeypatch):
+    shapely = pytest.importorskip('shapely')
+    # No COUNT query, the numpy engine counts the rows it reads
+    monkeypatch.setattr(config, 'metrics_count_features', False)
+    source = postgis2raster.MemorySource(
+        [shapely.Point(77.2, 28.6), shapely.Point(77.2001, 28.6001), shapely.Point(80, 20)], classes=['a', 'b', 'a'], srid=4326
+    )
+    postgis2raster.analysis_polygon(table=source, output_raster=None, query_x=77.2, query_y=28.6, height=200, width=200, cell_size=10, as_array=True)
+    assert records[-1].counts['features'] == 2
+    assert records[-1].error is None
+
+
+@pytest.mark.parametrize('error', [ValueError, KeyboardInterrupt])
+def test_failed_calls_recorded(records, error):
+    from postgis2raster.metrics import instrumented
+
+    @instrumented('failing')
+    def failing():
+        raise error()
+
+    with pytest.raises(error):
+        failing()
+    assert records[-1].name == 'failing' and records[-1].error == repr(error())
+
+
+@pytest.mark.parametrize('error', [ValueError, KeyboardInterrupt])
+def test_failed_async_calls_recorded(records, error):
+    import asyncio
+    from postgis2raster.metrics import instrumented
+
+    @instrumented('failing')
+    async def failing():
+        raise error()
+
+    with pytest.raises(error):
+        asyncio.run(failing())
+    assert records[-1].name == 'failing' and records[-1].error == repr(error())
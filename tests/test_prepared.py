@@ -0,0 +1,151 @@
+import psycopg2.errors
+import pytest
+
+from postgis2raster import config
+from postgis2raster.main import analysis_statement_kwargs, prepared_statement
+from postgis2raster.prepared import _statements, deallocate_prepared, query_prepared, statement_name
+from postgis2raster.utils import get_grid
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql, params=None):
+        command, name = sql.split(' ')[:2]
+        self.connection.executed.append(f'{command} {name}')
+        if command == 'PREPARE':
+            self.connection.server.add(name)
+        elif command == 'DEALLOCATE':
+            if name == 'ALL':
+                self.connection.server.clear()
+            else:
+                self.connection.server.remove(name)
+        elif command == 'EXECUTE' and name not in self.connection.server:
+            raise psycopg2.errors.InvalidSqlStatementName(f'prepared statement "{name}" does not exist')
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """psycopg2 connection of a backend keeping the names of its prepared statements"""
+
+    def __init__(self, autocommit=True):
+        self.autocommit = autocommit
+        self.pid = 1
+        self.server = set()
+        self.executed = []
+
+    def get_backend_pid(self):
+        return self.pid
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+SQL = "SELECT $1::int + $2"
+
+
+def test_statement_name():
+    assert statement_name(SQL) == statement_name(SQL)
+    assert statement_name(SQL) != statement_name(SQL + ' ')
+    assert statement_name(SQL).startswith('p2r_') and len(statement_name(SQL)) == 28
+
+
+def test_prepared_once():
+    con = FakeConnection()
+    name = statement_name(SQL)
+    assert query_prepared(SQL, [1, 2], ['integer'], connection=con) == [(1,)]
+    assert query_prepared(SQL, [3, 4], ['integer'], connection=con) == [(1,)]
+    assert con.executed == [f'PREPARE {name}', f'EXECUTE {name}', f'EXECUTE {name}']
+
+
+def test_new_backend_prepares_again():
+    con = FakeConnection()
+    query_prepared(SQL, [1, 2], connection=con)
+    # Reconnected, the statements of the old backend are gone
+    con.pid, con.server = 2, set()
+    query_prepared(SQL, [1, 2], connection=con)
+    assert [sql.split(' ')[0] for sql in con.executed] == ['PREPARE', 'EXECUTE', 'PREPARE', 'EXECUTE']
+
+
+def test_deallocated_prepares_again_on_autocommit():
+    con = FakeConnection()
+    name = statement_name(SQL)
+    query_prepared(SQL, [1, 2], connection=con)
+    # DISCARD ALL of a pooler in between
+    con.server.clear()
+    assert query_prepared(SQL, [1, 2], connection=con) == [(1,)]
+    assert con.executed[2:] == [f'EXECUTE {name}', f'PREPARE {name}', f'EXECUTE {name}']
+    assert name in _statements(con)
+
+
+def test_deallocated_raises_in_transaction():
+    con = FakeConnection(autocommit=False)
+    name = statement_name(SQL)
+    query_prepared(SQL, [1, 2], connection=con)
+    con.server.clear()
+    # The failed statement aborted the transaction, preparing again would fail as well
+    with pytest.raises(psycopg2.errors.InvalidSqlStatementName):
+        query_prepared(SQL, [1, 2], connection=con)
+    assert name not in _statements(con)
+    query_prepared(SQL, [1, 2], connection=con)
+    assert con.executed[-2:] == [f'PREPARE {name}', f'EXECUTE {name}']
+
+
+def test_evicted_statements_are_deallocated(monkeypatch):
+    monkeypatch.setattr(config, 'prepared_statements_per_connection', 2)
+    con = FakeConnection()
+    sqls = [f"SELECT {i} + $1" for i in range(3)]
+    for sql in sqls:
+        query_prepared(sql, [1], connection=con)
+    # The first one was used least recently
+    assert con.executed[-2] == f'DEALLOCATE {statement_name(sqls[0])}'
+    assert con.server == {statement_name(sqls[1]), statement_name(sqls[2])}
+
+    # Used again, the least recently used of the others is evicted
+    query_prepared(sqls[1], [1], connection=con)
+    query_prepared(sqls[0], [1], connection=con)
+    assert con.executed[-2] == f'DEALLOCATE {statement_name(sqls[2])}'
+    assert list(_statements(con)) == [statement_name(sqls[1]), statement_name(sqls[0])]
+
+
+def test_deallocate_prepared():
+    con = FakeConnection()
+    query_prepared(SQL, [1, 2], connection=con)
+    deallocate_prepared(con)
+    assert con.server == set() and con.executed[-1] == 'DEALLOCATE ALL'
+    assert not _statements(con)
+
+
+def test_prepared_statement_shape():
+    kwargs = dict(table='roads', geom_column='wkb_geometry', class_column='fclass', cell_size=10)
+    grids = [get_grid(77.2090, 28.6139, 200, 200, 10, 3857), get_grid(72.8777, 19.0760, 200, 200, 10, 3857)]
+    statements = []
+    for grid, (x, y) in zip(grids, [(77.2090, 28.6139), (72.8777, 19.0760)]):
+        statement_kwargs = analysis_statement_kwargs(grid=grid, query_x=x, query_y=y, height=200, **kwargs)
+        statements.append(prepared_statement(grid, statement_kwargs, x, y, 200, classes=['primary']))
+    # Requests of the same shape share the text, the grid and query point are parameters
+    (sql, params, types), (other_sql, other_params, _) = statements
+    assert sql == other_sql
+    assert params[:2] == [77.2090, 28.6139] and other_params[:2] == [72.8777, 19.0760]
+    assert params[-1] == ['primary'] and len(params) == 11
+    assert types == ['float8']*8 + ['integer']*2
+    assert '$11' in sql and "'primary'" not in sql
+
+
+def test_query_prepared(postgis_dsn):
+    import psycopg2
+
+    con = psycopg2.connect(postgis_dsn)
+    con.autocommit = True
+    try:
+        assert query_prepared(SQL, [1, 2], ['integer'], connection=con) == [(3,)]
+        con.cursor().execute("DISCARD ALL")
+        assert query_prepared(SQL, [2, 2], ['integer'], connection=con) == [(4,)]
+    finally:
+        con.close()
@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+
+from postgis2raster.pyramid import Pyramid, pyramid_level, refresh_tile_row_sql
+from postgis2raster.sql import pyramid_sql
+from postgis2raster.utils import Grid, get_class_query, project_xy
+
+PYRAMID = Pyramid('public', 'Roads', 'wkb_geometry', 'Road Class', 'public.Roads_pyramid', 3857, 10., 256, [1, 2, 4])
+
+
+def grid(x_left, y_upper, cell_size, srid=3857):
+    return Grid(srid, x_left, y_upper - 20*cell_size, x_left + 20*cell_size, y_upper, cell_size, 20, 20)
+
+
+def test_pyramid_level():
+    assert pyramid_level(PYRAMID, grid(0, 0, 5)) is None
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 10)) == 1
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 20)) == 2
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 1000)) == 2
+    assert pyramid_level(PYRAMID, grid(-8592960., 3330080., 1000)) == 4
+    # Rounding of the grid transforms
+    assert pyramid_level(PYRAMID, grid(8592900.000000001, 3330100., 10.000000000001)) == 1
+
+
+def test_pyramid_level_unaligned():
+    # Level pixels would be spread across request pixels
+    assert pyramid_level(PYRAMID, grid(8592905., 3330100., 10)) is None
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 39.9)) is None
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 10, srid=4326)) is None
+    # Coarser request pixels only with the Max resampling
+    assert pyramid_level(PYRAMID, grid(8592910., 3330100., 20)) == 1
+    assert pyramid_level(PYRAMID, grid(8592910., 3330100., 20), resample='NearestNeighbor') is None
+    assert pyramid_level(PYRAMID, grid(8592900., 3330100., 20), resample='NearestNeighbor') == 2
+
+
+def test_refresh_tile_row_sql_identifiers():
+    sql = refresh_tile_row_sql(PYRAMID, 1, 3, -2, 5)
+    assert 't."Road Class"::text AS class' in sql
+    assert '"public"."Roads" t' in sql
+    assert 't.Road Class' not in sql
+
+
+def test_refresh_tile_row_sql_keeps_null_classes():
+    # Features without a class are burnt by the burn engine without classes, their tiles are kept under a NULL class
+    sql = refresh_tile_row_sql(PYRAMID, 1, 3, -2, 5)
+    assert 'IS NOT NULL' not in sql
+    assert 'c.class IS NOT DISTINCT FROM p."Road Class"' in sql
+
+
+def test_pyramid_sql_null_class_filter():
+    class_query = get_class_query(None, PYRAMID.class_column)
+    single = pyramid_sql(PYRAMID.pyramid_table, 1, PYRAMID.class_column, class_query, positive=1)
+    bands = pyramid_sql(PYRAMID.pyramid_table, 1, PYRAMID.class_column, class_query, positive=1, classes_to_bands=True, band_classes=['a'])
+    assert 'p."Road Class" AS class' in single
+    assert 'IS NOT NULL' not in single
+    assert 'p."Road Class" IS NOT NULL' in bands
+
+
+def test_pyramid_engine_burns_null_classes(make_table):
+    shapely = pytest.importorskip('shapely')
+    import postgis2raster
+    from postgis2raster.pyramid import build_pyramid
+
+    # Request grid on the pixel corners of the base grid (x_left, y_upper multiples of 10 m), served from level 1
+    query_x, query_y = project_xy(8593000., 3330000., 3857, 4326)
+    table = make_table([
+        ('road', shapely.to_wkb(shapely.LineString([(8592945., 3330003.), (8593055., 3330003.)]))),
+        (None, shapely.to_wkb(shapely.LineString([(8593003., 3329945.), (8593003., 3330055.)]))),
+    ], srid=3857)
+    build_pyramid(table, cell_size=10, levels=(1, 2))
+    kwargs = dict(table=table, output_raster=None, query_x=query_x, query_y=query_y, height=200, width=200, cell_size=10, as_array=True)
+    burn = postgis2raster.analysis_polygon(engine='burn', **kwargs).array[0] == 1
+    pyramid = postgis2raster.analysis_polygon(engine='pyramid', **kwargs).array[0] == 1
+    # The north south line without a class is burnt as well, the aligned level gives the pixels of the burn engine
+    assert burn.any(axis=1).sum() > 10
+    assert np.array_equal(pyramid, burn)
+
+    bands = postgis2raster.analysis_polygon(engine='pyramid', classes_to_bands=True, **kwargs)
+    assert [c for c, _ in bands.band_mapping] == ['road']
+
+
+class RecordingCursor:
+    def __init__(self, has_column):
+        self.has_column = has_column
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql)
+
+    def fetchone(self):
+        return (1,) if self.has_column else None
+
+
+@pytest.mark.parametrize('has_column', [True, False])
+def test_changes_seen_added_once(has_column):
+    # No ALTER TABLE (ACCESS EXCLUSIVE lock on the registry) when the column exists
+    from postgis2raster.pyramid import _add_changes_seen
+    cur = RecordingCursor(has_column)
+    _add_changes_seen(cur)
+    assert any('information_schema.columns' in sql for sql in cur.statements)
+    assert any('ALTER TABLE' in sql for sql in cur.statements) == (not has_column)
+
+
+class SwapConnection:
+    """psycopg2 connection recording its statements with the autocommit they ran on"""
+
+    def __init__(self):
+        self.autocommit = True
+        self.closed = 0
+        self.statements = []
+
+    def cursor(self):
+        connection = self
+
+        class Cursor:
+            def execute(self, sql, params=None):
+                connection.statements.append((' '.join(sql.split()), connection.autocommit))
+
+            def fetchone(self):
+                return (1,)
+
+            def close(self):
+                pass
+        return Cursor()
+
+    def commit(self):
+        self.statements.append(('COMMIT', False))
+
+    def rollback(self):
+        self.statements.append(('ROLLBACK', False))
+
+
+def test_build_pyramid_swaps_in_one_transaction(monkeypatch):
+    from types import SimpleNamespace
+    from postgis2raster import changes, metadata, pyramid
+
+    filled = []
+    monkeypatch.setattr(metadata, 'get_table_metadata', lambda *args, **kwargs: SimpleNamespace(srid=3857))
+    monkeypatch.setattr(changes, 'latest_change', lambda *args, **kwargs: 7)
+    monkeypatch.setattr(pyramid, '_refresh_tiles', lambda p, connection: filled.append(p.pyramid_table))
+    con = SwapConnection()
+    built = pyramid.build_pyramid('roads', cell_size=10, levels=(2,), connection=con)
+    assert built.pyramid_table == 'public.roads_pyramid' and built.levels == [1, 2]
+    # Tiles filled into the build table, the live pyramid is only dropped in the swap
+    assert filled == ['public.roads_pyramid_build']
+    statements = [sql for sql, _ in con.statements]
+    swap = next(i for i, sql in enumerate(statements) if sql.startswith('DROP TABLE IF EXISTS public.roads_pyramid;'))
+    assert 'ALTER TABLE public.roads_pyramid_build RENAME TO roads_pyramid;' in statements[swap]
+    assert statements[swap + 1].startswith('INSERT INTO public.postgis2raster_pyramids')
+    assert statements[swap + 2] == 'COMMIT'
+    assert all(not autocommit for _, autocommit in con.statements[swap:swap + 3])
+    assert not any('public.roads_pyramid;' in sql for sql in statements[:swap])
+    assert con.autocommit
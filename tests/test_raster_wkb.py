@@ -0,0 +1,94 @@
+import struct
+
+import numpy as np
+import pytest
+
+from postgis2raster.raster_wkb import raster_array, read_raster_wkb, to_xarray
+
+GEOTRANSFORM = dict(scale_x=10., scale_y=-10., ip_x=500000., ip_y=3100000., skew_x=0., skew_y=0.)
+
+
+def raster_wkb(bands, srid=32643, byteorder='<', **geotransform):
+    """WKB raster like ST_AsBinary(raster), bands is a list of (pixel type, nodata or None, 2d array)"""
+    g = {**GEOTRANSFORM, **geotransform}
+    height, width = bands[0][2].shape if bands else (3, 2)
+    data = bytes([byteorder == '<'])
+    data += struct.pack(
+        byteorder + 'HHddddddiHH', 0, len(bands),
+        g['scale_x'], g['scale_y'], g['ip_x'], g['ip_y'], g['skew_x'], g['skew_y'], srid, width, height
+    )
+    for pixel_type, nodata, array in bands:
+        dtype = array.dtype.newbyteorder(byteorder)
+        data += bytes([pixel_type | (0x40 if nodata is not None else 0)])
+        data += np.array([nodata or 0], dtype=dtype).tobytes()
+        data += array.astype(dtype).tobytes()
+    return data
+
+
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_bands(byteorder):
+    first = np.arange(6, dtype=np.uint8).reshape(3, 2)
+    second = first[::-1] * 10
+    data = raster_wkb([(4, 254, first), (4, 254, second)], byteorder=byteorder)
+    array, geotransform, srid, nodata = read_raster_wkb(data)
+    assert array.shape == (2, 3, 2)
+    assert array[0].tolist() == first.tolist() and array[1].tolist() == second.tolist()
+    assert geotransform == (500000., 10., 0., 3100000., 0., -10.)
+    assert srid == 32643 and nodata == [254, 254]
+
+
+@pytest.mark.parametrize('pixel_type, dtype, nodata', [
+    (3, np.int8, -1),
+    (5, np.int16, -32768),
+    (6, np.uint16, None),
+    (7, np.int32, -9999),
+    (8, np.uint32, 0),
+    (10, np.float32, -1.5),
+    (11, np.float64, None),
+])
+@pytest.mark.parametrize('byteorder', ['<', '>'])
+def test_pixel_types(pixel_type, dtype, nodata, byteorder):
+    values = (np.arange(12).reshape(3, 4) * 3).astype(dtype)
+    array, _, _, band_nodata = read_raster_wkb(raster_wkb([(pixel_type, nodata, values)], byteorder=byteorder))
+    assert array.dtype == np.dtype(dtype).newbyteorder(byteorder)
+    assert array.shape == (1, 3, 4)
+    assert np.array_equal(array[0], values)
+    assert band_nodata == [nodata]
+
+
+def test_zero_copy():
+    data = raster_wkb([(4, None, np.ones((3, 2), dtype=np.uint8))])
+    array, _, _, _ = read_raster_wkb(data)
+    # A view on the fetched bytes
+    assert not array.flags.writeable
+    assert np.shares_memory(array, np.frombuffer(data, dtype=np.uint8))
+
+
+def test_no_bands():
+    array, _, srid, nodata = read_raster_wkb(raster_wkb([]))
+    assert array.shape == (0, 3, 2) and nodata == []
+
+
+def test_out_db():
+    data = bytearray(raster_wkb([(4, None, np.ones((3, 2), dtype=np.uint8))]))
+    data[1 + struct.calcsize('<HHddddddiHH')] |= 0x80
+    with pytest.raises(ValueError):
+        read_raster_wkb(bytes(data))
+
+
+def test_raster_array():
+    data = raster_wkb([(4, 254, np.zeros((3, 2), dtype=np.uint8))], srid=3857)
+    raster = raster_array(memoryview(data), band_mapping=[('road', 5)])
+    assert raster.crs == 'EPSG:3857' and raster.nodata == 254 and raster.band_mapping == [('road', 5)]
+    assert raster.geotransform[1] == 10.
+
+
+def test_to_xarray():
+    pytest.importorskip('xarray')
+    data = raster_wkb([(4, 254, np.zeros((3, 2), dtype=np.uint8))] * 2)
+    da = to_xarray(raster_array(data, band_mapping=[('road', 5), ('rail', 1)]))
+    assert da.dims == ('band', 'y', 'x')
+    assert da['band'].values.tolist() == ['road', 'rail']
+    # Pixel centers
+    assert da['x'].values.tolist() == [500005., 500015.]
+    assert da['y'].values.tolist() == [3099995., 3099985., 3099975.]
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip('shapely')
+
+from postgis2raster.rasterize import rasterize_wkb, rasterize_stream
+from postgis2raster.utils import Grid
+
+CELL = 0.37
+X_LEFT, Y_UPPER = 500123.25, 3100456.5
+GRID = Grid(32643, X_LEFT, Y_UPPER - 40*CELL, X_LEFT + 40*CELL, Y_UPPER, CELL, 40, 40)
+
+
+def pixel_polygons(grid):
+    # Corners computed like ST_PixelAsPolygons, upper left + pixel * scale
+    rows, cols = np.mgrid[0:grid.n_rows, 0:grid.n_cols]
+    return shapely.box(
+        grid.x_left + cols*grid.cell_size, grid.y_upper - (rows + 1)*grid.cell_size,
+        grid.x_left + (cols + 1)*grid.cell_size, grid.y_upper - rows*grid.cell_size,
+    )
+
+
+def fishnet(grid, geometry):
+    """pixels of the fishnet engine, ST_Intersects of the geometry and every pixel polygon"""
+    return shapely.intersects(pixel_polygons(grid), geometry)
+
+
+def to_map(pixels):
+    pixels = np.asarray(pixels, dtype=float)
+    return np.column_stack([X_LEFT + pixels[:, 0]*CELL, Y_UPPER - pixels[:, 1]*CELL])
+
+
+def assert_fishnet(geometry, grid=GRID):
+    burnt = rasterize_wkb(grid, [shapely.to_wkb(geometry)])
+    expected = fishnet(grid, geometry)
+    assert np.array_equal(burnt, expected), (
+        f"missing {np.argwhere(expected & ~burnt).tolist()} extra {np.argwhere(burnt & ~expected).tolist()}"
+    )
+
+
+@pytest.mark.parametrize('pixels', [
+    [(36, 26), (20, 9)],
+    [(5, 34), (26, 38)],
+    [(20, 24), (41, 30)],
+    [(26, 22), (22, 40)],
+    [(0, 0), (40, 40)],
+    [(3, 10), (30, 10)],
+    [(10, 3), (10, 30)],
+    [(-3, 5), (43, 7)],
+])
+def test_line_corners(pixels):
+    # Vertices on pixel corners, lines through corners of the pixels they pass
+    assert_fishnet(shapely.LineString(to_map(pixels)))
+
+
+@pytest.mark.parametrize('lattice', [True, False])
+def test_random_lines(lattice):
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        pixels = rng.integers(-3, 43, size=(rng.integers(2, 5), 2)) if lattice else rng.uniform(-3, 43, size=(3, 2))
+        assert_fishnet(shapely.LineString(to_map(pixels)))
+
+
+def test_long_line():
+    # Longer than one piece of candidate cells, cut at fractional pixels
+    grid = Grid(32643, X_LEFT, Y_UPPER - 300*CELL, X_LEFT + 300*CELL, Y_UPPER, CELL, 300, 300)
+    assert_fishnet(shapely.LineString(to_map([(0, 1), (299, 212)])), grid)
+    assert_fishnet(shapely.LineString(to_map([(0.3, 1.7), (299.1, 212.4)])), grid)
+
+
+@pytest.mark.parametrize('pixels', [
+    [(10, 10)],
+    [(10, 10.5)],
+    [(10.5, 10.5)],
+    [(0, 0), (40, 40), (40, 0)],
+    [(-0.5, 3), (3, 41)],
+])
+def test_points(pixels):
+    # On a corner 4 pixels, on an edge 2, inside 1, outside the grid none
+    assert_fishnet(shapely.MultiPoint(to_map(pixels)))
+
+
+def test_polygons():
+    square = shapely.Polygon(to_map([(2, 2), (12, 2), (12, 9), (2, 9)]))
+    hole = shapely.Polygon(to_map([(0, 0), (30, 0), (30, 30), (0, 30)]), [to_map([(5, 5), (20, 5), (20, 20), (5, 20)])])
+    triangle = shapely.Polygon(to_map([(1.2, 3.7), (38.4, 10.1), (17.9, 33.3)]))
+    for polygon in (square, hole, triangle):
+        assert_fishnet(polygon)
+
+
+def test_center_polygons():
+    # Only pixels with the center inside
+    polygon = shapely.Polygon(to_map([(2.2, 2.2), (12.6, 2.2), (12.6, 9.4), (2.2, 9.4)]))
+    burnt = rasterize_wkb(GRID, [shapely.to_wkb(polygon)], all_touched=False)
+    expected = np.zeros((40, 40), dtype=bool)
+    expected[2:9, 2:13] = True
+    assert np.array_equal(burnt, expected)
+
+
+def test_stream_bands():
+    selection = shapely.Polygon(to_map([(0, 0), (20, 0), (20, 40), (0, 40)]))
+    road = shapely.LineString(to_map([(0, 10.5), (40, 10.5)]))
+    well = shapely.Point(to_map([(5.5, 5.5)])[0])
+    batches = [
+        [(0, None, shapely.to_wkb(selection)), (1, 'road', shapely.to_wkb(road))],
+        [(1, 'well', shapely.to_wkb(well)), (1, None, shapely.to_wkb(well))],
+    ]
+    array, bands = rasterize_stream(GRID, batches, positive=1, negative=0, nodata=254, classes_to_bands=True)
+    assert bands == [('road', 1), ('well', 1)]
+    assert array.shape == (2, 40, 40) and array.dtype == np.uint8
+    # Outside the selection nodata, touched pixels inside positive
+    assert (array[:, :, 20:] == 254).all()
+    assert array[0, 10, :20].tolist() == [1]*20
+    assert (array[0] == 1).sum() == 20
+    assert array[1, 5, 5] == 1 and (array[1] == 1).sum() == 1
+
+    single, bands = rasterize_stream(GRID, batches)
+    assert bands is None and single.shape == (1, 40, 40)
+    assert (single[0] == 1).sum() == 21
@@ -0,0 +1,18 @@
+import pytest
+
+from postgis2raster.sources import MemorySource, PostGISSource, VectorSource
+
+
+def test_vector_source_is_abstract():
+    with pytest.raises(TypeError, match='abstract'):
+        VectorSource()
+
+    class VersionOnly(VectorSource):
+        def version(self):
+            return 1
+
+    # A source without feature_batches fails when it is made, not in the middle of an analysis
+    with pytest.raises(TypeError, match='feature_batches'):
+        VersionOnly()
+    assert isinstance(PostGISSource('roads'), VectorSource)
+    assert isinstance(MemorySource([], srid=3857), VectorSource)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from postgis2raster.sql import features_sql, prepared_geom_sql, statistics_sql
+from postgis2raster.utils import get_class_query, get_grid
+
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+SRID = 3857
+GRID = get_grid(QUERY['query_x'], QUERY['query_y'], QUERY['height'], QUERY['width'], QUERY['cell_size'], SRID)
+CLASS_QUERY = get_class_query(None, 'Road Class')
+
+
+def test_prepared_geom_sql():
+    assert prepared_geom_sql('t.geom', GRID) == 't.geom'
+    clipped = prepared_geom_sql('t.geom', GRID, clip=True)
+    assert clipped.startswith('ST_ClipByBox2D(')
+    # Grid extent of the same corners as the pixels plus one cell
+    assert f'ST_MakeEnvelope({GRID.x_left}, ({GRID.y_upper}) - ({GRID.n_rows})*({GRID.cell_size})' in clipped
+    assert f'{GRID.y_upper}, {GRID.srid})' in clipped
+    simplified = prepared_geom_sql('t.geom', GRID, clip=True, simplify=0.1)
+    assert simplified.startswith('ST_SimplifyPreserveTopology(ST_ClipByBox2D(')
+    assert simplified.endswith(f'0.1*({GRID.cell_size}))')
+
+
+def test_features_sql_identifiers():
+    sql = features_sql('Roads', 'the geom', 'Road Class', CLASS_QUERY, grid=GRID, attributes=['max speed'])
+    assert 'public."Roads" t' in sql
+    assert 'ST_Intersects(q.geom, t."the geom")' in sql
+    assert 't."Road Class" as class' in sql
+    assert 't."max speed" AS attr_0' in sql
+    assert 'ST_ClipByBox2D' not in sql
+    assert 'ST_Subdivide' not in sql
+
+
+def test_features_sql_subdivide():
+    sql = features_sql('Roads', 'the geom', 'Road Class', CLASS_QUERY, grid=GRID, clip=True, subdivide=64, simplify=0.1, attributes=['a', 'b'])
+    assert 'LEFT JOIN LATERAL ST_Subdivide(t.geom, 64) WITH ORDINALITY AS p(geom, part) ON true' in sql
+    assert 'COALESCE(p.part, 1) AS part' in sql
+    assert 't.ctid AS fid' in sql
+    assert 't.fid, t.attr_0, t.attr_1' in sql
+    # Clipped and simplified before the split, the selection stays on the original geometry
+    assert 'ST_SimplifyPreserveTopology(ST_ClipByBox2D(' in sql
+    assert 'ST_Intersects(q.geom, t."the geom")' in sql
+
+
+def test_statistics_sql_counts_features_of_parts_once():
+    assert 'COUNT(*) AS n' in statistics_sql(['count'], 1, 0, 254, 10)
+    subdivided = statistics_sql(['count'], 1, 0, 254, 10, subdivided=True)
+    assert 'COUNT(DISTINCT f.fid) AS n' in subdivided
+    assert 'COUNT(*) AS n' not in subdivided
+
+
+def test_subdivide_keeps_raster(make_table):
+    shapely = pytest.importorskip('shapely')
+    import postgis2raster
+
+    # Polygon of many vertices crossing the grid, split in many parts by ST_Subdivide
+    angles = np.linspace(0, 2*np.pi, 2000, endpoint=False)
+    radius = 80 + 15*np.sin(12*angles)
+    center = (GRID.x_left + 100, GRID.y_upper - 100)
+    polygon = shapely.Polygon(np.column_stack([center[0] + radius*np.cos(angles), center[1] + radius*np.sin(angles)]))
+    line = shapely.LineString([(GRID.x_left - 50, GRID.y_upper - 37), (GRID.x_left + 250, GRID.y_upper - 163)])
+    table = make_table([('landuse', shapely.to_wkb(polygon)), ('road', shapely.to_wkb(line))], srid=SRID)
+
+    for engine in ('fishnet', 'burn'):
+        kwargs = dict(table=table, output_raster=None, engine=engine, as_array=True, **QUERY)
+        plain = postgis2raster.analysis_polygon(**kwargs).array
+        subdivided = postgis2raster.analysis_polygon(subdivide=32, **kwargs).array
+        assert np.array_equal(plain, subdivided), engine
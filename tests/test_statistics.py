@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+import postgis2raster
+from postgis2raster import config
+from postgis2raster.sources import MemorySource
+from postgis2raster.sql import feature_to_raster_sql, parse_statistics, statistics_pixel_type, statistics_sql
+from postgis2raster.utils import get_class_query, get_grid
+
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+SRID = 3857
+GRID = get_grid(QUERY['query_x'], QUERY['query_y'], QUERY['height'], QUERY['width'], QUERY['cell_size'], SRID)
+
+
+def test_parse_statistics():
+    assert parse_statistics(['presence', 'count', 'max:maxspeed']) == [('presence', None), ('count', None), ('max', 'maxspeed')]
+    with pytest.raises(ValueError, match='statistics should be in'):
+        parse_statistics(['sum'])
+    with pytest.raises(ValueError, match='need a column'):
+        parse_statistics(['max'])
+    with pytest.raises(ValueError, match='need a column'):
+        parse_statistics(['count:maxspeed'])
+
+
+def test_statistics_pixel_type():
+    assert statistics_pixel_type(['presence']) == '8BUI'
+    assert statistics_pixel_type(['presence', 'count']) == '16BUI'
+    assert statistics_pixel_type(['count', 'length']) == '32BF'
+    assert statistics_pixel_type(['min:maxspeed']) == '32BF'
+
+
+def test_statistics_sql_single_pass():
+    sql = statistics_sql(['count', 'length', 'area_fraction', 'min:speed', 'max:speed'], 1, 0, -9999, 10, length_scale=2)
+    # One pixel x feature join, the intersection computed once for length and area, one column per attribute
+    assert sql.count('JOIN features f ON ST_Intersects(f.geom, px.geom)') == 1
+    assert sql.count('CROSS JOIN LATERAL (SELECT ST_Intersection(f.geom, px.geom) AS geom) i') == 1
+    assert 'MIN(f.attr_0)::double precision AS min_0' in sql
+    assert 'MAX(f.attr_0)::double precision AS max_0' in sql
+    assert 'attr_1' not in sql
+    assert '(p.length*2)::real' in sql
+    assert "ST_MapAlgebra(q_ras.ras, 1, '32BF', 'NULL', -9999)" in sql
+    assert [f'{i} AS idx' in sql for i in range(1, 6)] == [True]*5
+    assert 'ST_Intersection' not in statistics_sql(['presence', 'count'], 1, 0, 254, 10)
+
+
+def test_feature_to_raster_sql_statistics():
+    kwargs = dict(table='roads', grid=GRID, query_x=QUERY['query_x'], query_y=QUERY['query_y'], height=QUERY['height'], class_query=get_class_query(None, 'fclass'))
+    sql = feature_to_raster_sql(statistics=['presence', 'count', 'max:maxspeed'], **kwargs)
+    assert 't."maxspeed" AS attr_0' in sql
+    assert "'16BUI'" not in sql and f"'32BF', 'NULL', {config.statistics_float_nodata}" in sql
+    assert "ARRAY['presence', 'count', 'max:maxspeed']::text[]" in sql
+    with pytest.raises(ValueError, match='classes_to_bands'):
+        feature_to_raster_sql(statistics=['count'], classes_to_bands=True, **kwargs)
+
+
+@pytest.mark.parametrize('arguments', [
+    dict(engine='numpy'),
+    dict(engine='pyramid'),
+    dict(classes_to_bands=True),
+    dict(tile_size=16),
+    dict(max_workers=2),
+])
+def test_analysis_polygon_statistics_arguments(arguments):
+    with pytest.raises(ValueError, match='statistics'):
+        postgis2raster.analysis_polygon(table='roads', output_raster=None, as_array=True, statistics=['count'], **arguments, **QUERY)
+
+
+def test_statistics_of_sources():
+    shapely = pytest.importorskip('shapely')
+    source = MemorySource([shapely.Point(GRID.x_left + 5, GRID.y_upper - 5)], srid=SRID)
+    with pytest.raises(ValueError, match='statistics'):
+        postgis2raster.analysis_polygon(table=source, output_raster=None, as_array=True, statistics=['count'], **QUERY)
+
+
+def test_statistics(make_table):
+    shapely = pytest.importorskip('shapely')
+
+    def at(col, row):
+        return GRID.x_left + col*GRID.cell_size, GRID.y_upper - row*GRID.cell_size
+
+    # Two lines crossing in pixel (4, 4) and a polygon covering 0.8 of pixel (10, 10)
+    rows = [
+        ('road', shapely.to_wkb(shapely.LineString([at(0.5, 4.5), at(8.5, 4.5)]))),
+        ('road', shapely.to_wkb(shapely.LineString([at(4.5, 0.5), at(4.5, 8.5)]))),
+        ('landuse', shapely.to_wkb(shapely.box(*at(10.2, 11), *at(11, 10)))),
+    ]
+    table = make_table(rows, srid=SRID)
+    result = postgis2raster.analysis_polygon(
+        table=table,
+        output_raster=None,
+        as_array=True,
+        statistics=['presence', 'count', 'length', 'area_fraction', 'max:ogc_fid'],
+        **QUERY
+    )
+    presence, count, length, area_fraction, max_fid = result.array
+    assert [statistic for statistic, _ in result.band_mapping] == ['presence', 'count', 'length', 'area_fraction', 'max:ogc_fid']
+    assert [n for _, n in result.band_mapping] == [3]*5
+
+    assert count[4, 4] == 2
+    assert count[4, 1] == 1 and count[15, 15] == 0
+    assert presence[4, 1] == 1 and presence[15, 15] == 0
+    assert length[4, 2] == pytest.approx(10, rel=1e-3)
+    assert length[4, 0] == pytest.approx(5, rel=1e-3)
+    assert area_fraction[10, 10] == pytest.approx(0.8, rel=1e-3)
+    assert area_fraction[4, 2] == 0
+    assert max_fid[4, 4] == 2 and max_fid[10, 10] == 3
+    assert max_fid[15, 15] == config.statistics_float_nodata
+    assert np.isclose(length[4, 0:9].sum(), 80, rtol=1e-3)
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from postgis2raster import config, configure_pool, close_pool
+from postgis2raster import tiling
+from postgis2raster.pool import reserve_connections
+from postgis2raster.tiling import Window, get_max_workers, iter_windows, rasterize_windows, split_windows, window_grid
+from postgis2raster.utils import Grid
+
+GRID = Grid(3857, 0., -100., 70., 0., 1., 100, 70)
+
+
+@pytest.fixture
+def pool():
+    # No connection is opened upfront, the tests only take pool slots
+    saved = {name: getattr(config, name) for name in ('dsn', 'pool_minconn', 'pool_maxconn')}
+    configure_pool(dsn='postgresql://localhost:1/unused', minconn=0, maxconn=4)
+    yield
+    close_pool()
+    for name, value in saved.items():
+        setattr(config, name, value)
+
+
+def test_iter_windows():
+    windows = list(iter_windows(GRID, 32))
+    assert len(windows) == 4*3
+    assert windows[-1] == Window(96, 64, 4, 6)
+    assert sum(w.n_rows*w.n_cols for w in windows) == 100*70
+
+
+def test_split_windows():
+    windows = split_windows(GRID, 3)
+    assert [w.n_rows for w in windows] == [33, 34, 33]
+    assert [w.row_off for w in windows] == [0, 33, 67]
+    # Never more strips than rows
+    assert len(split_windows(GRID._replace(n_rows=2), 8)) == 2
+
+
+def test_window_grid():
+    grid = window_grid(GRID, Window(10, 20, 5, 7))
+    assert (grid.x_left, grid.y_upper, grid.x_right, grid.y_lower) == (20., -10., 27., -15.)
+    assert (grid.n_rows, grid.n_cols, grid.cell_size) == (5, 7, 1.)
+
+
+def test_get_max_workers(monkeypatch):
+    monkeypatch.setattr(config, 'max_workers_per_request', 4)
+    monkeypatch.setattr(config, 'pool_maxconn', 3)
+    assert get_max_workers(None) == 1
+    # A connection is left for the calling thread
+    assert get_max_workers(8) == 2
+
+
+def test_reserve_connections(pool):
+    with reserve_connections(3) as first:
+        with reserve_connections(3) as second:
+            with reserve_connections(3) as third:
+                assert (first, second, third) == (3, 1, 0)
+    # Freed on exit
+    with reserve_connections(10) as reserved:
+        assert reserved == 4
+
+
+def fake_window(calls):
+    def rasterize(grid, window, statement_kwargs, band_classes=None, connection=None):
+        calls.append((window, connection, threading.current_thread()))
+        return None
+    return rasterize
+
+
+def test_rasterize_windows_concurrent(pool, monkeypatch):
+    calls = []
+    monkeypatch.setattr(tiling, '_rasterize_window', fake_window(calls))
+    monkeypatch.setattr(tiling, 'borrow_connection', lambda reserved: _Reserved(reserved))
+    windows = split_windows(GRID, 6)
+    rasterize_windows(GRID, windows, {}, ds=None, connection='caller', max_workers=3)
+    assert sorted(c[0] for c in calls) == windows
+    assert {c[1] for c in calls} == {'reserved'}
+    assert all(c[2] is not threading.current_thread() for c in calls)
+
+
+@pytest.mark.parametrize('held', [3, 4])
+def test_rasterize_windows_falls_back(pool, monkeypatch, held):
+    # Other requests hold the pool, the windows run one by one on the caller's connection instead of waiting
+    calls = []
+    monkeypatch.setattr(tiling, '_rasterize_window', fake_window(calls))
+    windows = split_windows(GRID, 4)
+    with reserve_connections(held):
+        rasterize_windows(GRID, windows, {}, ds=None, connection='caller', max_workers=3)
+    assert [c[0] for c in calls] == windows
+    assert {c[1] for c in calls} == {'caller'}
+    assert {c[2] for c in calls} == {threading.current_thread()}
+
+
+class _Reserved:
+    def __init__(self, reserved):
+        assert reserved
+
+    def __enter__(self):
+        return 'reserved'
+
+    def __exit__(self, *exc):
+        return False
@@ -0,0 +1,73 @@
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('geopandas')
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('osgeo')
+shapely = pytest.importorskip('shapely')
+
+V1 = os.path.join(os.path.dirname(__file__), '..', 'src_old_v1_geopandas', 'postgis2raster')
+
+
+def load_v1():
+    # The GeoPandas package shares the name of the current one, loaded under a name of its own
+    spec = importlib.util.spec_from_file_location('postgis2raster_v1', os.path.join(V1, '__init__.py'), submodule_search_locations=[V1])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return importlib.import_module('postgis2raster_v1.utils')
+
+
+utils = load_v1()
+
+X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS = 1000., 5000., 10., 40, 50
+
+
+def geometries(seed):
+    rng = np.random.default_rng(seed)
+    x0, y0 = X_LEFT - 20, Y_UPPER - N_ROWS*CELL - 20
+    width, height = N_COLS*CELL + 40, N_ROWS*CELL + 40
+    xy = lambda n: np.column_stack([x0 + rng.random(n)*width, y0 + rng.random(n)*height])
+    geoms = [shapely.Point(*p) for p in xy(20)]
+    geoms += [shapely.LineString(xy(3)) for _ in range(10)]
+    geoms += [shapely.Point(*p).buffer(rng.random()*40 + 1) for p in xy(10)]
+    geoms += [shapely.MultiPolygon([shapely.box(*p, *(p + 15)) for p in xy(2)]) for _ in range(5)]
+    # On cell edges and corners
+    geoms += [shapely.Point(X_LEFT + 10*CELL, Y_UPPER - 5*CELL), shapely.LineString([(X_LEFT + 3*CELL, Y_UPPER), (X_LEFT + 3*CELL, Y_UPPER - 8*CELL)])]
+    return np.array(geoms, dtype=object)
+
+
+def brute_force(geoms):
+    # Every cell polygon queried against the geometries
+    rows, cols = np.divmod(np.arange(N_ROWS*N_COLS), N_COLS)
+    cells = utils.fishnet_cells(X_LEFT, Y_UPPER, CELL, rows, cols)
+    hit = shapely.STRtree(geoms).query(cells, predicate='intersects')[0]
+    arr = np.zeros(N_ROWS*N_COLS, dtype=np.uint8)
+    arr[hit] = 1
+    return arr.reshape(N_ROWS, N_COLS)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rasterize_fishnet_matches_brute_force(seed):
+    geoms = geometries(seed)
+    expected = brute_force(geoms)
+    assert expected.any()
+    assert np.array_equal(utils.rasterize_fishnet(geoms, X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS, chunk_cells=97), expected)
+
+    parts = shapely.get_parts(geoms)
+    hits = set(np.flatnonzero(expected))
+    # Candidates cover every hit, cells inside polygons are hits
+    assert hits <= set(utils.candidate_cells(parts, X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS))
+    assert set(utils.cells_inside(parts, X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS, chunk_cells=101)) <= hits
+
+
+def test_fishnet_geotransform():
+    assert utils.fishnet_geotransform(X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS, crs=3857) == (X_LEFT, CELL, 0, Y_UPPER, 0, -CELL)
+    # Bounds of the fishnet in 4326 by default
+    x_left, x_res, _, y_upper, _, y_res = utils.fishnet_geotransform(X_LEFT, Y_UPPER, CELL, N_ROWS, N_COLS)
+    assert (x_left, y_upper) == pytest.approx(utils.project_xy(X_LEFT, Y_UPPER, 3857, 4326))
+    assert (x_left + N_COLS*x_res, y_upper + N_ROWS*y_res) == pytest.approx(utils.project_xy(X_LEFT + N_COLS*CELL, Y_UPPER - N_ROWS*CELL, 3857, 4326))
@@ -0,0 +1,87 @@
+import struct
+
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip('shapely')
+
+from postgis2raster.wkb import GeometryParts, read_wkb
+
+
+def test_point():
+    parts = read_wkb(shapely.to_wkb(shapely.Point(1.5, -2)))
+    assert len(parts.points) == 1 and parts.points[0].tolist() == [[1.5, -2]]
+    assert not parts.lines and not parts.rings
+
+
+def test_empty_point():
+    assert not read_wkb(shapely.to_wkb(shapely.Point()))
+
+
+def test_linestring():
+    parts = read_wkb(shapely.to_wkb(shapely.LineString([(0, 0), (1, 2), (3, 4)])))
+    assert [line.tolist() for line in parts.lines] == [[[0, 0], [1, 2], [3, 4]]]
+    assert not parts.rings
+
+
+def test_polygon_rings():
+    polygon = shapely.Polygon([(0, 0), (10, 0), (10, 10), (0, 10)], [[(2, 2), (4, 2), (4, 4), (2, 2)]])
+    parts = read_wkb(shapely.to_wkb(polygon))
+    assert len(parts.rings) == 2 and parts.ring_polygon == [0, 0]
+    # Rings are burnt as lines too
+    assert len(parts.lines) == 2
+    assert parts.rings[1].tolist() == [[2, 2], [4, 2], [4, 4], [2, 2]]
+    assert parts.n_polygons == 1
+
+
+def test_multipolygon_ids():
+    squares = [shapely.box(i, 0, i + 1, 1) for i in range(3)]
+    parts = read_wkb(shapely.to_wkb(shapely.MultiPolygon(squares)))
+    assert parts.ring_polygon == [0, 1, 2]
+    # Polygon ids keep counting over geometries read into the same parts
+    read_wkb(shapely.to_wkb(squares[0]), parts)
+    assert parts.ring_polygon == [0, 1, 2, 3]
+
+
+def test_collection():
+    collection = shapely.GeometryCollection([
+        shapely.Point(0, 0),
+        shapely.MultiLineString([[(0, 0), (1, 1)], [(2, 2), (3, 3)]]),
+        shapely.box(0, 0, 1, 1),
+    ])
+    parts = read_wkb(shapely.to_wkb(collection))
+    assert len(parts.points) == 1 and len(parts.lines) == 3 and len(parts.rings) == 1
+
+
+@pytest.mark.parametrize('flavor', ['iso', 'extended'])
+@pytest.mark.parametrize('byte_order', [0, 1])
+def test_dimensions(flavor, byte_order):
+    # z and m ordinates are skipped, in ISO WKB and EWKB of either byte order
+    line = shapely.LineString([(0, 1, 2), (3, 4, 5)])
+    wkb = shapely.to_wkb(line, output_dimension=3, byte_order=byte_order, flavor=flavor, include_srid=False)
+    assert read_wkb(wkb).lines[0].tolist() == [[0, 1], [3, 4]]
+
+
+def test_iso_zm():
+    # POINT ZM as ISO WKB, type 3001
+    wkb = struct.pack('<BI4d', 1, 3001, 1, 2, 3, 4)
+    assert read_wkb(wkb).points[0].tolist() == [[1, 2]]
+
+
+def test_ewkb_srid():
+    point = shapely.set_srid(shapely.Point(7, 8, 9), 3857)
+    wkb = shapely.to_wkb(point, output_dimension=3, flavor='extended', include_srid=True)
+    assert read_wkb(wkb).points[0].tolist() == [[7, 8]]
+
+
+def test_memoryview():
+    # psycopg2 returns bytea as memoryview
+    parts = read_wkb(memoryview(shapely.to_wkb(shapely.LineString([(0, 0), (1, 1)]))))
+    assert parts.lines[0].tolist() == [[0, 0], [1, 1]]
+
+
+def test_unsupported():
+    # CircularString, type 8
+    wkb = struct.pack('<BII6d', 1, 8, 3, 0, 0, 1, 1, 2, 0)
+    with pytest.raises(ValueError):
+        read_wkb(wkb, GeometryParts())
@@ -0,0 +1,108 @@
+import pytest
+
+from postgis2raster import config
+from postgis2raster.main import analysis_output_profile, statement_output_kwargs
+from postgis2raster.sql import output_sql
+from postgis2raster.writers import (
+    OutputProfile, check_profile_values, creation_options, get_output_profile, overview_factors, server_driver_options
+)
+
+QUERY = dict(query_x=77.2090, query_y=28.6139, height=200, width=200, cell_size=10)
+
+
+def test_get_output_profile():
+    assert get_output_profile(None) is None
+    assert get_output_profile('cog') == OutputProfile(**config.output_profiles['cog'])
+    assert get_output_profile({'compress': 'deflate'}).compress == 'DEFLATE'
+    profile = OutputProfile(block_size=256)
+    assert get_output_profile(profile) == profile
+
+
+@pytest.mark.parametrize('profile, message', [
+    ('geotiff', 'output_profile should be one of'),
+    ({'compress': 'JPEG'}, 'compress should be one of'),
+    ({'encode': 'database'}, 'encode should be'),
+    ({'nbits': 3}, 'nbits should be'),
+    ({'predictor': 1}, 'predictor should be'),
+    ({'cog': True, 'nbits': 1}, "nbits of a cog needs encode='client'"),
+])
+def test_get_output_profile_errors(profile, message):
+    with pytest.raises(ValueError, match=message):
+        get_output_profile(profile)
+
+
+def test_check_profile_values():
+    check_profile_values(None, [254])
+    check_profile_values(OutputProfile(), [254])
+    check_profile_values(OutputProfile(nbits=2), [1, 0, 3])
+    with pytest.raises(ValueError, match='nbits=2 holds 0 to 3'):
+        check_profile_values(OutputProfile(nbits=2), [1, 0, 254])
+
+
+def test_creation_options():
+    assert creation_options(OutputProfile()) == ['COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+    assert creation_options(get_output_profile('cog_zstd')) == [
+        'COMPRESS=ZSTD', 'BIGTIFF=IF_SAFER', 'ZSTD_LEVEL=9', 'PREDICTOR=2',
+        'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COPY_SRC_OVERVIEWS=YES'
+    ]
+    assert 'NBITS=2' in creation_options(get_output_profile('cog_mask'))
+    # Levels of the other compressions are not GDAL options
+    assert creation_options(OutputProfile(compress='LZW', level=5)) == ['COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+
+def test_server_driver_options():
+    assert server_driver_options(get_output_profile('tiled')) == (
+        'GTiff', ['COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', 'PREDICTOR=2', 'TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256']
+    )
+    assert server_driver_options(get_output_profile('cog_zstd')) == (
+        'COG', ['COMPRESS=ZSTD', 'BIGTIFF=IF_SAFER', 'OVERVIEW_RESAMPLING=NEAREST', 'LEVEL=9', 'PREDICTOR=STANDARD', 'BLOCKSIZE=512']
+    )
+
+
+def test_overview_factors():
+    assert overview_factors(100, 200, 512) == []
+    assert overview_factors(512, 512, 512) == []
+    assert overview_factors(513, 100, 512) == [2]
+    assert overview_factors(3000, 5000, 512) == [2, 4, 8, 16]
+
+
+def test_output_sql():
+    assert output_sql('wkb') == 'ST_AsBinary(out_raster.ras)'
+    assert 'ST_AsTIFF' in output_sql()
+    sql = output_sql('tiff', 'COG', ['COMPRESS=DEFLATE', "NAME=it's"])
+    assert "'COG'" in sql
+    assert "ARRAY['COMPRESS=DEFLATE', 'NAME=it''s']::text[]" in sql
+
+
+def test_statement_output_kwargs():
+    assert statement_output_kwargs() == dict(output_format='tiff')
+    assert statement_output_kwargs(as_array=True) == dict(output_format='wkb')
+    assert statement_output_kwargs(profile=get_output_profile('cog_mask')) == dict(output_format='wkb')
+    driver_options = statement_output_kwargs(profile=get_output_profile('cog'))
+    assert driver_options['output_format'] == 'tiff' and driver_options['output_driver'] == 'COG'
+
+
+def test_analysis_output_profile():
+    assert analysis_output_profile('cog', True, None, 1, 0, 254) is None
+    assert analysis_output_profile({'nbits': 2, 'encode': 'client'}, False, None, 1, 0, 3).nbits == 2
+    with pytest.raises(ValueError, match='nbits=2 holds.*pass nodata=3'):
+        analysis_output_profile('cog_mask', False, None, 1, 0, 254)
+    with pytest.raises(ValueError, match='pass nodata=2'):
+        analysis_output_profile('cog_mask', False, None, [1, 3], 0, 254)
+    with pytest.raises(ValueError, match='no value is left for nodata'):
+        analysis_output_profile({'nbits': 1, 'encode': 'client'}, False, None, 1, 0, 254)
+    with pytest.raises(ValueError, match=r'got values \[5\] \(positive, negative, nodata\)$'):
+        analysis_output_profile('cog_mask', False, None, 5, 0, 3)
+    with pytest.raises(ValueError, match='not statistics'):
+        analysis_output_profile('cog_mask', False, ['count'], 1, 0, 3)
+
+
+def test_server_encoded_profile(make_table, tmp_path):
+    shapely = pytest.importorskip('shapely')
+    import postgis2raster
+
+    table = make_table([('road', shapely.to_wkb(shapely.LineString([(77.2085, 28.6135), (77.2095, 28.6145)])))], srid=4326)
+    output_raster = str(tmp_path / 'roads.tif')
+    assert postgis2raster.analysis_polygon(table=table, output_raster=output_raster, output_profile='tiled', **QUERY)
+    with open(output_raster, 'rb') as f:
+        assert f.read(4) in (b'II*\x00', b'MM\x00*')